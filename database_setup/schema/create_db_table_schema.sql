@@ -289,6 +289,35 @@ CREATE TABLE IF NOT EXISTS `weather_db`.`tbl_station_update` (
   UNIQUE INDEX `primary_id_UNIQUE` (`primary_id` ASC))
 ENGINE = InnoDB;
 
+
+-- -----------------------------------------------------
+-- Table `weather_db`.`tbl_cdec_sensors`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `weather_db`.`tbl_cdec_sensors` ;
+
+CREATE TABLE IF NOT EXISTS `weather_db`.`tbl_cdec_sensors` (
+  `primary_id` VARCHAR(10) NOT NULL,
+  `sens_long_name` VARCHAR(128) NOT NULL,
+  `dur_code` VARCHAR(5) NOT NULL,
+  `date_updated` DATETIME NOT NULL,
+  PRIMARY KEY (`primary_id`, `sens_long_name`, `dur_code`))
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `weather_db`.`tbl_backfill`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `weather_db`.`tbl_backfill` ;
+
+CREATE TABLE IF NOT EXISTS `weather_db`.`tbl_backfill` (
+  `station_id` VARCHAR(10) NOT NULL,
+  `source` VARCHAR(45) NOT NULL,
+  `start_time` DATETIME NOT NULL,
+  `end_time` DATETIME NOT NULL,
+  `date_completed` DATETIME NULL,
+  PRIMARY KEY (`station_id`, `source`, `start_time`))
+ENGINE = InnoDB;
+
 USE `weather_db` ;
 
 -- -----------------------------------------------------
@@ -0,0 +1,113 @@
+"""
+Benchmark parsing CDEC CSVDataServlet responses. Compares the original
+parser (one response per station and sensor, inferred date parsing, regex
+replace of '---' and pd.concat of the sensors) against the long format
+parsers, a groupby/unstack pivot and CDEC.read_csv with CDEC.long2wide
+with the C engine and the pyarrow engine if it's available.
+
+The responses are generated in the format recorded from the servlet with
+~5% missing values, no network or database connection is needed.
+
+    python benchmark_cdec_parse.py [nstations] [ndays]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'wxdb'))
+
+import cdec as cdec_module
+from cdec import CDEC
+
+HEADER = 'STATION_ID,DURATION,SENSOR_NUMBER,SENSOR_TYPE,DATE TIME,OBS DATE,VALUE,DATA_FLAG,UNITS'
+SENSORS = {2: 'RAINTIP', 3: 'SNO ADJ', 4: 'TEMP', 9: 'SPD WIND', 10: 'DIR WIND',
+           12: 'REL HUM', 18: 'SNOW DP', 26: 'SOLAR R'}
+
+
+def make_rows(stid, num, times, rng):
+    """Rows of a response for a station and sensor"""
+    values = np.round(rng.rand(len(times)) * 100, 2).astype(str)
+    values[rng.rand(len(times)) < 0.05] = '---'
+    return ['{0},H,{1},{2},{3},{3},{4}, ,UNITS'.format(stid, num, SENSORS[num], t, v)
+            for t, v in zip(times, values)]
+
+
+def make_responses(nstations, ndays):
+    """Responses for one request per station and sensor and one batched"""
+    rng = np.random.RandomState(0)
+    times = pd.date_range('2017-10-01', periods=24*ndays, freq='60min').strftime('%Y%m%d %H%M')
+
+    single = []
+    batched = [HEADER]
+    for i in range(nstations):
+        stid = 'S{:02d}'.format(i)
+        for num in SENSORS:
+            rows = make_rows(stid, num, times, rng)
+            single.append((stid, num, '\n'.join([HEADER] + rows) + '\n'))
+            batched += rows
+
+    return single, '\n'.join(batched) + '\n'
+
+
+def original(single, cdec):
+    """Parsing in cdec2df before the long format parser"""
+    cols = {v['num']: v['col'] for v in cdec.sensor_metadata.values()}
+    data = {}
+    for stid, num, text in single:
+        df = pd.read_csv(StringIO(text), header=0, parse_dates=['DATE TIME'])
+        df2 = df[['DATE TIME', 'VALUE']]
+        df2.columns = ['date_time', cols[num]]
+        df2 = df2.set_index('date_time')
+        df2 = df2.replace(r'\---', np.nan, regex=True)
+        df2[cols[num]] = pd.to_numeric(df2[cols[num]])
+        data.setdefault(stid, []).append(df2)
+
+    return {stid: pd.concat(d, axis=1) for stid, d in data.items()}
+
+
+def groupby_pivot(text, cdec):
+    """Long format read with inferred types and a groupby/unstack pivot"""
+    df = pd.read_csv(StringIO(text), header=0, parse_dates=['DATE TIME'])
+    df['VALUE'] = pd.to_numeric(df['VALUE'], errors='coerce')
+    cols = {v['num']: v['col'] for v in cdec.sensor_metadata.values()}
+    df['col'] = df['SENSOR_NUMBER'].map(cols)
+    wide = df.groupby(['STATION_ID', 'DATE TIME', 'col'])['VALUE'].first().unstack('col')
+    return {stid: d.reset_index(level=0, drop=True) for stid, d in wide.groupby(level=0)}
+
+
+def long_format(text, cdec):
+    return cdec.long2wide(cdec.read_csv(text))
+
+
+def run(name, func, arg, cdec, nrows):
+    t = time.time()
+    data = func(arg, cdec)
+    elapsed = time.time() - t
+    print('{:<30} {:>8.3f} s {:>12,.0f} rows/s {:>6} stations'.format(
+        name, elapsed, nrows / elapsed, len(data)))
+
+
+if __name__ == '__main__':
+
+    nstations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    ndays = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+
+    cdec = CDEC(None, {})
+    single, batched = make_responses(nstations, ndays)
+    nrows = nstations * len(SENSORS) * 24 * ndays
+    print('{} stations x {} sensors x {} days, {:,} rows'.format(
+        nstations, len(SENSORS), ndays, nrows))
+
+    run('original', original, single, cdec, nrows)
+    run('groupby pivot', groupby_pivot, batched, cdec, nrows)
+    engines = ['c']
+    if cdec_module.CSV_ENGINE == 'pyarrow':
+        engines.append('pyarrow')
+    for engine in engines:
+        cdec_module.CSV_ENGINE = engine
+        run('read_csv/long2wide ({})'.format(engine), long_format, batched, cdec, nrows)
@@ -0,0 +1,100 @@
+"""
+Benchmark converting a Mesowest timeseries response to dataframes. Compares
+the original Mesowest.meso2df (inferred timestamp parsing, DataFrame from
+the OBSERVATIONS dict and a strftime of every timestamp) against the
+current meso2df for every station in the decoded response.
+
+The response is generated in the format recorded from the timeseries API,
+5 minute data for a year for 10 stations with ~5% missing values, no
+network or database connection is needed.
+
+    python benchmark_meso2df.py [nstations] [ndays]
+"""
+
+import os
+import sys
+import json
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'wxdb'))
+
+import utils
+from mesowest import Mesowest
+
+VARIABLES = ['air_temp', 'relative_humidity', 'wind_speed', 'wind_direction',
+             'wind_gust', 'solar_radiation', 'precip_accum', 'snow_depth']
+
+
+def make_response(nstations, ndays):
+    """Timeseries response text with nstations stations"""
+    rng = np.random.RandomState(0)
+    times = pd.date_range('2017-10-01', periods=288*ndays, freq='5min')
+    times = times.strftime('%Y-%m-%dT%H:%M:%SZ').tolist()
+
+    stations = []
+    for i in range(nstations):
+        sv = {'date_time': {'date_time': {}}}
+        obs = {'date_time': times}
+        for v in VARIABLES:
+            sv[v] = {'{}_set_1'.format(v): {'position': ''}}
+            values = np.round(rng.rand(len(times)) * 100, 2)
+            values = [None if m else x for x, m in
+                      zip(values.tolist(), rng.rand(len(times)) < 0.05)]
+            obs['{}_set_1'.format(v)] = values
+        stations.append({'STID': 'S{:02d}'.format(i),
+                         'SENSOR_VARIABLES': sv,
+                         'OBSERVATIONS': obs})
+
+    return json.dumps({'STATION': stations, 'SUMMARY': {}})
+
+
+def original(s):
+    """meso2df before the vectorized conversion"""
+    station_id = str(s['STID'])
+    var = s['SENSOR_VARIABLES'].keys()
+    v = {}
+    for i in s['SENSOR_VARIABLES']:
+        if s['SENSOR_VARIABLES'][i]:
+            v[list(s['SENSOR_VARIABLES'][i].keys())[0]] = i
+
+    r = pd.DataFrame(s['OBSERVATIONS'], columns=s['OBSERVATIONS'].keys())
+    r['date_time'] = pd.to_datetime(r['date_time'])
+    r.set_index('date_time', inplace=True)
+    r = r.truncate(r.first_valid_index().ceil('H'), r.last_valid_index().floor('H'))
+    r['date_time'] = r.index.strftime('%Y-%m-%d %H:%M')
+    r.rename(columns=v, inplace=True)
+    vkeep = r.columns.isin(var)
+    r = r[r.columns[vkeep]]
+    r['station_id'] = station_id
+
+    if ('air_temp' in r.columns) & ('relative_humidity' in r.columns):
+        r['vapor_pressure'] = utils.rh2vp(r['air_temp'], r['relative_humidity']/100.0)
+
+    df = utils.average_df(r, station_id)
+    return r, df
+
+
+def run(name, func, data, nrows):
+    t = time.time()
+    out = [func(s) for s in data['STATION']]
+    elapsed = time.time() - t
+    print('{:<12} {:>8.3f} s {:>12,.0f} rows/s {:>6} stations'.format(
+        name, elapsed, nrows / elapsed, len(out)))
+
+
+if __name__ == '__main__':
+
+    nstations = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    ndays = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+
+    text = make_response(nstations, ndays)
+    nrows = nstations * 288 * ndays
+    print('{} stations x {} days of 5 minute data, {:,} rows, {:.0f} MB response'.format(
+        nstations, ndays, nrows, len(text) / 1024.0**2))
+
+    meso = Mesowest.__new__(Mesowest)
+    run('original', original, json.loads(text), nrows)
+    run('meso2df', meso.meso2df, json.loads(text), nrows)
@@ -0,0 +1,60 @@
+"""
+Benchmark decoding a Mesowest timeseries response. Compares decoding the
+response text with json.loads, as done with `response.text`, against
+decode_stream reading the raw bytes with ijson into typed buffers.
+
+Reports the time and peak traced memory (from a second, traced pass) of
+each method, the raw response bytes are not counted. Uses the synthetic
+response from benchmark_meso2df.py, no network connection is needed.
+
+    python benchmark_mesowest_decode.py [nstations] [ndays]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'wxdb'))
+
+from mesowest import decode_stream
+from benchmark_meso2df import make_response
+
+
+def loads(raw):
+    return json.loads(raw.decode('utf-8'))
+
+
+def stream(raw):
+    return decode_stream(io.BytesIO(raw))
+
+
+def run(name, func, raw):
+    # time without tracing then trace the memory on a second pass
+    t = time.time()
+    data = func(raw)
+    elapsed = time.time() - t
+    del data
+
+    tracemalloc.start()
+    data = func(raw)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<14} {:>8.3f} s {:>10.1f} MB peak {:>10.1f} MB retained'.format(
+        name, elapsed, peak / 1024.0**2, current / 1024.0**2))
+
+
+if __name__ == '__main__':
+
+    nstations = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    ndays = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+
+    raw = make_response(nstations, ndays).encode('utf-8')
+    print('{} stations x {} days of 5 minute data, {:.0f} MB response'.format(
+        nstations, ndays, len(raw) / 1024.0**2))
+
+    run('json.loads', loads, raw)
+    run('decode_stream', stream, raw)
@@ -0,0 +1,69 @@
+"""
+Benchmark a full station from the decoded Mesowest response to the rows
+sent to the database. Compares the frames with a string 'date_time' column
+from index.strftime, as before, against the frames that keep the times as
+the DatetimeIndex which row_batches writes as datetime64.
+
+Both run the current meso2df and serialize the raw and hourly frames with
+row_batches, no network or database connection is needed.
+
+    python benchmark_parse_to_insert.py [nstations] [ndays]
+"""
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'wxdb'))
+
+from mesowest import Mesowest
+from database import row_batches
+from benchmark_meso2df import make_response
+
+CHUNK_SIZE = 75000
+
+
+def serialize(df):
+    n = 0
+    for rows in row_batches(df, CHUNK_SIZE):
+        n += len(rows)
+    return n
+
+
+def strftime(meso, s):
+    """meso2df with the string date_time columns"""
+    r, df = meso.meso2df(s)
+    r['date_time'] = r.index.strftime('%Y-%m-%d %H:%M')
+    df['date_time'] = df.index.strftime('%Y-%m-%d %H:%M')
+    return serialize(r) + serialize(df), r.memory_usage(deep=True).sum()
+
+
+def native(meso, s):
+    """meso2df with the times as the index"""
+    r, df = meso.meso2df(s)
+    return serialize(r) + serialize(df), r.memory_usage(deep=True).sum()
+
+
+def run(name, func, meso, data):
+    t = time.time()
+    out = [func(meso, s) for s in data['STATION']]
+    elapsed = time.time() - t
+    nrows = sum([o[0] for o in out])
+    mem = sum([o[1] for o in out])
+    print('{:<10} {:>8.3f} s {:>12,.0f} rows/s {:>8.1f} MB raw frames'.format(
+        name, elapsed, nrows / elapsed, mem / 1024.0**2))
+
+
+if __name__ == '__main__':
+
+    nstations = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    ndays = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+
+    text = make_response(nstations, ndays)
+    print('{} stations x {} days of 5 minute data'.format(nstations, ndays))
+
+    meso = Mesowest.__new__(Mesowest)
+    run('strftime', strftime, meso, json.loads(text))
+    run('native', native, meso, json.loads(text))
@@ -0,0 +1,93 @@
+"""
+Benchmark the range checks in QC.run. Compares the original run (boolean
+DataFrames built column by column and the qc_flag built with .loc string
+concatenation) against the current run that checks a 2D block of all the
+columns against the min/max vectors at once, for each flag option.
+
+The data is hourly for a year for each station with ~5% missing and ~2%
+out of range values, no database connection is needed.
+
+    python benchmark_quality_control.py [nstations] [ndays]
+"""
+
+import os
+import sys
+import time
+import logging
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'wxdb'))
+
+from quality_control import QC
+
+VARIABLES = ['air_temp', 'relative_humidity', 'wind_speed', 'wind_direction',
+             'wind_gust', 'solar_radiation', 'precip_accum', 'snow_depth',
+             'vapor_pressure']
+
+
+def make_station(rng, stid, ndays):
+    """Hourly data for a station"""
+    index = pd.date_range('2017-10-01', periods=24*ndays, freq='H', name='date_time')
+    df = pd.DataFrame(index=index)
+    for v in VARIABLES:
+        lo, hi = QC.ranges[v]['min'], QC.ranges[v]['max']
+        values = rng.uniform(lo, hi, len(index))
+        bad = rng.rand(len(index))
+        values[bad < 0.02] = hi * 2
+        values[(bad >= 0.02) & (bad < 0.07)] = np.nan
+        df[v] = values
+    df['station_id'] = stid
+    return df
+
+
+def original(qc, data):
+    """QC.run before the vectorized range checks"""
+    cols = data.columns
+    r = pd.DataFrame(index=data.index)
+    m = pd.DataFrame(index=data.index)
+    for key, val in qc.ranges.items():
+        if key in cols:
+            m_idx = data[key].isnull()
+            r_idx = ~data[key].between(val['min'], val['max'])
+            r_idx[m_idx] = False
+            if qc.config['flag'] == 'remove':
+                data.loc[r_idx, key] = np.nan
+            m[key] = m_idx
+            r[key] = r_idx
+
+    r_idx = r.any(axis=1)
+    m_idx = m.any(axis=1)
+    data['qc_flag'] = None
+    data.loc[m_idx, 'qc_flag'] = 'm'
+    data.loc[r_idx, 'qc_flag'] = data.loc[r_idx, 'qc_flag'] + 'r'
+    return data
+
+
+def run(name, func, qc, stations, nrows):
+    stations = [s.copy() for s in stations]
+    t = time.time()
+    for s in stations:
+        func(qc, s)
+    elapsed = time.time() - t
+    print('{:<14} {:>8.3f} s {:>12,.0f} rows/s'.format(name, elapsed, nrows / elapsed))
+
+
+if __name__ == '__main__':
+
+    nstations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    ndays = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+
+    # the flagged rows are logged as warnings for every station
+    logging.getLogger('quality_control').setLevel(logging.ERROR)
+
+    rng = np.random.RandomState(0)
+    stations = [make_station(rng, 'S{:03d}'.format(i), ndays) for i in range(nstations)]
+    nrows = nstations * 24 * ndays
+    print('{} stations x {} days of hourly data, {:,} rows'.format(nstations, ndays, nrows))
+
+    run('original', original, QC({'flag': 'remove'}), stations, nrows)
+    for flag in ['remove', 'cap', 'fill']:
+        qc = QC({'flag': flag})
+        run('run {}'.format(flag), lambda q, d: q.run(d), qc, stations, nrows)
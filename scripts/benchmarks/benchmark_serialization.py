@@ -0,0 +1,100 @@
+"""
+Benchmark the row serialization used by Database.insert_data. Compares the
+original df.where(pd.notnull(df), None) and tuple(rw) approach against
+row_batches, and DataFrame.to_csv against write_delimited for the bulk
+insert method, on a 1M row frame.
+
+Reports rows/second and peak traced memory (from a second, traced pass)
+for each method, no database connection is needed.
+
+    python benchmark_serialization.py [nrows]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'wxdb'))
+
+from database import row_batches, write_delimited, chunks
+
+CHUNK_SIZE = 75000
+COLUMNS = ['air_temp', 'dew_point_temperature', 'relative_humidity',
+           'wind_speed', 'wind_direction', 'wind_gust', 'solar_radiation',
+           'snow_smoothed', 'precip_accum', 'snow_depth', 'snow_interval',
+           'snow_water_equiv', 'vapor_pressure']
+
+
+class NullWriter():
+    """File like object that throws away what is written"""
+    def write(self, s):
+        pass
+
+    def writelines(self, lines):
+        for l in lines:
+            pass
+
+
+def make_frame(nrows):
+    """Station like frame with 10% missing values"""
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(rng.randn(nrows, len(COLUMNS)) * 10, columns=COLUMNS)
+    df = df.mask(rng.rand(nrows, len(COLUMNS)) < 0.1)
+    df['station_id'] = 'BOGI1'
+    df['date_time'] = pd.date_range('2000-01-01', periods=nrows, freq='5min').values
+    return df
+
+
+def original(df):
+    """Serialization in insert_data before the columnar serializer"""
+    d = df.copy()
+    d['date_time'] = d['date_time'].dt.strftime('%Y-%m-%d %H:%M')
+    d = d.where((pd.notnull(d)), None)
+    data = [tuple(rw) for rw in d.values]
+    for c in chunks(data, CHUNK_SIZE):
+        pass
+
+
+def to_csv(df):
+    """Delimited file written by pandas for the bulk insert method"""
+    df.to_csv(NullWriter(), sep='\t', header=False, index=False,
+              na_rep='NULL', chunksize=CHUNK_SIZE)
+
+
+def batches(df):
+    for c in row_batches(df, CHUNK_SIZE):
+        pass
+
+
+def delimited(df):
+    write_delimited(df, NullWriter(), CHUNK_SIZE)
+
+
+def run(name, func, df):
+    # time without tracing then trace the memory on a second pass
+    t = time.time()
+    func(df)
+    elapsed = time.time() - t
+
+    tracemalloc.start()
+    func(df)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<20} {:>12,.0f} rows/s {:>10.1f} MB peak'.format(
+        name, len(df) / elapsed, peak / 1024.0**2))
+
+
+if __name__ == '__main__':
+
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    df = make_frame(nrows)
+    print('{:,} rows x {} columns'.format(nrows, len(df.columns)))
+
+    run('original', original, df)
+    run('row_batches', batches, df)
+    run('to_csv', to_csv, df)
+    run('write_delimited', delimited, df)
@@ -0,0 +1,83 @@
+"""
+Benchmark the vapor pressure calculation in utils.rh2vp. Compares the
+original rh2vp/sati/satw (boolean mask indexing, repeated temporaries and
+modifying the input) against the current kernel that computes each branch
+only for its own values with `out=` ufuncs in shared work arrays, in
+float64 and float32.
+
+The air temperature and relative humidity are random values over the
+range seen at the stations with ~5% missing values.
+
+    python benchmark_vapor_pressure.py [nvalues]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'wxdb'))
+
+import utils
+from utils import FREEZE, BOIL, SEA_LEVEL
+
+
+def satw(tk):
+    """satw before the kernel"""
+    tk[tk < 0] = np.nan
+    l10 = np.log(10.0)
+    btk = BOIL/tk
+    x = -7.90298*(btk - 1.0) + 5.02808*np.log(btk)/l10 - \
+        1.3816e-7*(np.power(10.0, 1.1344e1*(1.0 - tk/BOIL))-1.) + \
+        8.1328e-3*(np.power(10.0, -3.49149*(btk - 1.0)) - 1.0) + \
+        np.log(SEA_LEVEL)/l10
+    return np.power(10.0, x)
+
+
+def sati(tk):
+    """sati before the kernel"""
+    tk[tk < 0] = np.nan
+    x = np.empty(tk.shape)
+    ind = tk > FREEZE
+    x[ind] = satw(tk[ind])
+    l10 = np.log(10.0)
+    x[~ind] = 100.0 * np.power(10.0, -9.09718*((FREEZE/tk[~ind]) - 1.0) -
+                               3.56654*np.log(FREEZE/tk[~ind])/l10 +
+                               8.76793e-1*(1.0 - (tk[~ind]/FREEZE)) +
+                               np.log(6.1071)/l10)
+    return x
+
+
+def original(ta, rh):
+    """rh2vp before the kernel"""
+    if np.max(rh) >= 1.0:
+        rh = rh / 100.0
+    return sati(ta + FREEZE) * rh
+
+
+def run(name, func, ta, rh, repeat=5):
+    t = time.time()
+    for i in range(repeat):
+        vp = func(ta, rh)
+    elapsed = (time.time() - t) / repeat
+    print('{:<18} {:>8.3f} s {:>14,.0f} values/s'.format(name, elapsed, len(ta) / elapsed))
+    return vp
+
+
+if __name__ == '__main__':
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    rng = np.random.RandomState(0)
+    ta = rng.uniform(-40, 45, n)
+    ta[rng.rand(n) < 0.05] = np.nan
+    rh = rng.uniform(0.05, 0.99, n)
+    print('{:,} values'.format(n))
+
+    a = run('original', original, ta, rh)
+    b = run('rh2vp float64', utils.rh2vp, ta, rh)
+    c = run('rh2vp float32', utils.rh2vp, ta.astype(np.float32), rh.astype(np.float32))
+
+    print('max relative difference float64 {:.3g}, float32 {:.3g}'.format(
+        np.nanmax(np.abs(b - a) / a), np.nanmax(np.abs(c - a) / a)))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `wxdb.backfill`."""
+
+import os
+import sys
+import unittest
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wxdb'))
+
+from backfill import Backfill
+
+
+class FakeCursor():
+
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, qry, params):
+        self.db.executed.append((qry, params))
+        self.stations = params[1:]
+
+    def executemany(self, qry, rows):
+        self.db.inserted += rows
+
+    def fetchall(self):
+        return [r for r in self.db.rows if r[0] in self.stations]
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def commit(self):
+        pass
+
+
+class FakeDatabase():
+    """Database with the tbl_backfill rows, recording the writes"""
+
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.executed = []
+        self.inserted = []
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+
+def utc(t):
+    return pd.Timestamp(t, tz='UTC')
+
+
+class TestSplit(unittest.TestCase):
+
+    def test_epoch_aligned(self):
+        """the inner edges are multiples of the chunk from the epoch"""
+
+        bf = Backfill(FakeDatabase(), 'mesowest', pd.Timedelta(days=7))
+        start = utc('2017-10-03 05:00')
+        end = utc('2017-11-20 13:00')
+        split = bf.split(start, end)
+
+        self.assertEqual(split[0][0], start)
+        self.assertEqual(split[-1][1], end)
+        for (s, e), (s2, e2) in zip(split[:-1], split[1:]):
+            self.assertEqual(e, s2)
+            self.assertEqual(e.value % bf.chunk.value, 0)
+        for s, e in split:
+            self.assertTrue(s < e <= s + bf.chunk)
+
+        # another start in the same chunk shares the later chunks
+        other = bf.split(start + pd.Timedelta(days=1), end)
+        self.assertEqual(other[1:], split[1:])
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk = pd.Timedelta(days=7)
+
+    def test_short_range(self):
+        """ranges shorter than a chunk are retrieved normally"""
+
+        db = FakeDatabase()
+        bf = Backfill(db, 'mesowest', self.chunk)
+        start, chunks = bf.plan({'BOGI1': datetime(2017, 10, 1)}, datetime(2017, 10, 3))
+
+        self.assertEqual(start, {'BOGI1': utc('2017-10-01')})
+        self.assertEqual(chunks, [])
+        self.assertEqual(db.inserted, [])
+
+    def test_new_chunks(self):
+        """long ranges are split and recorded as naive UTC"""
+
+        db = FakeDatabase()
+        bf = Backfill(db, 'mesowest', self.chunk)
+        start, chunks = bf.plan({'BOGI1': pd.Timestamp('2017-10-01', tz='US/Mountain')},
+                                datetime(2017, 11, 1))
+
+        self.assertEqual(start, {})
+        self.assertEqual(chunks[0], ('BOGI1', utc('2017-10-01 06:00'), utc('2017-10-05')))
+        self.assertEqual(chunks[-1][2], utc('2017-11-01'))
+        self.assertEqual(db.inserted[0],
+                         ('BOGI1', 'mesowest', datetime(2017, 10, 1, 6), datetime(2017, 10, 5)))
+        self.assertEqual(len(db.inserted), len(chunks))
+
+    def test_pending(self):
+        """chunks that were not completed are requested again"""
+
+        rows = [('BOGI1', datetime(2017, 10, 5), datetime(2017, 10, 12), None),
+                ('BOGI1', datetime(2017, 10, 12), datetime(2017, 10, 19), datetime(2017, 10, 20)),
+                ('GIN', datetime(2017, 10, 12), datetime(2017, 10, 19), None)]
+        db = FakeDatabase(rows)
+        bf = Backfill(db, 'mesowest', self.chunk)
+        start, chunks = bf.plan({'BOGI1': datetime(2017, 10, 5)}, datetime(2017, 10, 20))
+
+        self.assertEqual(chunks, [('BOGI1', utc('2017-10-05'), utc('2017-10-12'))])
+        self.assertEqual(start, {'BOGI1': utc('2017-10-19')})
+        self.assertEqual(db.executed[0][1], ['mesowest', 'BOGI1'])
+
+    def test_resume(self):
+        """the start moves to the end of the last recorded chunk"""
+
+        rows = [('BOGI1', datetime(2017, 10, 5), datetime(2017, 10, 12), datetime(2017, 10, 20))]
+        bf = Backfill(FakeDatabase(rows), 'mesowest', self.chunk)
+
+        # the recorded end is later than the requested start
+        start, chunks = bf.plan({'BOGI1': datetime(2017, 10, 1)}, datetime(2017, 11, 1))
+        self.assertEqual(start, {})
+        self.assertEqual(chunks[0][1], utc('2017-10-12'))
+
+        # a later start than the recorded end is kept
+        start, chunks = bf.plan({'BOGI1': datetime(2017, 10, 30)}, datetime(2017, 11, 1))
+        self.assertEqual(start, {'BOGI1': utc('2017-10-30')})
+        self.assertEqual(chunks, [])
+
+        # nothing left to retrieve
+        start, chunks = bf.plan({'BOGI1': datetime(2017, 10, 1)}, datetime(2017, 10, 12))
+        self.assertEqual(start, {})
+        self.assertEqual(chunks, [])
+
+
+class TestTrim(unittest.TestCase):
+
+    def setUp(self):
+        self.bf = Backfill(FakeDatabase(), 'mesowest')
+        self.chunk = (utc('2017-10-01'), utc('2017-10-02'))
+
+    def test_naive(self):
+        """naive times are UTC"""
+
+        index = pd.date_range('2017-10-01', '2017-10-02 03:00', freq='60min')
+        df = pd.DataFrame({'air_temp': np.arange(len(index))}, index=index)
+        trimmed = self.bf.trim(df, self.chunk)
+
+        self.assertEqual(len(trimmed), 24)
+        self.assertEqual(trimmed.index[-1], pd.Timestamp('2017-10-01 23:00'))
+
+    def test_tz_aware(self):
+        """aware times in another timezone are compared in UTC"""
+
+        index = pd.date_range('2017-09-30 17:00', periods=30, freq='60min', tz='US/Pacific')
+        df = pd.DataFrame({'air_temp': np.arange(len(index))}, index=index)
+        trimmed = self.bf.trim(df, (self.chunk[0], pd.Timestamp('2017-10-01 17:00', tz='US/Pacific')))
+
+        self.assertEqual(len(trimmed), 24)
+        self.assertEqual(trimmed.index[-1], utc('2017-10-01 23:00'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `wxdb.cdec`."""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+try:
+    # Python 2
+    from StringIO import StringIO
+except ImportError:
+    # Python 3
+    from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wxdb'))
+
+import cdec
+from cdec import CDEC
+
+HEADER = 'STATION_ID,DURATION,SENSOR_NUMBER,SENSOR_TYPE,DATE TIME,OBS DATE,VALUE,DATA_FLAG,UNITS\n'
+
+
+def make_csv(rng):
+    """Long CSV text for a few stations with missing, duplicate and unknown sensors"""
+    times = pd.date_range('2017-10-01', periods=48, freq='60min')
+    lines = []
+    for stid in ['GIN', 'Dan', 'TUM']:
+        for num in [4, 12, 26, 103, 999]:
+            for t in times:
+                v = rng.rand()
+                value = '---' if v < 0.1 else ('' if v < 0.15 else '{:.2f}'.format(v * 100))
+                lines.append('{},H,{},X,{},{},{}, ,X'.format(
+                    stid, num, t.strftime('%Y%m%d %H%M'), t.strftime('%Y%m%d %H%M'), value))
+    rng.shuffle(lines)
+    return HEADER + '\n'.join(lines) + '\n'
+
+
+def reference(text):
+    """Wide frames with pandas, keeping the first value for each cell"""
+    df = pd.read_csv(StringIO(text), na_values={'VALUE': ['---', '']},
+                     keep_default_na=False)
+    lookup = {v['num']: v['col'] for v in CDEC.sensor_metadata.values()}
+    df['col'] = df['SENSOR_NUMBER'].map(lookup)
+    df = df.dropna(subset=['col', 'VALUE'])
+    df['date_time'] = pd.to_datetime(df['DATE TIME'], format=CDEC.date_format)
+
+    # sensors that map to the same column are ordered by column then
+    # sensor number, first in the response order
+    df = df.sort_values(['STATION_ID', 'date_time', 'col'], kind='mergesort')
+
+    data = {}
+    for stid, d in df.groupby('STATION_ID'):
+        w = d.pivot_table(index='date_time', columns='col', values='VALUE', aggfunc='first')
+        data[stid.upper()] = w
+    return data
+
+
+class TestLong2Wide(unittest.TestCase):
+    """read_csv and long2wide against a pandas pivot"""
+
+    def setUp(self):
+        self.cdec = CDEC.__new__(CDEC)
+
+    def test_pivot(self):
+        text = make_csv(np.random.RandomState(0))
+        data = self.cdec.long2wide(self.cdec.read_csv(text))
+        ref = reference(text)
+
+        self.assertEqual(sorted(data.keys()), sorted(ref.keys()))
+        for stid in ref:
+            d = data[stid]
+            r = ref[stid].reindex(index=d.index, columns=d.columns)
+            self.assertEqual(sorted(d.columns), sorted(ref[stid].columns))
+            np.testing.assert_array_equal(d.values, r.values)
+
+    def test_parse_failure(self):
+        """a response that isn't the CSV format raises"""
+        with self.assertRaises(Exception):
+            self.cdec.read_csv('<html>Service unavailable</html>')
+
+
+@unittest.skipIf(cdec.CSV_ENGINE != 'pyarrow', 'pyarrow CSV engine is not available')
+class TestPyarrowEngine(unittest.TestCase):
+    """read_csv with the pyarrow engine against the C engine"""
+
+    def setUp(self):
+        self.cdec = CDEC.__new__(CDEC)
+
+    def tearDown(self):
+        cdec.CSV_ENGINE = 'pyarrow'
+
+    def read(self, text, engine):
+        cdec.CSV_ENGINE = engine
+        return self.cdec.read_csv(text)
+
+    def test_engines(self):
+        text = make_csv(np.random.RandomState(1))
+        text += 'GIN,H,4,X,20171005 0000,20171005 0000,---, ,X\n'
+        text += ',H,4,X,20171005 0000,20171005 0000,1.5, ,X\n'
+
+        df = self.read(text, 'pyarrow')
+        ref = self.read(text, 'c')
+
+        self.assertEqual(list(df.columns), list(ref.columns))
+        for c in ref.columns:
+            np.testing.assert_array_equal(df[c].values, ref[c].values)
+        self.assertEqual(df['VALUE'].dtype, np.float64)
+        self.assertEqual(df['STATION_ID'].values[-1], '')
+        self.assertTrue(np.isnan(df['VALUE'].values[-2]))
+
+        data = self.cdec.long2wide(df)
+        self.assertEqual(sorted(data.keys()), sorted(reference(text).keys()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `wxdb.database`."""
+
+import csv
+import io
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wxdb'))
+
+import database
+from database import Database
+
+
+class FakeCursor():
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.sql.append(sql)
+
+    def executemany(self, sql, rows):
+        self.sql.append(sql)
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+
+    def __init__(self):
+        self.sql = []
+
+    def cursor(self):
+        return FakeCursor(self.sql)
+
+    def commit(self):
+        pass
+
+
+def make_db():
+    db = Database.__new__(Database)
+    db._logger = logging.getLogger(__name__)
+    db.chunk_size = 100
+    return db
+
+
+class TestStagingTable(unittest.TestCase):
+
+    def test_quote_identifier(self):
+        self.assertEqual(database.quote_identifier('tbl_level1'), '`tbl_level1`')
+        self.assertEqual(database.quote_identifier('db.tbl_level1'), '`db`.`tbl_level1`')
+        self.assertEqual(database.quote_identifier('a`b'), '`a``b`')
+
+    def test_staging_table(self):
+        self.assertEqual(database.staging_table('tmp_stage_', 'db.tbl_level1'),
+                         '`tmp_stage_tbl_level1`')
+
+    def test_bulk_insert(self):
+        """a schema qualified table gets an unqualified staging table"""
+
+        df = pd.DataFrame({'station_id': ['BOGI1'], 'air_temp': [1.5]},
+                          index=pd.DatetimeIndex(['2017-01-01 00:00'], name='date_time'))
+        cnx = FakeConnection()
+        make_db()._bulk_insert(cnx, df, 'db.tbl_level1')
+
+        self.assertEqual(cnx.sql[0], 'DROP TEMPORARY TABLE IF EXISTS `tmp_stage_tbl_level1`')
+        self.assertTrue(cnx.sql[1].startswith('CREATE TEMPORARY TABLE `tmp_stage_tbl_level1` '))
+        self.assertTrue(cnx.sql[1].endswith(' FROM `db`.`tbl_level1` LIMIT 0'))
+        self.assertTrue(cnx.sql[3].startswith('INSERT INTO `db`.`tbl_level1` '))
+        self.assertIn(' FROM `tmp_stage_tbl_level1` ', cnx.sql[3])
+
+    def test_batch_update(self):
+        df = pd.DataFrame({'primary_id': ['BOGI1'], 'elevation': [1000.0]})
+        cnx = FakeConnection()
+        make_db()._batch_update(cnx, df, 'db.tbl_metadata', 'primary_id')
+
+        self.assertEqual(cnx.sql[0], 'DROP TEMPORARY TABLE IF EXISTS `tmp_update_tbl_metadata`')
+        self.assertTrue(cnx.sql[1].startswith('CREATE TEMPORARY TABLE `tmp_update_tbl_metadata` '))
+        self.assertTrue(cnx.sql[1].endswith(' FROM `db`.`tbl_metadata` LIMIT 0'))
+        self.assertTrue(cnx.sql[3].startswith('UPDATE `db`.`tbl_metadata` t JOIN `tmp_update_tbl_metadata` u '))
+
+
+class PoolConnection():
+
+    def __init__(self, fail_rollback=False):
+        self.fail_rollback = fail_rollback
+        self.closed = False
+
+    def rollback(self):
+        if self.fail_rollback:
+            raise Exception('lost connection')
+
+    def is_connected(self):
+        return not self.closed
+
+    def set_converter_class(self, converter):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def waiter(self, pool):
+        """start a thread waiting for a connection from the pool"""
+
+        got = []
+        t = threading.Thread(target=lambda: got.append(pool.get()))
+        t.daemon = True
+        t.start()
+        time.sleep(0.05)
+        self.assertTrue(t.is_alive())
+        return t, got
+
+    def test_put_failed_rollback_wakes_waiter(self):
+        pool = database.ConnectionPool(lambda: PoolConnection(), size=1)
+        cnx = pool.get()
+        cnx.fail_rollback = True
+
+        t, got = self.waiter(pool)
+        pool.put(cnx)
+        t.join(2)
+
+        self.assertFalse(t.is_alive())
+        self.assertIsNot(got[0], cnx)
+        self.assertTrue(cnx.closed)
+        self.assertEqual(pool.stats()['opened'], 2)
+
+    def test_discard_wakes_waiter(self):
+        pool = database.ConnectionPool(lambda: PoolConnection(), size=1)
+        cnx = pool.get()
+
+        t, got = self.waiter(pool)
+        pool.discard(cnx)
+        t.join(2)
+
+        self.assertFalse(t.is_alive())
+        self.assertFalse(got[0].closed)
+
+    def test_put_reuses(self):
+        pool = database.ConnectionPool(lambda: PoolConnection(), size=1)
+        cnx = pool.get()
+
+        t, got = self.waiter(pool)
+        pool.put(cnx)
+        t.join(2)
+
+        self.assertIs(got[0], cnx)
+        self.assertEqual(pool.stats()['reused'], 1)
+
+    def test_timeout(self):
+        pool = database.ConnectionPool(lambda: PoolConnection(), size=1, timeout=0.05)
+        pool.get()
+        self.assertRaises(database.mysql.connector.PoolError, pool.get)
+
+    def test_placeholders_not_idle(self):
+        pool = database.ConnectionPool(lambda: PoolConnection(), size=2)
+        a = pool.get()
+        b = pool.get()
+        pool.discard(a)
+        pool.put(b)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+        pool.close()
+        self.assertTrue(b.closed)
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertEqual(len([pool.get(), pool.get()]), 2)
+
+
+class TestLocalInfile(unittest.TestCase):
+    """LOCAL INFILE is only allowed when bulk loading is configured"""
+
+    config = {'user': 'user', 'password': 'password', 'host': 'localhost',
+              'database': 'weather_db'}
+
+    def setUp(self):
+        self.connect = database.mysql.connector.connect
+        self.kwargs = []
+
+        def connect(**kwargs):
+            self.kwargs.append(kwargs)
+            return PoolConnection()
+        database.mysql.connector.connect = connect
+
+    def tearDown(self):
+        database.mysql.connector.connect = self.connect
+
+    def test_insert(self):
+        db = Database(dict(self.config))
+        with db.connection():
+            pass
+
+        self.assertFalse(self.kwargs[0]['allow_local_infile'])
+        self.assertNotIn('allow_local_infile_in_path', self.kwargs[0])
+
+        df = pd.DataFrame({'station_id': ['BOGI1']})
+        self.assertRaises(ValueError, db.insert_data, df, 'data', method='bulk')
+
+    def test_bulk(self):
+        db = Database(dict(self.config, insert_method='bulk'))
+        with db.connection():
+            pass
+
+        if database.LOCAL_INFILE_IN_PATH:
+            self.assertFalse(self.kwargs[0]['allow_local_infile'])
+            self.assertEqual(self.kwargs[0]['allow_local_infile_in_path'],
+                             tempfile.gettempdir())
+        else:
+            self.assertTrue(self.kwargs[0]['allow_local_infile'])
+
+
+class TestSerialization(unittest.TestCase):
+    """rows for executemany and lines for LOAD DATA INFILE"""
+
+    def setUp(self):
+        index = pd.DatetimeIndex(['2017-10-01 00:00', '2017-10-01 01:00', '2017-10-01 02:00'],
+                                 tz='US/Mountain', name='date_time')
+        self.df = pd.DataFrame({'station_id': ['BOGI1', None, 'a\tb'],
+                                'air_temp': [1.5, np.nan, -2.25],
+                                'count': [1, 2, 3]}, index=index,
+                               columns=['station_id', 'air_temp', 'count'])
+
+    def test_write_columns(self):
+        """a DatetimeIndex is written as date_time in naive UTC"""
+
+        self.assertEqual(database.write_columns(self.df),
+                         ['station_id', 'air_temp', 'count', 'date_time'])
+        arrays = database.frame_arrays(self.df)
+        self.assertEqual(len(arrays), 4)
+        np.testing.assert_array_equal(arrays[-1], np.array(
+            ['2017-10-01T06:00', '2017-10-01T07:00', '2017-10-01T08:00'], dtype='datetime64[ns]'))
+
+        # an existing date_time column is written instead of the index
+        df = self.df.reset_index()
+        df.index = self.df.index
+        self.assertEqual(database.write_columns(df).count('date_time'), 1)
+        self.assertEqual(len(database.frame_arrays(df)), 4)
+
+    def test_column_values(self):
+        """missing values are None"""
+
+        self.assertEqual(database.column_values(np.array([1.5, np.nan])), [1.5, None])
+        self.assertEqual(database.column_values(
+            np.array(['2017-10-01T06:00', 'NaT'], dtype='datetime64[ns]')),
+            [datetime(2017, 10, 1, 6), None])
+        self.assertEqual(database.column_values(np.array(['a', None, np.nan], dtype=object)),
+                         ['a', None, None])
+        values = database.column_values(np.array([1, 2], dtype=np.int64))
+        self.assertEqual(values, [1, 2])
+        self.assertTrue(all(type(v) is int for v in values))
+
+    def test_row_batches(self):
+        batches = list(database.row_batches(self.df, 2))
+
+        self.assertEqual([len(b) for b in batches], [2, 1])
+        self.assertEqual(batches[0][0], ('BOGI1', 1.5, 1, datetime(2017, 10, 1, 6)))
+        self.assertEqual(batches[0][1], (None, None, 2, datetime(2017, 10, 1, 7)))
+        self.assertEqual(batches[1][0], ('a\tb', -2.25, 3, datetime(2017, 10, 1, 8)))
+
+    def test_column_strings(self):
+        """missing values are the unquoted word NULL"""
+
+        self.assertEqual(database.column_strings(np.array([0.1, np.nan])), ['0.1', 'NULL'])
+        self.assertEqual(database.column_strings(
+            np.array(['2017-10-01T06:00', 'NaT'], dtype='datetime64[ns]')),
+            ['2017-10-01 06:00:00', 'NULL'])
+        self.assertEqual(database.column_strings(np.array([1, 2])), ['1', '2'])
+
+    def test_quoting(self):
+        """values that can't be written bare are enclosed in double quotes"""
+
+        values = np.array(['plain', None, 'tab\there', 'new\nline', 'say "hi"', 'NULL'],
+                          dtype=object)
+        self.assertEqual(database.column_strings(values),
+                         ['plain', 'NULL', '"tab\there"', '"new\nline"',
+                          '"say ""hi"""', '"NULL"'])
+
+    def test_write_delimited(self):
+        """the lines read back with the LOAD DATA field and line options"""
+
+        df = pd.DataFrame({'station_id': ['new\nline', 'NULL', None, 'say "hi"'],
+                           'air_temp': [0.1, np.nan, 3.0, 1e-7]},
+                          index=pd.date_range('2017-10-01', periods=4, freq='60min'))
+        f = io.StringIO()
+        database.write_delimited(df, f, 3)
+
+        reader = csv.reader(io.StringIO(f.getvalue()), delimiter='\t', quotechar='"',
+                            doublequote=True, lineterminator='\n')
+        rows = list(reader)
+        self.assertEqual(rows, [
+            ['new\nline', '0.1', '2017-10-01 00:00:00'],
+            ['NULL', 'NULL', '2017-10-01 01:00:00'],
+            ['NULL', '3.0', '2017-10-01 02:00:00'],
+            ['say "hi"', '1e-07', '2017-10-01 03:00:00']])
+
+        # only a bare NULL is read as NULL, a quoted one is the string
+        lines = f.getvalue().split('\n')
+        self.assertTrue(lines[2].startswith('"NULL"\tNULL\t'))
+        self.assertTrue(lines[3].startswith('NULL\t3.0\t'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `wxdb.fetch`."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wxdb'))
+
+import fetch
+
+
+class FakeResponse():
+
+    def __init__(self, retry_after=None):
+        self.headers = {}
+        if retry_after is not None:
+            self.headers['Retry-After'] = retry_after
+
+
+class TestWait(unittest.TestCase):
+
+    def setUp(self):
+        self.delays = []
+        self.sleep = fetch.time.sleep
+        fetch.time.sleep = self.delays.append
+
+    def tearDown(self):
+        fetch.time.sleep = self.sleep
+
+    def test_retry_after_capped(self):
+        f = fetch.Fetcher(backoff=0.01, max_retry_after=5)
+        f._wait(1, FakeResponse('3600'))
+        self.assertEqual(self.delays, [5])
+
+    def test_retry_after(self):
+        f = fetch.Fetcher(backoff=0.01, max_retry_after=5)
+        f._wait(1, FakeResponse('2'))
+        f._wait(1, FakeResponse('soon'))
+        self.assertEqual(self.delays[0], 2)
+        self.assertLess(self.delays[1], 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
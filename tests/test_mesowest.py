@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `wxdb.mesowest`."""
+
+import io
+import logging
+import os
+import sys
+import json
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wxdb'))
+
+import utils
+from backfill import Backfill
+from fetch import Request
+from mesowest import Mesowest, decode_stream, ijson
+
+VARIABLES = ['air_temp', 'relative_humidity', 'wind_speed', 'wind_direction', 'precip_accum']
+
+
+def make_response(nstations=3, nhours=30):
+    """Timeseries response in the format of the Mesowest API"""
+    rng = np.random.RandomState(0)
+    times = pd.date_range('2017-10-01 00:05', periods=12*nhours, freq='5min')
+    times = times.strftime('%Y-%m-%dT%H:%M:%SZ').tolist()
+
+    stations = []
+    for i in range(nstations):
+        sv = {'date_time': {'date_time': {}}}
+        obs = {'date_time': times}
+        for v in VARIABLES:
+            sv[v] = {'{}_set_1'.format(v): {'position': ''}}
+            values = np.round(rng.rand(len(times)) * 100, 2).tolist()
+            obs['{}_set_1'.format(v)] = [None if m else x for x, m in
+                                         zip(values, rng.rand(len(times)) < 0.1)]
+        # integers are valid JSON numbers too
+        obs['air_temp_set_1'][3] = 7
+        stations.append({'STID': 'S{:02d}'.format(i), 'NAME': u'Station é',
+                         'SENSOR_VARIABLES': sv, 'OBSERVATIONS': obs})
+
+    return json.dumps({'SUMMARY': {'RESPONSE_CODE': 1, 'NUMBER_OF_OBJECTS': nstations},
+                       'STATION': stations})
+
+
+def reference(s):
+    """meso2df with pandas, as before the vectorized conversion"""
+    v = {}
+    for i in s['SENSOR_VARIABLES']:
+        if s['SENSOR_VARIABLES'][i]:
+            v[list(s['SENSOR_VARIABLES'][i].keys())[0]] = i
+
+    r = pd.DataFrame(s['OBSERVATIONS'], columns=s['OBSERVATIONS'].keys())
+    r['date_time'] = pd.to_datetime(r['date_time']).dt.tz_localize(None)
+    r.set_index('date_time', inplace=True)
+    r = r.truncate(r.first_valid_index().ceil('H'), r.last_valid_index().floor('H'))
+    r.rename(columns=v, inplace=True)
+    r = r[[c for c in r.columns if c in s['SENSOR_VARIABLES']]].astype(float)
+    r['station_id'] = str(s['STID'])
+    r['vapor_pressure'] = utils.rh2vp(r['air_temp'], r['relative_humidity']/100.0)
+    return r
+
+
+class TestDecodeStream(unittest.TestCase):
+    """decode_stream against json.loads"""
+
+    @unittest.skipIf(ijson is None, 'ijson is not installed')
+    def test_decode(self):
+        text = make_response()
+        expected = json.loads(text)
+        data = decode_stream(io.BytesIO(text.encode('utf-8')), chunk_size=50)
+
+        self.assertEqual(data['SUMMARY'], expected['SUMMARY'])
+        self.assertEqual(len(data['STATION']), len(expected['STATION']))
+
+        for s, e in zip(data['STATION'], expected['STATION']):
+            self.assertEqual(s['STID'], e['STID'])
+            self.assertEqual(s['NAME'], e['NAME'])
+            self.assertEqual(s['SENSOR_VARIABLES'], e['SENSOR_VARIABLES'])
+            self.assertEqual(sorted(s['OBSERVATIONS'].keys()), sorted(e['OBSERVATIONS'].keys()))
+
+            for key, values in e['OBSERVATIONS'].items():
+                if key == 'date_time':
+                    expected_values = pd.to_datetime(values).tz_localize(None).values
+                else:
+                    expected_values = np.array(values, dtype=np.float64)
+                np.testing.assert_array_equal(s['OBSERVATIONS'][key], expected_values)
+
+    @unittest.skipIf(ijson is None, 'ijson is not installed')
+    def test_no_data(self):
+        text = json.dumps({'SUMMARY': {'RESPONSE_CODE': 2, 'RESPONSE_MESSAGE': 'No stations'}})
+        data = decode_stream(io.BytesIO(text.encode('utf-8')))
+        self.assertEqual(data, json.loads(text))
+
+
+class TestMeso2df(unittest.TestCase):
+    """meso2df against the pandas conversion"""
+
+    def test_meso2df(self):
+        meso = Mesowest.__new__(Mesowest)
+
+        for s in json.loads(make_response())['STATION']:
+            r, df = meso.meso2df(s)
+            ref = reference(s)
+
+            self.assertTrue(r.index.equals(ref.index))
+            self.assertEqual(sorted(r.columns), sorted(ref.columns))
+            for c in ref.columns:
+                if c == 'station_id':
+                    self.assertTrue((r[c] == ref[c]).all())
+                else:
+                    np.testing.assert_allclose(r[c].values, ref[c].values)
+
+            av = utils.average_df(ref, str(s['STID']))
+            self.assertTrue(df.index.equals(av.index))
+            np.testing.assert_allclose(df[VARIABLES].values, av[VARIABLES].values)
+
+
+class FakeBackfill(Backfill):
+    """Backfill that records the completed stations instead of writing them"""
+
+    def __init__(self):
+        self.completed = []
+
+    def complete(self, stations, chunk):
+        self.completed += list(stations)
+
+
+class FakeResponse():
+
+    def __init__(self, text):
+        self.status_code = 200
+        self.text = text
+
+    def close(self):
+        pass
+
+
+class TestParseResponse(unittest.TestCase):
+    """stations without data are completed, failed stations are not"""
+
+    def setUp(self):
+        self.meso = Mesowest.__new__(Mesowest)
+        self.meso._logger = logging.getLogger(__name__)
+        self.meso.stream = False
+        self.meso.backfill = FakeBackfill()
+
+    def test_backfill_chunk(self):
+        data = json.loads(make_response(nstations=4))
+        stations = data['STATION']
+        stations[1]['OBSERVATIONS'] = {}
+        for key in stations[2]['OBSERVATIONS']:
+            if key != 'date_time':
+                stations[2]['OBSERVATIONS'][key] = [None] * len(stations[2]['OBSERVATIONS'][key])
+        stations[3]['OBSERVATIONS']['date_time'][5] = 'bogus'
+
+        group = ['S00', 'S01', 'S02', 'S03', 'S04']
+        chunk = (pd.Timestamp('2017-10-01 00:00'), pd.Timestamp('2017-10-01 12:00'))
+        req = Request('', key=(group, chunk))
+        out = self.meso.parse_response((req, FakeResponse(json.dumps(data))))
+
+        self.assertEqual([o[0] for o in out], ['S00'])
+        self.assertTrue(out[0][1].index.max() < chunk[1])
+        self.assertEqual(sorted(self.meso.backfill.completed), ['S01', 'S02', 'S04'])
+
+    def test_no_full_hour(self):
+        s = json.loads(make_response(nstations=1, nhours=1))['STATION'][0]
+        s['OBSERVATIONS'] = {k: v[:6] for k, v in s['OBSERVATIONS'].items()}
+        self.assertEqual(self.meso.meso2df(s), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `wxdb.stations`."""
+
+import os
+import sys
+import unittest
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wxdb'))
+
+from stations import StationIndex
+
+
+class FakeCursor():
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, qry, params):
+        self.params = params
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return FakeCursor(self.rows)
+
+
+class FakeDatabase():
+    """Database that returns the rows for any query"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self.rows)
+
+
+class TestStationIndex(unittest.TestCase):
+    """Tests for :class:`StationIndex`"""
+
+    def test_client_case(self):
+        """Clients returned in a different case are matched to the config"""
+
+        rows = [('boi_ars', 'BOII', 'mesowest', 1),
+                ('Boi_Ars', 'BOGI1', 'mesowest', 2),
+                ('TUOL', 'BOGI1', 'mesowest', 2),
+                ('tuol', 'GIN', 'cdec', 3)]
+        index = StationIndex(FakeDatabase(rows), ['BOI_ARS', 'TUOL'])
+
+        self.assertEqual(index.by_client['BOI_ARS'], ['BOII', 'BOGI1'])
+        self.assertEqual(index.by_client['TUOL'], ['BOGI1', 'GIN'])
+        self.assertEqual(index.stations(), ['BOII', 'BOGI1', 'GIN'])
+        self.assertEqual(index.stations(source='cdec'), ['GIN'])
+        self.assertEqual(index.by_station['BOGI1']['clients'], ['BOI_ARS', 'TUOL'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `wxdb.utils`."""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'wxdb'))
+
+import utils
+
+
+class TestHourlyAggregate(unittest.TestCase):
+    """average_df and hourly_aggregate against pandas resample"""
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        index = pd.date_range('2017-01-01', periods=3000, freq='7min', name='date_time')
+        cols = ['air_temp', 'wind_direction', 'wind_gust', 'precip_accum']
+        self.r = pd.DataFrame(rng.rand(len(index), len(cols)) * 350, index=index, columns=cols)
+        self.r[self.r > 300] = np.nan
+        self.r.iloc[100:130] = np.nan
+        self.r['station_id'] = 'TEST'
+
+    def test_reducers(self):
+        """mean, max, last and counts match resample"""
+
+        df, counts = utils.average_df(self.r, 'TEST', counts=True)
+        g = self.r[['air_temp', 'wind_gust', 'precip_accum']].resample('H')
+        index = g.count().index[g.count().sum(axis=1) > 0]
+
+        self.assertTrue(df.index.equals(index))
+        np.testing.assert_allclose(df['air_temp'], g.mean()['air_temp'].reindex(index))
+        np.testing.assert_allclose(df['wind_gust'], g.max()['wind_gust'].reindex(index))
+        np.testing.assert_allclose(df['precip_accum'], g.last()['precip_accum'].reindex(index))
+        np.testing.assert_array_equal(
+            counts[['air_temp', 'wind_gust']].values,
+            g.count()[['air_temp', 'wind_gust']].reindex(index).values)
+        self.assertTrue((df['station_id'] == 'TEST').all())
+
+    def test_timezone(self):
+        """a tz-aware index keeps the timezone"""
+
+        r = self.r.tz_localize('UTC')
+        df = utils.average_df(r, 'TEST')
+        self.assertEqual(str(df.index.tz), 'UTC')
+        self.assertTrue(df.index.tz_localize(None).equals(utils.average_df(self.r, 'TEST').index))
+
+    def test_circular(self):
+        """directions are averaged as unit vectors"""
+
+        hour = 3600 * 10**9
+        t = np.array([0, 10, hour, hour + 5, 2 * hour])
+        values = np.array([[350.0], [10.0], [90.0], [np.nan], [np.nan]])
+        hours, out, n = utils.hourly_aggregate(t, values, ['circular'])
+
+        np.testing.assert_array_equal(hours, [0, 1, 2])
+        np.testing.assert_allclose(out[:2, 0], [0.0, 90.0], atol=1e-9)
+        self.assertTrue(np.isnan(out[2, 0]))
+        np.testing.assert_array_equal(n[:, 0], [2, 1, 0])
+
+    def test_unsorted(self):
+        """last is the last observation in time"""
+
+        hours, out, n = utils.hourly_aggregate(np.array([5, 0]), np.array([[1.0], [2.0]]), ['last'])
+        np.testing.assert_array_equal(out, [[1.0]])
+
+
+class TestVaporPressure(unittest.TestCase):
+    """sati and rh2vp against the IPW formulas"""
+
+    def reference(self, tk):
+        water = np.power(10.0, -7.90298*(utils.BOIL/tk - 1.0) +
+                         5.02808*np.log10(utils.BOIL/tk) -
+                         1.3816e-7*(np.power(10.0, 1.1344e1*(1.0 - tk/utils.BOIL)) - 1.0) +
+                         8.1328e-3*(np.power(10.0, -3.49149*(utils.BOIL/tk - 1.0)) - 1.0) +
+                         np.log10(utils.SEA_LEVEL))
+        ice = 100.0 * np.power(10.0, -9.09718*(utils.FREEZE/tk - 1.0) -
+                               3.56654*np.log10(utils.FREEZE/tk) +
+                               8.76793e-1*(1.0 - tk/utils.FREEZE) +
+                               np.log10(6.1071))
+        return np.where(tk > utils.FREEZE, water, ice)
+
+    def test_sati(self):
+        tk = np.array([[180.0, 250.0, 273.16], [273.2, 300.0, 320.0]])
+        tk0 = tk.copy()
+        np.testing.assert_allclose(utils.sati(tk), self.reference(tk), rtol=1e-12)
+        np.testing.assert_array_equal(tk, tk0)
+
+        vp = utils.sati(tk.astype(np.float32))
+        self.assertEqual(vp.dtype, np.float32)
+        np.testing.assert_allclose(vp, self.reference(tk), rtol=1e-5)
+
+    def test_bad_values(self):
+        """negative and missing temperatures are NaN, the input isn't changed"""
+        tk = np.array([-1.0, np.nan, 260.0, 290.0])
+        vp = utils.sati(tk)
+        self.assertTrue(np.isnan(vp[:2]).all())
+        self.assertTrue(np.isnan(tk[1]) and tk[0] == -1.0)
+
+    def test_rh2vp(self):
+        ta = np.array([-10.0, 0.0, 25.0])
+        rh = np.array([0.5, 0.8, 0.3])
+        np.testing.assert_allclose(utils.rh2vp(ta, rh),
+                                   self.reference(ta + utils.FREEZE) * rh, rtol=1e-12)
+
+
+class TestConfigBool(unittest.TestCase):
+
+    def test_values(self):
+        config = {'bare': '', 'none': None, 'yes': 'Yes', 'true': ' TRUE ',
+                  'one': '1', 'false': 'false', 'off': 'Off', 'zero': '0'}
+        for key in ['bare', 'none', 'yes', 'true', 'one']:
+            self.assertTrue(utils.config_bool(config, key), key)
+        for key in ['false', 'off', 'zero']:
+            self.assertFalse(utils.config_bool(config, key), key)
+
+        self.assertFalse(utils.config_bool(config, 'missing'))
+        self.assertTrue(utils.config_bool(config, 'missing', True))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, utils.config_bool, {'stream': 'maybe'}, 'stream')
+
+
+class TestUtmCoords(unittest.TestCase):
+    """utm_coords against utm.from_latlon"""
+
+    def test_from_latlon(self):
+        """points in several zones, hemispheres and the zone exceptions"""
+
+        lat = np.array([43.6, 37.1, -33.9, 60.1, 78.2, 78.2, 0.5, -79.9, 83.9])
+        lon = np.array([-116.2, -119.5, 151.2, 5.3, 15.6, 2.0, 0.5, -70.0, 179.0])
+        x, y, zone = utils.utm_coords(lat, lon)
+
+        for i in range(len(lat)):
+            e, n, number, letter = utils.utm.from_latlon(lat[i], lon[i])
+            self.assertAlmostEqual(x[i], e, places=3)
+            self.assertAlmostEqual(y[i], n, places=3)
+            self.assertEqual(zone[i], '{}{}'.format(number, letter))
+
+    def test_invalid(self):
+        """missing and out of range values are NaN with no zone"""
+
+        x, y, zone = utils.utm_coords(['43.6', None, '95', 'bad'], [-116.2, -116.2, 0, 0])
+
+        self.assertFalse(np.isnan(x[0]))
+        self.assertTrue(np.isnan(x[1:]).all())
+        self.assertTrue(np.isnan(y[1:]).all())
+        self.assertEqual(list(zone[1:]), [None, None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ from copy import copy
 from datetime import datetime
 import pytz
 import utils
+from database import chunks
 from acid_core.autocleanfft import AutoCleanFFT
 from acid_core.auto_cloudfactor import AutoCloudFactor
 
@@ -107,110 +108,108 @@ class ACID():
             startTime = pd.to_datetime(self.config['start_time'])
             startTime = mnt.localize(startTime)
             startTime = startTime.tz_convert('UTC')
-            start_time_org = copy(startTime)
-            startTime = startTime - pd.Timedelta(days=self.prepend)
+            start_times = {stid: startTime for stid in stations}
             
+        else:
+            # get the start time for all stations at once
+            start_times = self.start_time_from_database(stations, endTime)
         
-        # go through each station
-        for stid in stations:
+        # prepend the data to the start time for the cleaning
+        start_times_org = copy(start_times)
+        start_times = {stid: st - pd.Timedelta(days=self.prepend) for stid, st in start_times.items()}
+        
+        # go through the stations in groups, retrieving the data for the
+        # group in a single query
+        for sta in chunks(stations, self.db.station_chunk_size):
             
-            if self.config['start_time'] is None:        
-                startTime = self.start_time_from_database(stid, endTime)
-                start_time_org = copy(startTime)
-                startTime = startTime - pd.Timedelta(days=self.prepend)
+            data = self.db.retrieve_stations_data(sta, start_times, endTime)
             
-            df = self.db.retrieve_station_data(stid, startTime, endTime)
+            for stid in sta:
+                self.station_run(stid, data.get(stid), start_times_org[stid], endTime)
+                
+    def station_run(self, stid, df, start_time_org, endTime):
+        """
+        Apply ACID to the data for a single station and write to the database
+        
+        Args:
+            stid: station primary_id
+            df: DataFrame of data from the database, None for no data
+            start_time_org: start time without the prepended days
+            endTime: end time
+        """
+        
+        if df is None or df.empty:
+            self._logger.debug('No data to apply ACID to for {}'.format(stid))
+            return
+        
+        try:
+            # each column and apply the cleaning
+            for key in df.columns:
+                if key in self.acid.keys():
+                    df[key] = AutoCleanFFT(df[key], **self.acid[key])
             
-            if not df.empty:
-                try:
-                    df.drop(['id'], axis=1, inplace=True)
-                    
-                    # each column and apply the cleaning
-                    for key in df.columns:
-                        if key in self.acid.keys():
-                            df[key] = AutoCleanFFT(df[key], **self.acid[key])
-                    
-                    # after cleaning solar, calc cloud factor
-                    if 'solar_radiation' in df.columns:
-                        df['cloud_factor'] = AutoCloudFactor(df['solar_radiation'], **self.acid_cf)
-                        
+            # after cleaning solar, calc cloud factor
+            if 'solar_radiation' in df.columns:
+                df['cloud_factor'] = AutoCloudFactor(df['solar_radiation'], **self.acid_cf)
                 
-                    # truncate to the start and end times
-                    df = df.truncate(start_time_org, endTime)
-                    
-                    # perform some extra calculations for vapor pressure
-                    if ('air_temp' in df.columns) & ('relative_humidity' in df.columns):
-                        df['vapor_pressure'] = utils.rh2vp(df['air_temp'], df['relative_humidity']/100.0) 
+        
+            # truncate to the start and end times
+            df = df.truncate(start_time_org, endTime)
             
-                    # convert to date_time from the returned format to MySQL format
-                    df['date_time'] = df.index.strftime('%Y-%m-%d %H:%M')
+            # perform some extra calculations for vapor pressure
+            if ('air_temp' in df.columns) & ('relative_humidity' in df.columns):
+                df['vapor_pressure'] = utils.rh2vp(df['air_temp'], df['relative_humidity']/100.0) 
+
+            if self.db:
+                # write out to the database
+                self.db.insert_data(df, 
+                                    loc='auto',
+                                    description='ACID data for {}'.
+                                    format(stid))
                 
-                    if self.db:
-                        # write out to the database
-                        self.db.insert_data(df, 
-                                            loc='auto',
-                                            description='ACID data for {}'.
-                                            format(stid))
-                        
-                except Exception as e:
-                    self._logger.warn('Problem applying ACID to {}'.format(stid))
-                    self._logger.warn(e)
+        except Exception as e:
+            self._logger.warn('Problem applying ACID to {}'.format(stid))
+            self._logger.warn(e)
         
                 
-    def start_time_from_database(self, stid, endTime):
-        """
-        Get the start time from the database
+    def start_time_from_database(self, stations, endTime):
         """
+        Get the start time from the database for a list of stations. The
+        last value for all stations are retrieved with a single query.
         
-        self.db.db_connect()
-        cursor = self.db.cnx.cursor()
+        Args:
+            stations: list of station primary_id's
+            endTime: end time, used to find the water year for stations
+                without any data
+            
+        Returns:
+            dict of start times keyed by station
+        """
         
-        # determine the last value for the station
-        qry = "SELECT max(date_time) + INTERVAL 1 MINUTE AS d FROM tbl_level_auto WHERE station_id='{}'".format(stid)
-        cursor.execute(qry)
-        startTime = cursor.fetchone()[0]                 
-    
-        if startTime is not None:
-            startTime = pd.to_datetime(startTime, utc=True)
-        else:             
-            # start of the water year, do a local time then convert to UTC       
-            wy = utils.water_day(endTime, self.config['timezone'])
-            startTime = pd.to_datetime(datetime(wy-1, 10, 1), utc=False)
-            mnt = pytz.timezone(self.config['timezone'])
-            startTime = mnt.localize(startTime)
-            startTime = startTime.tz_convert('UTC')
+        # determine the last value for the stations
+        start_times = self.db.get_watermarks(stations, loc='auto')
+        
+        for stid, startTime in start_times.items():
+            if startTime is None:
+                # start of the water year, do a local time then convert to UTC       
+                wy = utils.water_day(endTime, self.config['timezone'])
+                startTime = pd.to_datetime(datetime(wy-1, 10, 1), utc=False)
+                mnt = pytz.timezone(self.config['timezone'])
+                startTime = mnt.localize(startTime)
+                start_times[stid] = startTime.tz_convert('UTC')
             
-        self.db.db_close()
-        return startTime
+        return start_times
               
     def retrieve_stations(self):
         """
         Retrieve the stations given a list of clients
         """
-        self.db.db_connect()
         
         # deteremine the client/s for processing
         client = self.config['client']
         self._logger.info('Client for ACID cleaning: {}'.format(client))
         
-        # query to get the mesowest stations for the given client
-        client_qry = "SELECT primary_id FROM tbl_stations_view WHERE client='{}'"
-        cursor = self.db.cnx.cursor()
-        
-        stations = []
-        for cl in client:
-            self._logger.info('Retrieving stations for client {}'.format(cl))
-            
-            cursor.execute(client_qry.format(cl))
-            stations += cursor.fetchall()
-        
-        # clean up the stations
-        stations = [stid[0] for stid in stations]
-        stations = list(set(stations)) # remove duplicate stations
-        
-        self.db.db_close()
-        
-        return stations
+        return self.db.station_index(client).stations()
         
     def station_acid(self, data):
         """
@@ -0,0 +1,255 @@
+"""
+Plan and record the backfill of long time ranges in chunks
+"""
+
+import logging
+import pandas as pd
+
+from database import chunks
+
+__author__ = "Scott Havens"
+__maintainer__ = "Scott Havens"
+__email__ = "scott.havens@ars.usda.gov"
+__date__ = "2017-07-27"
+
+
+class Backfill():
+    """
+    Split long time ranges, i.e. a new station that needs the whole water
+    year, into chunks that are requested and written independently. The
+    chunks are recorded in `table` when they are planned and marked
+    complete once they are written, so an interrupted backfill picks up
+    the remaining chunks on the next run instead of starting over.
+
+    Chunk boundaries are aligned to multiples of `chunk` so that stations
+    with the same start get the same chunks and can share requests.
+
+    Args:
+        db: :class:`~wxdb.database.Database` instance
+        source: name of the data source, i.e. 'mesowest'
+        chunk: pandas Timedelta of the chunk length
+
+    Example:
+        bf = Backfill(db, 'mesowest', pd.Timedelta(days=7))
+        start, chunks = bf.plan(start, endTime)
+        ...
+        bf.complete(['BOGI1'], chunk)
+    """
+
+    table = 'tbl_backfill'
+
+    def __init__(self, db, source, chunk=pd.Timedelta(days=7)):
+        self._logger = logging.getLogger(__name__)
+
+        self.db = db
+        self.source = source
+        self.chunk = chunk
+
+    def plan(self, start, end):
+        """
+        Plan the chunks for the stations. The start time for a station is
+        moved to the end of the last chunk recorded for it. Ranges longer
+        than `chunk` are split into chunks and recorded, chunks that were
+        recorded but never completed are requested again.
+
+        Args:
+            start: dict of start times keyed by station
+            end: end time
+
+        Returns:
+            tuple of the dict of start times for the stations to retrieve
+            normally and the list of (station, chunk start, chunk end) to
+            backfill, times are UTC
+        """
+
+        end = to_utc(end)
+        recorded = self.read(list(start.keys()))
+
+        incremental = {}
+        pending = []
+        new = []
+        for stid, st in start.items():
+            st = to_utc(st)
+            rec = recorded.get(stid, [])
+
+            # chunks that were not finished in a previous run
+            pending += [(stid, s, e) for s, e, completed in rec if completed is None]
+
+            if rec:
+                st = max(st, max([e for s, e, completed in rec]))
+
+            if end - st > self.chunk:
+                new += [(stid, s, e) for s, e in self.split(st, end)]
+            elif st < end:
+                incremental[stid] = st
+
+        self.record(new)
+
+        self._logger.info('{} backfill: {} new chunks, {} chunks left from previous runs'.format(
+            self.source, len(new), len(pending)))
+
+        return incremental, pending + new
+
+    def split(self, start, end):
+        """
+        Split the range into chunks aligned to multiples of `chunk`
+
+        Args:
+            start: start time
+            end: end time
+
+        Returns:
+            list of tuples of the chunk start and end
+        """
+
+        edges = [start]
+        t = start.floor(self.chunk) + self.chunk
+        while t < end:
+            edges.append(t)
+            t += self.chunk
+        edges.append(end)
+
+        return list(zip(edges[:-1], edges[1:]))
+
+    def group(self, chunks, size):
+        """
+        Group the stations that have the same chunk into batches of at
+        most `size` stations
+
+        Args:
+            chunks: list of (station, chunk start, chunk end)
+            size: maximum number of stations in a batch
+
+        Returns:
+            list of tuples of the chunk start and end and the list of
+            stations, in chunk order
+        """
+
+        stations = {}
+        for stid, s, e in chunks:
+            stations.setdefault((s, e), []).append(stid)
+
+        groups = []
+        for c in sorted(stations.keys()):
+            for i in range(0, len(stations[c]), size):
+                groups.append((c, stations[c][i:i + size]))
+
+        return groups
+
+    def trim(self, df, chunk):
+        """
+        Trim the data for a chunk to the half open range [start, end).
+        Neighbouring chunks share the end time and the sources return the
+        end of the range, so the hour at the end only has the one value at
+        the end time and would overwrite the full hour from the next chunk.
+        
+        Args:
+            df: DataFrame with a DatetimeIndex, naive times are UTC
+            chunk: tuple of the chunk start and end
+            
+        Returns:
+            DataFrame without the rows at or after the end of the chunk
+        """
+        
+        end = to_utc(chunk[1])
+        if df.index.tz is None:
+            end = end.tz_localize(None)
+            
+        return df[df.index < end]
+    
+    def read(self, stations):
+        """
+        Read the recorded chunks for the stations
+
+        Args:
+            stations: list of station id's
+
+        Returns:
+            dict of lists of (chunk start, chunk end, date completed) keyed
+            by station, date completed is None for unfinished chunks
+        """
+
+        recorded = {}
+        if len(stations) == 0:
+            return recorded
+
+        with self.db.connection() as cnx:
+            cur = cnx.cursor()
+            for sta in chunks(stations, 1000):
+                qry = "SELECT station_id, start_time, end_time, date_completed FROM {0} " \
+                    "WHERE source=%s AND station_id IN ({1})".format(
+                        self.table, ','.join(['%s'] * len(sta)))
+                cur.execute(qry, [self.source] + sta)
+
+                for stid, s, e, completed in cur.fetchall():
+                    recorded.setdefault(stid, []).append(
+                        (pd.Timestamp(s, tz='UTC'), pd.Timestamp(e, tz='UTC'), completed))
+            cur.close()
+
+        return recorded
+
+    def record(self, new):
+        """
+        Record the planned chunks as not completed
+
+        Args:
+            new: list of (station, chunk start, chunk end)
+        """
+
+        if len(new) == 0:
+            return
+
+        rows = [(stid, self.source, to_naive(s), to_naive(e)) for stid, s, e in new]
+        insert_sql = "INSERT INTO {} (station_id, source, start_time, end_time) " \
+            "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE " \
+            "end_time=VALUES(end_time), date_completed=NULL".format(self.table)
+
+        with self.db.connection() as cnx:
+            cur = cnx.cursor()
+            cur.executemany(insert_sql, rows)
+            cnx.commit()
+            cur.close()
+
+    def complete(self, stations, chunk):
+        """
+        Mark the chunk as completed for the stations, called once the data
+        for the chunk has been written
+
+        Args:
+            stations: list of station id's
+            chunk: tuple of the chunk start and end
+        """
+
+        if len(stations) == 0:
+            return
+
+        qry = "UPDATE {0} SET date_completed=UTC_TIMESTAMP() " \
+            "WHERE source=%s AND start_time=%s AND station_id IN ({1})".format(
+                self.table, ','.join(['%s'] * len(stations)))
+
+        with self.db.connection() as cnx:
+            cur = cnx.cursor()
+            cur.execute(qry, [self.source, to_naive(chunk[0])] + list(stations))
+            cnx.commit()
+            cur.close()
+
+        self._logger.debug('Completed {} backfill {} to {} for {}'.format(
+            self.source, chunk[0], chunk[1], ','.join(stations)))
+
+
+def to_utc(t):
+    """
+    Convert a timestamp to UTC, naive timestamps are assumed to be UTC
+    """
+
+    t = pd.Timestamp(t)
+    if t.tzinfo is None:
+        return t.tz_localize('UTC')
+    return t.tz_convert('UTC')
+
+def to_naive(t):
+    """
+    Convert a timestamp to a naive UTC datetime for the database
+    """
+
+    return to_utc(t).tz_localize(None).to_pydatetime()
@@ -7,20 +7,30 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 import pytz
-import grequests
-import requests
 import json
 import re
 import utils
+from pipeline import Pipeline
+from fetch import Fetcher, Request
+from database import chunks
+from backfill import Backfill
 
 import sys
 if sys.version_info[0] < 3: 
     from StringIO import StringIO
-    from urlparse import urlparse, parse_qs
 else:
     # Python 3
-    from urllib.parse import urlparse, parse_qs
     from io import StringIO
+from io import BytesIO
+
+# the pyarrow CSV engine was added in pandas 1.4
+CSV_ENGINE = 'c'
+try:
+    import pyarrow  # noqa: F401, only checking that it is installed
+    if tuple(int(v) for v in pd.__version__.split('.')[:2]) >= (1, 4):
+        CSV_ENGINE = 'pyarrow'
+except ImportError:
+    pass
     
     
 __author__ = "Scott Havens"
@@ -55,12 +65,33 @@ class CDEC():
         
     metadata_table = 'tbl_metadata'
     
+    sensor_table = 'tbl_cdec_sensors'
+    sensor_ttl = pd.Timedelta(days=7)    # age before the sensors are refreshed
+    no_sensors = ''     # sens_long_name and dur_code of the row for a station without sensors
+    
     station_info_url = 'http://cdec.water.ca.gov/cdecstation2/CDecServlet/getStationInfo'
     
+    all_stations_url = 'http://cdec.water.ca.gov/cdecstation2/CDecServlet/getAllStations'
+    
     data_csv_url = 'http://cdec.water.ca.gov/dynamicapp/req/CSVDataServlet'
     
+    date_format = '%Y%m%d %H%M' # format of the DATE TIME column
+    
     timezone = 'Etc/GMT+8' # timezone that the data is retrieved in
     
+    queue_size = 4 # stations waiting between each stage of the pipeline
+    
+    # Because the CDEC site sucks, we have to really thottle the number of 
+    # concurrent requests... Start with one and let the adaptive limiter
+    # ramp up while the site is responding well
+    concurrency = 1
+    max_concurrency = 6
+    max_retry_after = 60    # longest Retry-After in seconds that is honoured
+    
+    batch_size = 10     # stations per request
+    batch_window = pd.Timedelta(days=1)    # start time spread within a request
+    backfill_chunk = pd.Timedelta(days=30)  # longer ranges are backfilled in chunks
+    
     # sensor mapping 'LONG NAME' : {sensor number, database column}
     sensor_metadata = {
         'PRECIPITATION, ACCUMULATED': {
@@ -110,6 +141,22 @@ class CDEC():
         
         self.units = {val['col']: val['units'] for key,val in self.sensor_metadata.items()}
         
+        if (self.config is not None) and ('cdec_batch_size' in self.config):
+            self.batch_size = int(self.config['cdec_batch_size'])
+        if (self.config is not None) and ('cdec_sensor_ttl' in self.config):
+            self.sensor_ttl = pd.Timedelta(days=float(self.config['cdec_sensor_ttl']))
+        if (self.config is not None) and ('cdec_backfill_days' in self.config):
+            self.backfill_chunk = pd.Timedelta(days=float(self.config['cdec_backfill_days']))
+        if (self.config is not None) and ('cdec_max_retry_after' in self.config):
+            self.max_retry_after = float(self.config['cdec_max_retry_after'])
+            
+        self.backfill = Backfill(db, 'cdec', self.backfill_chunk)
+        
+        self.fetcher = Fetcher(concurrency=self.concurrency,
+                               adaptive=True,
+                               max_concurrency=self.max_concurrency,
+                               max_retry_after=self.max_retry_after)
+        
         self._logger.debug('Initialized CDEC')
         
     def single_station_info(self, stid):
@@ -121,10 +168,12 @@ class CDEC():
         
         Returns:
             Dataframe for station that will have all the sensors names, and 
-            timescale 
+            timescale, None if the request failed
         """
-        r = requests.get('http://cdec.water.ca.gov/cdecstation2/CDecServlet/getStationInfo',
-                         params={'stationID': stid})
+        r = self.fetcher.get(self.station_info_url, params={'stationID': stid})
+        if r is None:
+            return None
+        
         data = json.loads(r.text)
         
         return pd.DataFrame(data['STATION'])
@@ -133,7 +182,8 @@ class CDEC():
     def multi_station_info(self, stids, fields=False):
         """
         Query the station info for a list of stations. Because of the many
-        small requests, use async grequests to request all at once.
+        small requests, use the :class:`~wxdb.fetch.Fetcher` to request
+        them concurrently.
         
         Args:
             stids: list of station ID's to fetch
@@ -146,15 +196,11 @@ class CDEC():
         # build the requests
         r = []
         for s in stids:
-            r.append(grequests.get(self.station_info_url, params={'stationID': s}))
+            r.append(Request(self.station_info_url, params={'stationID': s}, key=s))
             
-        # Because the CDEC site sucks, we have to really thottle the number of 
-        # concurrent requests...
-        res = grequests.map(r, size=1)
-        
         # go through the responses and parse
         df = []
-        for rs in res:
+        for req, rs in self.fetcher.imap(r):
             if rs:
                 if rs.status_code == 200:
                     try:
@@ -166,19 +212,24 @@ class CDEC():
                             df.append(d.iloc[0])
                         self._logger.debug('Got metadata for {}'.format(d['STATION_ID'][0]))
                     except Exception:
-                        pass
-#                         self._logger.debug('Metadata problem for {} - {}'.format(d['STATION_ID'][0], e))
+                        self._logger.debug('Metadata problem for {}'.format(req.key))
                         
+        self.fetcher.log_stats()
         
         return pd.concat(df, axis=1).T.reset_index()
         
-    def metadata(self):
+    def metadata(self, incremental=False):
         """
         Retrieve the metadata from Mesowest. Two calls are made to the Mesowest API.
         The first call is to get the networks in order to determine the `network` and
         `primary_provider`. The second call retrieves the metadata given the `config`
         parameters. The two dataframes are combined and inserted into the database
         given the :class:`~wxcb.database.Database` instance.
+        
+        Args:
+            incremental: only request the station info for stations that
+                are not in the metadata table and only write the stations
+                that are new or changed
         """
         
         self._logger.info('Obtaining metadata form CDEC')
@@ -187,10 +238,28 @@ class CDEC():
 #         r = urllib.request.urlopen('http://cdec.water.ca.gov/cdecstation2/CDecServlet/getAllStations')
 #         data = json.loads(r.read().decode(r.info().get_param('charset') or 'utf-8'))
         
-        r = requests.get('http://cdec.water.ca.gov/cdecstation2/CDecServlet/getAllStations')
+        r = self.fetcher.get(self.all_stations_url)
+        if r is None:
+            self._logger.error('Could not retrieve the CDEC station list')
+            return
+        
         data = json.loads(r.text)
         df = pd.DataFrame(data['STATION'])
         
+        # the station list only has the names so only the new stations can
+        # be requested, the rest are counted as unchanged
+        skipped = 0
+        if incremental:
+            current = self.db.read_metadata('cdec')
+            new = ~df['STATION_ID'].str.upper().isin(current.index.str.upper())
+            skipped = len(df) - new.sum()
+            df = df[new]
+            
+            if len(df) == 0:
+                self._logger.info('CDEC metadata: 0 new, 0 changed, {} unchanged stations'.format(
+                    skipped))
+                return
+        
         # request the data for all stations
         info = self.multi_station_info(df['STATION_ID'])
         
@@ -208,7 +277,7 @@ class CDEC():
         DF['reported_long'] = DF['longitude']
         
         # calculate the UTM coordinates
-        DF['utm_x'], DF['utm_y'], DF['utm_zone'] = zip(*DF.apply(utils.df_utm, axis=1))
+        DF['utm_x'], DF['utm_y'], DF['utm_zone'] = utils.utm_coords(DF['latitude'], DF['longitude'])
          
         # add the source to the DF
         DF['source'] = 'cdec'
@@ -221,26 +290,33 @@ class CDEC():
         # up for any potential UTF-8 characters that made it through
         DF['station_name'] = DF['station_name'].apply(escape_column)
         
+        if incremental:
+            status = self.db.metadata_status(DF, current)
+            self._logger.info('CDEC metadata: {} new, {} changed, {} unchanged stations'.format(
+                (status == 'new').sum(), (status == 'changed').sum(),
+                (status == 'unchanged').sum() + skipped))
+            
+            DF = DF[(status != 'unchanged').values]
+            if len(DF) == 0:
+                return
+        
         # insert the dataframe into the database
         self.db.insert_data(DF, 'metadata', description='CDEC metadata')
         
     def data(self, duration='H'):
         """
         Retrieve the hourly data from CDEC. Build a list of the URL's that 
-        need to be fetched and use grequests to fetch the data. Then the
-        data retrieval will be significantly sped up.
+        need to be fetched and use the :class:`~wxdb.fetch.Fetcher` to fetch
+        the data. Each request is for a group of stations and all their
+        sensors. The stations in each response are passed through a
+        :class:`~wxdb.pipeline.Pipeline` so that parsing and database writes
+        overlap with the remaining downloads.
         """
         
-        self.db.db_connect()
-        
         # deteremine the client/s for processing
         client = self.config['client']
         self._logger.info('Client for CDEC data collection: {}'.format(client))
          
-        # query to get the mesowest stations for the given client
-        client_qry = "SELECT primary_id FROM tbl_stations_view WHERE source='cdec' AND client='{}'"
-        cursor = self.db.cnx.cursor()
-         
         # get the current local time
         endTime = utils.get_end_time(self.config['timezone'], self.config['end_time'], self.timezone)
         
@@ -254,204 +330,498 @@ class CDEC():
             startTime = mnt.localize(startTime)
             startTime = startTime.tz_convert(self.timezone)
         
-        # go through each client and get the stations
+        # the cdec stations for all the clients
+        stations = self.db.station_index(client).stations(source='cdec')
+        
+        # determine the last value for every station in one query
+        if self.config['start_time'] is None:
+            watermarks = self.db.get_watermarks(stations, loc='level0')
+            
+        # sensors for every station, only requested from CDEC when stale
+        inventory = self.sensor_inventory(stations)
+            
+        # go through each station and get the start time and sensors
+        start = {}
+        sensors = {}
+        for stid in stations:
+                    
+            if self.config['start_time'] is None:        
+                startTime = watermarks[stid]
+            
+                if startTime is None:
+                    # start of the water year, do a PST time       
+                    wy = utils.water_day(endTime, self.timezone)
+                    startTime = pd.to_datetime(datetime(wy-1, 10, 1), utc=False)
+                    startTime = pst.localize(startTime)
+             
+            # determine what sensors to retreive and filter to duration
+            sens = inventory.get(stid)
+            if sens is None:
+                self._logger.warn('Could not get the sensors for {}'.format(stid))
+                continue
+            sens = sens[sens.dur_code == duration]
+            
+            nums = [v['num'] for s, v in self.sensor_metadata.items()
+                    if sens.sens_long_name.str.contains(s, regex=False).any()]
+            if not nums:
+                self._logger.warn('No sensors to retrieve for {}'.format(stid))
+                continue
+            
+            start[stid] = startTime
+            sensors[stid] = nums
+            
+        # long ranges are backfilled in chunks
+        backfill_chunks = []
+        if self.config['start_time'] is None:
+            start, backfill_chunks = self.backfill.plan(start, endTime)
+            
+        # build the url's, one request for each group of stations with a
+        # similar start time for all the sensors in the group
         req = []
-        stations = []
-        for cl in client:
-            self._logger.info('Building URLs for client {}'.format(cl))
+        for group in utils.group_stations(start, self.batch_size, self.batch_window):
+            startTime = min([start[stid] for stid in group])
+            req.append(self.data_request(group, sensors, startTime, endTime, duration, None))
             
-            cursor.execute(client_qry.format(cl))
-            sta = cursor.fetchall()
-            sta = [s[0] for s in sta]
-            stations = stations + sta
+        # one request for each group of stations with the same chunk
+        for chunk, group in self.backfill.group(backfill_chunks, self.batch_size):
+            req.append(self.data_request(group, sensors, chunk[0], chunk[1], duration, chunk))
             
-            # go through each and get the data
-            for stid in sta:
-                        
-                if self.config['start_time'] is None:        
-                    # determine the last value for the station
-                    qry = "SELECT max(date_time) + INTERVAL 1 MINUTE AS d FROM tbl_level0 WHERE station_id='%s'" % stid
-                    cursor.execute(qry)
-                    startTime = cursor.fetchone()[0]                 
-                
-                    if startTime is not None:
-                        startTime = pd.to_datetime(startTime, utc=True)
-                    else:             
-                        # start of the water year, do a PST time       
-                        wy = utils.water_day(endTime, self.timezone)
-                        startTime = pd.to_datetime(datetime(wy-1, 10, 1), utc=False)
-                        startTime = pst.localize(startTime)
-                 
-                # determine what sensors to retreive and filter to duration
-                sens = self.single_station_info(stid)
-                sens = sens[sens.DUR_CODE == duration]
-                 
-                self._logger.debug('Building url for station {} between {} and {}'.format(
-                    stid, startTime.strftime('%Y-%m-%d'), endTime.strftime('%Y-%m-%d'))) 
-                
-                # build the url's for each sensor
-                for s in self.sensor_metadata.keys():
-                    if sens.SENS_LONG_NAME.str.contains(s).any():
-                        p = {}
-                        p['Stations'] = stid
-                        p['SensorNums'] = self.sensor_metadata[s]['num'] 
-                        p['dur_code'] = duration
-                        p['Start'] = startTime.strftime('%Y-%m-%d')
-                        p['End'] = endTime.strftime('%Y-%m-%d')
-                        
-                        req.append(grequests.get(self.data_csv_url, params=p))
-                        
-        # close the db connection since the data retrieval might take a while 
-        self.db.db_close()
+        # send the requests to CDEC and pass the stations in each response
+        # through the pipeline
+        self._logger.info('Sending {} requests to CDEC for {} stations and {} backfill chunks'.format(
+            len(req), len(start), len(backfill_chunks)))
+        
+        p = Pipeline('CDEC', maxsize=self.queue_size)
+        p.add_stage('parse', self.parse_response, expand=True)
+        p.add_stage('write', self.write_data)
+        if self.qc:
+            p.add_stage('qc', self.qc_data)
+        
+        p.run(self.fetcher.imap(req))
+        self.fetcher.log_stats()
+        
+    def sensor_inventory(self, stations):
+        """
+        Get the sensors for the stations from the `sensor_table`. Stations
+        that are not in the table or were updated more than `sensor_ttl`
+        ago are refreshed from CDEC with concurrent requests. If a refresh
+        fails, the sensors in the table are used.
+        
+        Args:
+            stations: list of station id's
             
-        # send the requests to CDEC
-        self._logger.info('Sending {} requests to CDEC'.format(len(req)))
-        res = grequests.map(req, size=1)
+        Returns:
+            dict of DataFrames with the sens_long_name and dur_code for
+            each station, empty for stations that don't have any sensors,
+            stations that could not be retrieved are left out
+        """
         
-        # parse the responses
-        data, av = self.cdec2df(res, stations) 
-
-        # insert into the database
-        for stid in list(data.keys()):
-            if data[stid] is not None:
-                self.db.insert_data(data[stid], 'level0', description='CDEC data for {}'.format(stid))
-                
-        for stid in list(av.keys()):
-            if av[stid] is not None:
-                self.db.insert_data(av[stid], 'level1', description='CDEC data for {} averaged'.format(stid))
-                # quality control
-                if self.qc:
-                    av[stid] = self.qc.run(av[stid])
-                
-
+        inventory, updated = self.read_sensor_inventory(stations)
         
-    def cdec2df(self, res, stations):
+        cutoff = datetime.utcnow() - self.sensor_ttl
+        stale = [stid for stid in stations
+                 if (updated.get(stid) is None) or (updated[stid] < cutoff)]
+        
+        self._logger.info('Refreshing the sensors for {} of {} stations'.format(
+            len(stale), len(stations)))
+        
+        if stale:
+            fresh = self.fetch_sensor_inventory(stale)
+            self.write_sensor_inventory(fresh)
+            inventory.update(fresh)
+            
+        return inventory
+    
+    def read_sensor_inventory(self, stations):
         """
-        Parse a list of responses from CDEC into dataframes
+        Read the sensors for the stations from the `sensor_table`
         
         Args:
-            res: list of grequest responses
+            stations: list of station id's
             
         Returns:
-            dict of dataframes, one for each site
+            tuple of dicts keyed by station, the DataFrames of the sensors
+            and the oldest time the station's sensors were updated. Stations
+            stored without sensors have an empty DataFrame.
         """
         
-        data = {}
-#         for stid in stations:
-#             data[stid] = []
+        inventory = {}
+        updated = {}
+        if len(stations) == 0:
+            return inventory, updated
+        
+        rows = []
+        with self.db.connection() as cnx:
+            cur = cnx.cursor()
+            for sta in chunks(list(set(stations)), 1000):
+                qry = "SELECT primary_id, sens_long_name, dur_code, date_updated FROM {0} " \
+                    "WHERE primary_id IN ({1})".format(self.sensor_table, ','.join(['%s'] * len(sta)))
+                cur.execute(qry, sta)
+                rows += cur.fetchall()
+            cur.close()
+            
+        df = pd.DataFrame(rows, columns=['primary_id', 'sens_long_name', 'dur_code', 'date_updated'])
+        for stid, d in df.groupby('primary_id'):
+            updated[stid] = d['date_updated'].min()
+            d = d[(d.sens_long_name != self.no_sensors) | (d.dur_code != self.no_sensors)]
+            inventory[stid] = d[['sens_long_name', 'dur_code']].reset_index(drop=True)
+            
+        return inventory, updated
+    
+    def fetch_sensor_inventory(self, stations):
+        """
+        Request the station info from CDEC for the stations to get the
+        sensors, the requests are sent concurrently
         
-        count = 0
+        Args:
+            stations: list of station id's
+            
+        Returns:
+            dict of DataFrames with the sens_long_name and dur_code, keyed
+            by station id, empty if CDEC doesn't list any sensors
+        """
+        
+        r = [Request(self.station_info_url, params={'stationID': s}, key=s) for s in stations]
+        
+        inventory = {}
+        for req, rs in self.fetcher.imap(r):
+            if rs and rs.status_code == 200:
+                try:
+                    d = pd.DataFrame(json.loads(rs.text)['STATION'])
+                    if len(d) == 0:
+                        d = pd.DataFrame(columns=['SENS_LONG_NAME', 'DUR_CODE'])
+                    d = d[['SENS_LONG_NAME', 'DUR_CODE']].drop_duplicates()
+                    d.columns = ['sens_long_name', 'dur_code']
+                    inventory[req.key] = d.reset_index(drop=True)
+                except Exception:
+                    self._logger.warn('Sensor problem for {}'.format(req.key))
+                    
+        self._logger.debug('Got the sensors for {} of {} stations'.format(
+            len(inventory), len(stations)))
+        
+        return inventory
+    
+    def write_sensor_inventory(self, inventory):
+        """
+        Replace the sensors in the `sensor_table` for the stations in
+        inventory in a single transaction. A station without any sensors
+        gets one row with `no_sensors` so that it is cached like the others.
+        
+        Args:
+            inventory: dict of DataFrames from :meth:`fetch_sensor_inventory`
+        """
+        
+        if len(inventory) == 0:
+            return
+        
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        rows = []
+        for stid, d in inventory.items():
+            if len(d) == 0:
+                rows.append((stid, self.no_sensors, self.no_sensors, now))
+            rows += [(stid, r.sens_long_name, r.dur_code, now) for r in d.itertuples()]
+        
+        insert_sql = "INSERT INTO {} (primary_id, sens_long_name, dur_code, date_updated) " \
+            "VALUES (%s, %s, %s, %s)".format(self.sensor_table)
+        
+        with self.db.connection() as cnx:
+            cur = cnx.cursor()
+            for sta in chunks(list(inventory.keys()), 1000):
+                cur.execute("DELETE FROM {0} WHERE primary_id IN ({1})".format(
+                    self.sensor_table, ','.join(['%s'] * len(sta))), sta)
+            cur.executemany(insert_sql, rows)
+            cnx.commit()
+            cur.close()
+            
+        self._logger.info('Updated {} sensors for {} stations in {}'.format(
+            len(rows), len(inventory), self.sensor_table))
+        
+    def data_request(self, group, sensors, startTime, endTime, duration, chunk):
+        """
+        Build the request for a group of stations and all their sensors
+        
+        Args:
+            group: list of station id's
+            sensors: dict of the sensor numbers keyed by station
+            startTime: start time
+            endTime: end time
+            duration: CDEC duration code
+            chunk: backfill chunk or None
+            
+        Returns:
+            :class:`~wxdb.fetch.Request` with the group and chunk as the key
+        """
+        
+        # CDEC takes the dates in PST
+        startTime = startTime.tz_convert(self.timezone)
+        endTime = endTime.tz_convert(self.timezone)
+        nums = sorted(set([n for stid in group for n in sensors[stid]]))
+            
+        self._logger.debug('Building url for station {} between {} and {}'.format(
+            ','.join(group), startTime.strftime('%Y-%m-%d'), endTime.strftime('%Y-%m-%d'))) 
+        
+        p = {}
+        p['Stations'] = ','.join(group)
+        p['SensorNums'] = ','.join([str(n) for n in nums])
+        p['dur_code'] = duration
+        p['Start'] = startTime.strftime('%Y-%m-%d')
+        p['End'] = endTime.strftime('%Y-%m-%d')
+        
+        return Request(self.data_csv_url, params=p, key=(group, chunk))
+    
+    def parse_response(self, item):
+        """
+        Parse a response for a group of stations into the data and averaged
+        data for each station
+        
+        Args:
+            item: tuple of the request and response, the request key is the
+                list of station id's and the backfill chunk or None
+            
+        Returns:
+            list of tuples of station id, DataFrame, averaged DataFrame and
+            the backfill chunk, stations without data are left out
+        """
+        
+        req, rs = item
+        group, chunk = req.key
+        data, av, failed = self.cdec2df([rs], group)
+        
+        out = []
+        for stid in group:
+            df = data.get(stid)
+            a = av.get(stid)
+            if (df is None) or (a is None):
+                continue
+            if chunk is not None:
+                df = self.backfill.trim(df, chunk)
+                a = self.backfill.trim(a, chunk)
+            out.append((stid, df, a, chunk))
+        
+        # stations in a backfill chunk without any data to write are done,
+        # stations that failed to parse are requested again on the next run
+        if (chunk is not None) and rs and (rs.status_code == 200):
+            written = [o[0] for o in out]
+            self.backfill.complete([stid for stid in group
+                                    if (stid not in written) and (stid not in failed)], chunk)
+            
+        return out
+    
+    def write_data(self, item):
+        """
+        Insert the data and averaged data into the database, a backfill
+        chunk is marked complete once both have been written
+        """
+        
+        stid, df, av, chunk = item
+        ok = self.db.insert_data(df, 'level0', description='CDEC data for {}'.format(stid))
+        ok &= self.db.insert_data(av, 'level1', description='CDEC data for {} averaged'.format(stid))
+        
+        if ok and (chunk is not None):
+            self.backfill.complete([stid], chunk)
+            
+        return item
+    
+    def qc_data(self, item):
+        """
+        Quality control the averaged data after it has been written
+        """
+        
+        stid, df, av, chunk = item
+        self.qc.run(av)
+        
+    def cdec2df(self, res, stations):
+        """
+        Parse a list of responses from CDEC into dataframes. The responses
+        are the long CSV format with a row for every station, sensor and
+        time, which are pivoted into a wide dataframe for each station.
+        
+        Args:
+            res: list of responses
+            stations: list of station id's that were requested
+            
+        Returns:
+            tuple of dicts of the dataframes and averaged dataframes, one
+            for each station, None for stations without data, and the list
+            of stations that could not be parsed. If a response can't be
+            read all the stations are in the list.
+        """
+        
+        frames = []
+        failed = []
         for rs in res:
             if rs:
                 if rs.status_code == 200:
                     try:
-                        
-                        # determine the station and sensor from the url
-                        stid, sens_name = self.parse_url(rs.url)
-                        
-                        if stid not in data.keys():
-                            data[stid] = []
-                        
-                        # read in the response
-                        # df = pd.read_csv(StringIO(rs.text), skiprows=2, header=None, parse_dates=[[0,1]], index_col=None, na_values='m')
-                        df = pd.read_csv(StringIO(rs.text), header=0, parse_dates=['DATE TIME'])
-
-                        # create a new data frame with just date and value
-                        df2 = df[['DATE TIME', 'VALUE']]
-                        df2.columns = ['date_time', sens_name]
-                        df2.set_index('date_time', inplace=True)
-
-                        if df2.empty:
-                            self._logger.warn('No data returned for {} - {}'.format(stid, sens_name))
-                            continue
-
-                        # no data is represented as '---', find and replace
-                        df2 = df2.replace(r'\---', np.nan, regex=True)
-                        df2[sens_name] = pd.to_numeric(df2[sens_name])
-                                                
-                        if sens_name is not None:
-                            data[stid].append(df2)
-
-                        self._logger.debug('Got data for {} - {}'.format(stid, sens_name))
-                        count += 1
+                        frames.append(self.read_csv(rs.text))
                     except Exception:
-                        self._logger.warn('Error parsing data for {} - {} ({})'.format(stid, sens_name, rs.url))
-                        pass
+                        self._logger.warn('Error parsing data from {}'.format(rs.url))
+                        failed = list(stations)
                     
-        self._logger.info('Retrieved {} good responses form CDEC'.format(count))
+        self._logger.debug('Retrieved {} good responses form CDEC'.format(len(frames)))
+        
+        wide = {}
+        if frames:
+            wide = self.long2wide(pd.concat(frames, ignore_index=True))
                     
-        # merge the data frames together and get ready for the database
+        # get the data ready for the database
+        data = {}
         av = {}
-        for stid in data.keys():
-            if len(data[stid]) > 0:
-                self._logger.debug('Parsing data from {}'.format(stid))
-                
-                try:
-                    data[stid] = pd.concat(data[stid], axis=1)
-                    data[stid].dropna(axis=0, how='all', inplace=True)
-                    
-                    if len(data[stid]) > 0:
-                        
-                        # convert timezone
-                        data[stid] = data[stid].tz_localize(self.timezone).tz_convert('UTC')
-                        
-                        # convert the units
-                        data[stid] = utils.convert_units(data[stid], self.units)
-                        
-                        # truncate and add fields
-                        data[stid] = data[stid].truncate(data[stid].first_valid_index().ceil('H'),
-                                                         data[stid].last_valid_index().floor('H'))
-                        data[stid]['station_id'] = stid
-                        data[stid]['date_time'] = data[stid].index.strftime('%Y-%m-%d %H:%M')
-                        
-                        # perform some extra calculations for vapor pressure
-                        if ('air_temp' in data[stid].columns) & ('relative_humidity' in data[stid].columns):
-                            data[stid]['vapor_pressure'] = utils.rh2vp(data[stid]['air_temp'],
-                                                                       data[stid]['relative_humidity']/100.0) 
-                        
-                        # average the dataframe
-                        av[stid] = utils.average_df(data[stid], stid)
-                        
-#                         else:
-#                             data[stid] = None
-#                             av[stid] = None
+        for stid in stations:
+            data[stid] = None
+            av[stid] = None
+            
+            if stid.upper() not in wide:
+                self._logger.warn('No data returned for {}'.format(stid))
+                continue
                 
-                except Exception:
-                    self._logger.warn('Could not merge and convert units for {}'.format(stid))
+            self._logger.debug('Parsing data from {}'.format(stid))
+            try:
+                data[stid], av[stid] = self.station_df(wide[stid.upper()], stid)
+            except Exception:
+                self._logger.warn('Could not merge and convert units for {}'.format(stid))
+                if stid not in failed:
+                    failed.append(stid)
+            
+        return data, av, failed
+    
+    def read_csv(self, text):
+        """
+        Read the long CSV format returned by the CSVDataServlet. Only the
+        needed columns are read with explicit types, '---' and empty values
+        are read as NaN and the time is parsed with the fixed CDEC format into integer
+        minutes since the epoch. The pyarrow engine is used if it's
+        installed and the pandas version supports it.
         
-            else:
-                data[stid] = None
-                av[stid] = None
+        Args:
+            text: response text
             
-        return data, av
+        Returns:
+            DataFrame with the STATION_ID, SENSOR_NUMBER, VALUE and time
+            as integer minutes
+        """
         
+        kwargs = {
+            'header': 0,
+            'usecols': ['STATION_ID', 'SENSOR_NUMBER', 'DATE TIME', 'VALUE'],
+            'dtype': {'STATION_ID': str, 'SENSOR_NUMBER': np.int64,
+                      'DATE TIME': str, 'VALUE': np.float64},
+            'keep_default_na': False
+            }
+        
+        if CSV_ENGINE == 'pyarrow':
+            # the pyarrow engine only takes a list of na_values for all the
+            # columns, it doesn't apply them to the string columns so an
+            # empty STATION_ID stays an empty string like the C engine below
+            df = pd.read_csv(BytesIO(text.encode('utf-8')), engine='pyarrow',
+                             na_values=['---', ''], **kwargs)
+        else:
+            df = pd.read_csv(StringIO(text), engine='c',
+                             na_values={'VALUE': ['---', '']}, **kwargs)
+        
+        # the same times repeat for every station and sensor, parse the
+        # unique values
+        codes, uniques = pd.factorize(df['DATE TIME'])
+        t = pd.to_datetime(uniques, format=self.date_format)
+        df['time'] = t.values.astype('datetime64[m]').astype(np.int64)[codes]
+        
+        return df[['STATION_ID', 'SENSOR_NUMBER', 'time', 'VALUE']]
     
-    def parse_url(self, url):
+    def long2wide(self, df):
         """
-        Parse the url that was passed to CDEC. Pull out the station
-        id and the sensor name
+        Pivot the long CSV format into a wide dataframe for each station
+        with a column for each sensor. The rows are sorted on the station
+        and integer time, then the values are placed into a single 2D
+        array with one row per station and time. Sensors that map to the
+        same column are combined, taking the first value.
         
         Args:
-            url: url string with parameters
+            df: DataFrame from :meth:`read_csv`
             
         Returns:
-            station id and sensor name from sensor_metadata, None if not found
+            dict of dataframes indexed by time, keyed by station id
         """
         
-        o = urlparse(url)
-        query = parse_qs(o.query)
-        stid = query['Stations'][0]
-        sens_num = int(query['SensorNums'][0])
+        columns = sorted(set([v['col'] for v in self.sensor_metadata.values()]))
+        lookup = {v['num']: columns.index(v['col']) for v in self.sensor_metadata.values()}
+        
+        col = df['SENSOR_NUMBER'].map(lookup).values
+        keep = ~np.isnan(col) & ~np.isnan(df['VALUE'].values)
+        if not keep.any():
+            return {}
+        
+        sta_codes, sta_names = pd.factorize(df['STATION_ID'].values[keep])
+        t = df['time'].values[keep]
+        col = col[keep].astype(np.int64)
+        value = df['VALUE'].values[keep]
+        
+        # sort by station, time and column keeping the order of duplicates
+        # so the first value is kept
+        order = np.lexsort((col, t, sta_codes))
+        sta_codes = sta_codes[order]
+        t = t[order]
+        col = col[order]
+        value = value[order]
+        
+        new_row = np.ones(len(t), dtype=bool)
+        new_row[1:] = (sta_codes[1:] != sta_codes[:-1]) | (t[1:] != t[:-1])
+        first = new_row.copy()
+        first[1:] |= col[1:] != col[:-1]
+        row = np.cumsum(new_row) - 1
+        
+        block = np.full((row[-1] + 1, len(columns)), np.nan)
+        block[row[first], col[first]] = value[first]
+        
+        # split the block by station
+        row_sta = sta_codes[new_row]
+        row_t = t[new_row]
+        bounds = np.flatnonzero(np.diff(row_sta)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(row_sta)]))
         
-        sens_name = None
-        for v in self.sensor_metadata.values():
-            if sens_num == v['num']:
-                sens_name = v['col']
-                break
+        data = {}
+        for s, e in zip(starts, ends):
+            idx = pd.DatetimeIndex(row_t[s:e].astype('datetime64[m]').astype('datetime64[ns]'),
+                                   name='date_time')
+            d = pd.DataFrame(block[s:e], index=idx, columns=columns)
+            data[sta_names[row_sta[s]].upper()] = d.dropna(axis=1, how='all')
             
-        return stid, sens_name
-        
-
-  
+        return data
     
-
+    def station_df(self, df, stid):
+        """
+        Convert the wide dataframe for a station to UTC and metric units
+        and average
+        
+        Args:
+            df: DataFrame from :meth:`long2wide`
+            stid: station id
+            
+        Returns:
+            tuple of the DataFrame and averaged DataFrame, None if there
+            is no data
+        """
+        
+        df = df.dropna(axis=0, how='all')
+                    
+        if len(df) == 0:
+            return None, None
+                        
+        # convert timezone
+        df = df.tz_localize(self.timezone).tz_convert('UTC')
+        
+        # convert the units
+        df = utils.convert_units(df, self.units)
+        
+        # truncate and add fields
+        df = df.truncate(df.first_valid_index().ceil('H'),
+                         df.last_valid_index().floor('H'))
+        df['station_id'] = stid
+        
+        # perform some extra calculations for vapor pressure
+        if ('air_temp' in df.columns) & ('relative_humidity' in df.columns):
+            df['vapor_pressure'] = utils.rh2vp(df['air_temp'],
+                                               df['relative_humidity']/100.0) 
+        
+        # average the dataframe
+        return df, utils.average_df(df, stid)
@@ -3,11 +3,26 @@ Database instance
 """
 
 import mysql.connector
-from mysql.connector import errorcode
+from mysql.connector import errorcode, FieldType
 import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
 
+from stations import StationIndex
+
+try:
+    from queue import LifoQueue, Empty, Full
+except ImportError:
+    from Queue import LifoQueue, Empty, Full
+
+# LOCAL INFILE can be restricted to a directory from Connector/Python 8.0.24
+LOCAL_INFILE_IN_PATH = tuple(mysql.connector.version.VERSION[:3]) >= (8, 0, 24)
+
 __author__ = "Scott Havens"
 __maintainer__ = "Scott Havens"
 __email__ = "scott.havens@ars.usda.gov"
@@ -16,6 +31,9 @@ __date__ = "2017-07-27"
 class Database():
     """
     Database class to create a connection and interact with a MySQL database.
+    Connections are checked out of a :class:`ConnectionPool` so that a whole
+    run reuses a handful of warm connections instead of connecting for every
+    insert or query.
     
     Args:
         config: The [mysql] section of the cofiguration file. Should have at a
@@ -26,15 +44,45 @@ class Database():
             database: which database to use
             metadata: metadata data to insert into
             data: data table to insert into
+            pool_size: (optional) maximum number of pooled connections,
+                default 5
+            pool_timeout: (optional) seconds to wait for a free connection
+                before raising, default wait forever
+            insert_method: (optional) default method for
+                :meth:`insert_data`, `insert` or `bulk`. The `bulk` method
+                requires `local_infile` to be enabled on the server and
+                is only allowed when it's the default, otherwise the
+                connections don't allow LOCAL INFILE.
         
     """
     
     fields = ['user', 'password', 'host', 'database']
     chunk_size = 75000
+    station_chunk_size = 50
+    pool_size = 5
+    insert_methods = ['insert', 'bulk']
+    insert_method = 'insert'
+    update_methods = ['batch', 'row']
+    
+    # metadata columns reported by the sources that are compared for the
+    # incremental metadata refresh and the decimals they are compared to,
+    # None for text. latitude, longitude and utm_* are not compared since
+    # they can be changed by tbl_station_update.
+    metadata_columns = {
+        'station_name': None,
+        'elevation': 2,
+        'state': None,
+        'timezone': None,
+        'primary_provider': None,
+        'network': None,
+        'reported_lat': 6,
+        'reported_long': 6
+        }
     
     def __init__(self, config):
         """
-        Initialize the db instance by connecting to the database
+        Initialize the db instance and the connection pool, connections
+        are not opened until they are needed
         """
         
         self._logger = logging.getLogger(__name__)
@@ -65,111 +113,346 @@ class Database():
         if 'auto' in k:
             self.auto_tables = config['auto'].split(',')
             
+        # connection pool
+        if 'pool_size' in k:
+            self.pool_size = int(config['pool_size'])
+        
+        pool_timeout = None
+        if 'pool_timeout' in k:
+            pool_timeout = float(config['pool_timeout'])
+            
+        self._pool = ConnectionPool(self._open_connection,
+                                    size=self.pool_size,
+                                    timeout=pool_timeout)
+        
+        # default insert method
+        if 'insert_method' in k:
+            self.insert_method = config['insert_method'].strip().lower()
+        if self.insert_method not in self.insert_methods:
+            raise ValueError('insert_method must be one of {}'.format(self.insert_methods))
+        
+        # LOCAL INFILE lets the server read files from the client, only
+        # allow it when the data can be bulk loaded
+        self.local_infile = self.insert_method == 'bulk'
+            
+        self.cnx = None
         self.conneted = False
         
-    def db_connect(self):
+        # station indexes for the run keyed by the clients
+        self._station_index = {}
+        
+    def _open_connection(self):
         """
-        Connect to the database
+        Open a new connection to the database, used by the connection pool.
+        LOCAL INFILE is only allowed for bulk loading and if possible only
+        for the temporary files written by :meth:`_bulk_insert`.
         """
+        
+        kwargs = {'allow_local_infile': False}
+        if self.local_infile:
+            if LOCAL_INFILE_IN_PATH:
+                kwargs['allow_local_infile_in_path'] = tempfile.gettempdir()
+            else:
+                kwargs['allow_local_infile'] = True
+                
         try:
             cnx = mysql.connector.connect(user=self.config['user'],
                                           password=self.config['password'],
                                           host=self.config['host'],
                                           database=self.config['database'],
-                                          port=self.config['port'])
+                                          port=self.config['port'],
+                                          **kwargs)
             cnx.set_converter_class(NumpyMySQLConverter)
 
         except mysql.connector.Error as err:
             raise err
+        
+        self._logger.debug('Connected to MySQL database -- {}'.format(self.config['database']))
+        return cnx
+    
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection from the pool for the duration of a with
+        block, the connection is returned to the pool when the block exits
+        
+        Example:
+            with db.connection() as cnx:
+                cursor = cnx.cursor()
+        """
+        cnx = self._pool.get()
+        try:
+            yield cnx
+        finally:
+            self._pool.put(cnx)
+        
+    def station_index(self, clients):
+        """
+        Get the :class:`~wxdb.stations.StationIndex` for the clients, the
+        index is loaded on the first call and cached for the rest of the run
+        
+        Args:
+            clients: list of client names
+            
+        Returns:
+            :class:`~wxdb.stations.StationIndex`
+        """
+        
+        key = tuple(clients)
+        if key not in self._station_index:
+            self._station_index[key] = StationIndex(self, clients)
             
-        self.cnx = cnx
+        return self._station_index[key]
+        
+    def db_connect(self):
+        """
+        Check out a connection from the pool and store it as `cnx`. Must
+        be followed by :meth:`db_close` to return the connection.
+        """
+        self.cnx = self._pool.get()
         self.conneted = True
-        self._logger.debug('Connected to MySQL database -- {}'.format(self.config['database']))
         
     def db_close(self):
         """
-        Ensure that the database connection is closed
+        Return the connection checked out by :meth:`db_connect` to the pool
         """
-        self.cnx.close()
+        if self.cnx is not None:
+            self._pool.put(self.cnx)
+        self.cnx = None
         self.conneted = False
+        
+    def close(self):
+        """
+        Close all the pooled connections and log the connection statistics
+        """
+        stats = self.connection_stats()
+        self._pool.close()
+        self._logger.info('MySQL connections opened: {}, reused: {}, replaced: {}'.format(
+            stats['opened'], stats['reused'], stats['replaced']))
         self._logger.debug('Disconnected from MySQL database -- {}'.format(self.config['database']))
         
+    def connection_stats(self):
+        """
+        Connection counters for monitoring
         
+        Returns:
+            dict with the number of connections `opened`, `reused` from the
+            pool, `replaced` after a failed health check and currently `idle`
+        """
+        return self._pool.stats()
         
-    def insert_data(self, df, loc, description=''):
+    def insert_data(self, df, loc, description='', method=None):
         """
-        Insert data into the database for the given table and dataframe
+        Insert data into the database for the given table and dataframe. Rows
+        that already exist are updated.
+        
+        Args:
+            df: DataFrame with columns matching the table columns, a
+                DatetimeIndex is written as the `date_time` column
+            loc: table location, see :meth:`get_table`
+            description: description of the data for logging
+            method: `insert` to send batched INSERT statements or `bulk` to
+                load the data into a staging table with LOAD DATA LOCAL INFILE
+                and merge into the table. Defaults to the `insert_method`
+                from the config, `bulk` requires `insert_method: bulk`.
+                
+        Returns:
+            True if the data was written to all the tables
         """
         
         table = self.get_table(loc)
-                
-        self.db_connect()
         
-        for tbl in table:
-            self._logger.info('Adding/updating {} ({} values) to the database table {}'.format(
-                description, len(df), tbl))
-            
-            try:
-                # replace Null with None
-                df = df.where((pd.notnull(df)), None)
-            
-                # create a bulk insert for the data        
-                wildcards = ','.join(['%s'] * len(df.columns))
-                colnames = ','.join(df.columns)
-                update = ','.join(['{}=VALUES({})'.format(c,c) for c in df.columns])
-                insert_sql = 'INSERT INTO {0} ({1}) VALUES ({2}) ON DUPLICATE KEY UPDATE {3}'.format(
-                    tbl, colnames, wildcards, update)
-                
-                data = [tuple(rw) for rw in df.values]
-                cur = self.cnx.cursor()
+        if method is None:
+            method = self.insert_method
+        if method not in self.insert_methods:
+            raise ValueError('method must be one of {}'.format(self.insert_methods))
+        if (method == 'bulk') and not self.local_infile:
+            raise ValueError('method bulk requires insert_method: bulk in the config')
                 
-                for d in chunks(data, self.chunk_size):
-                    cur.executemany(insert_sql, d)
-                    self.cnx.commit()
+        ok = True
+        with self.connection() as cnx:
+        
+            for tbl in table:
+                self._logger.info('Adding/updating {} ({} values) to the database table {}'.format(
+                    description, len(df), tbl))
                 
-            except Exception as err:
-                    self._logger.error(err)
+                try:
+                    if method == 'bulk':
+                        self._bulk_insert(cnx, df, tbl)
+                    else:
+                        self._executemany_insert(cnx, df, tbl)
                     
-        self.db_close()
+                except Exception as err:
+                        self._logger.error(err)
+                        ok = False
+                        
+        return ok
+                        
+    def _executemany_insert(self, cnx, df, tbl):
+        """
+        Insert the dataframe with INSERT ... ON DUPLICATE KEY UPDATE
+        statements sent in chunks of `chunk_size` rows
+        """
+        
+        # create a bulk insert for the data        
+        columns = write_columns(df)
+        wildcards = ','.join(['%s'] * len(columns))
+        colnames = ','.join(columns)
+        update = ','.join(['{}=VALUES({})'.format(c,c) for c in columns])
+        insert_sql = 'INSERT INTO {0} ({1}) VALUES ({2}) ON DUPLICATE KEY UPDATE {3}'.format(
+            tbl, colnames, wildcards, update)
+        
+        cur = cnx.cursor()
+        
+        # rows are serialized one chunk at a time with NaN as None
+        for d in row_batches(df, self.chunk_size):
+            cur.executemany(insert_sql, d)
+            cnx.commit()
+            
+        cur.close()
         
-    def update_data(self, df, loc, where, description=''):
+    def _bulk_insert(self, cnx, df, tbl):
         """
-        Update data into the database for the given table and dataframe
+        Write the dataframe to a temporary file, LOAD DATA LOCAL INFILE into a
+        temporary staging table then merge the staging table into `tbl` with
+        a single INSERT ... SELECT ... ON DUPLICATE KEY UPDATE
         """
         
-        table = self.get_table(loc)
+        staging = staging_table('tmp_stage_', tbl)
+        columns = write_columns(df)
+        colnames = ','.join(columns)
+        update = ','.join(['{}=VALUES({})'.format(c,c) for c in columns])
         
-        for tbl in table:
-            self._logger.info('Adding/updating {} ({} values) to the database table {}'.format(
-                description, len(df), tbl))
+        # write the data out in chunks, NULL is the unquoted word NULL
+        f = tempfile.NamedTemporaryFile(mode='w', suffix='.tsv', delete=False)
+        try:
+            write_delimited(df, f, self.chunk_size)
+            f.close()
             
-            try:
-                # replace Null with None
-                df = df.where((pd.notnull(df)), None)
+            cur = cnx.cursor()
             
-                # create a bulk insert for the data        
-#                 wildcards = ','.join(['%s'] * len(df.columns))
-#                 colnames = ','.join(df.columns)
-
-                for i,row in df.iterrows():
-                    
-                    row.dropna(inplace=True)
-                    w = row[where]
-                    del row[where]
-                    
-                    update = ','.join(['{}=%s'.format(c) for c in row.index])
-                    update_sql = 'UPDATE {0} SET {1} WHERE {2}="{3}"'.format(tbl, update, where, w)
+            # staging table with the same column types and no indexes
+            cur.execute('DROP TEMPORARY TABLE IF EXISTS {}'.format(staging))
+            cur.execute('CREATE TEMPORARY TABLE {0} SELECT {1} FROM {2} LIMIT 0'.format(
+                staging, colnames, quote_identifier(tbl)))
+            
+            load_sql = "LOAD DATA LOCAL INFILE '{0}' INTO TABLE {1} " \
+                "FIELDS TERMINATED BY '\\t' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' " \
+                "LINES TERMINATED BY '\\n' ({2})".format(
+                    f.name.replace('\\', '/'), staging, colnames)
+            cur.execute(load_sql)
+            self._logger.debug('Loaded {} rows into {}'.format(cur.rowcount, staging))
+            
+            # merge into the table
+            merge_sql = 'INSERT INTO {0} ({1}) SELECT {1} FROM {2} ON DUPLICATE KEY UPDATE {3}'.format(
+                quote_identifier(tbl), colnames, staging, update)
+            cur.execute(merge_sql)
+            cnx.commit()
+            
+            cur.execute('DROP TEMPORARY TABLE {}'.format(staging))
+            cur.close()
+            
+        finally:
+            f.close()
+            os.remove(f.name)
+        
+    def update_data(self, df, loc, where, description='', method='batch'):
+        """
+        Update data into the database for the given table and dataframe. Only
+        the non null values in `df` are updated, null values keep the current
+        value in the table.
+        
+        Args:
+            df: DataFrame with the `where` column and the columns to update
+            loc: table location, see :meth:`get_table`
+            where: column to match the rows in the table on
+            description: description of the data for logging
+            method: `batch` to load `df` into a temporary table and apply
+                all updates with a single UPDATE ... JOIN or `row` to send an
+                UPDATE statement for every row
+        """
+        
+        table = self.get_table(loc)
+        
+        if method not in self.update_methods:
+            raise ValueError('method must be one of {}'.format(self.update_methods))
+        
+        with self.connection() as cnx:
+        
+            for tbl in table:
+                self._logger.info('Adding/updating {} ({} values) to the database table {}'.format(
+                    description, len(df), tbl))
                 
-                    data = [rw for rw in row.values]
-                    cur = self.cnx.cursor()
-                    
-                    cur.execute(update_sql, data)
-                    self.cnx.commit()
-                    
-            except mysql.connector.Error as err:
-                    self._logger.error(err)
-                    
-        self.db_close()
+                try:
+                    if method == 'batch':
+                        self._batch_update(cnx, df, tbl, where)
+                    else:
+                        self._row_update(cnx, df, tbl, where)
+                        
+                except mysql.connector.Error as err:
+                        self._logger.error(err)
+                        
+    def _batch_update(self, cnx, df, tbl, where):
+        """
+        Load the dataframe into a temporary table and update `tbl` with one
+        UPDATE ... JOIN in a single transaction. COALESCE keeps the current
+        value for any null in the dataframe.
+        """
+        
+        staging = staging_table('tmp_update_', tbl)
+        columns = write_columns(df)
+        cols = [c for c in columns if c != where]
+        colnames = ','.join(columns)
+        
+        cur = cnx.cursor()
+        
+        # staging table with the same column types and an index on the key
+        cur.execute('DROP TEMPORARY TABLE IF EXISTS {}'.format(staging))
+        cur.execute('CREATE TEMPORARY TABLE {0} (INDEX ({1})) SELECT {2} FROM {3} LIMIT 0'.format(
+            staging, where, colnames, quote_identifier(tbl)))
+        
+        wildcards = ','.join(['%s'] * len(columns))
+        insert_sql = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(staging, colnames, wildcards)
+        
+        for d in row_batches(df, self.chunk_size):
+            cur.executemany(insert_sql, d)
+        
+        # apply the updates
+        update = ','.join(['t.{0}=COALESCE(u.{0}, t.{0})'.format(c) for c in cols])
+        update_sql = 'UPDATE {0} t JOIN {1} u ON t.{2}=u.{2} SET {3}'.format(
+            quote_identifier(tbl), staging, where, update)
+        cur.execute(update_sql)
+        self._logger.debug('Updated {} rows in {}'.format(cur.rowcount, tbl))
+        cnx.commit()
+        
+        cur.execute('DROP TEMPORARY TABLE {}'.format(staging))
+        cur.close()
+        
+    def _row_update(self, cnx, df, tbl, where):
+        """
+        Update `tbl` with an UPDATE statement for every row in the dataframe
+        """
+        
+        # replace Null with None
+        df = df.where((pd.notnull(df)), None)
+        
+        cur = cnx.cursor()
+
+        for i,row in df.iterrows():
+            
+            row.dropna(inplace=True)
+            w = row[where]
+            del row[where]
+            
+            update = ','.join(['{}=%s'.format(c) for c in row.index])
+            update_sql = 'UPDATE {0} SET {1} WHERE {2}=%s'.format(tbl, update, where)
+        
+            data = [rw for rw in row.values] + [w]
+            
+            cur.execute(update_sql, data)
+            
+        cnx.commit()
+        cur.close()
         
     def retrieve_station_data(self, stid, start_date, end_date, loc='level1'):
         """
@@ -188,30 +471,291 @@ class Database():
         
         table = self.get_table(loc)[0]
         
-        if not self.conneted:
-            self.db_connect()
+        df = None
+        with self.connection() as cnx:
+            try:
+                qry = "SELECT * FROM {0} WHERE station_id='{1}' AND date_time BETWEEN '{2}' AND '{3}'".format(
+                    table, stid, start_date.isoformat(), end_date.isoformat())
+    
+                df = pd.read_sql(qry, cnx, index_col='date_time')
+                
+                if df is None:
+                    self._logger.warn('Could not find data for {}'.format(stid))
+                    
+                else:
+                    # replace None with NaN and drop columns without any data
+                    df.fillna(value=np.nan, inplace=True)
+                    df.dropna(axis=1, how='all', inplace=True)
+                    
+            except mysql.connector.Error as err:
+                    self._logger.error(err)
+                
+        return df
+
+        
+    def retrieve_stations_data(self, stations, start_date, end_date, columns=None, loc='level1'):
+        """
+        Retrieve the data for many stations with parameterized queries of up
+        to `station_chunk_size` stations each, instead of a query per station.
+        Numeric columns are parsed directly into float columns.
+        
+        Args:
+            stations: list of primary_id's
+            start_date: timestamp for the start date to pull, or a dict of
+                timestamps keyed by station for a different start per station
+            end_date: timestamp for the end date to pull
+            columns: list of columns to retrieve, default is all columns
+                except `id`
+            loc: table location to get from
+            
+        Returns:
+            dict of DataFrames keyed by station with 'date_time' as the index,
+            columns without any data are dropped. Stations without data are
+            not in the dict.
+        """
+        
+        table = self.get_table(loc)[0]
+        
+        if not isinstance(start_date, dict):
+            start_date = {stid: start_date for stid in stations}
+        
+        data = {}
+        with self.connection() as cnx:
+            cur = cnx.cursor()
+            
+            colnames = ','.join(self._data_columns(cur, table, columns))
+            
+            for sta in chunks(list(stations), self.station_chunk_size):
+                
+                # a date range for each station
+                where = ' OR '.join(['(station_id=%s AND date_time BETWEEN %s AND %s)'] * len(sta))
+                params = []
+                for stid in sta:
+                    params += [stid, start_date[stid].isoformat(), end_date.isoformat()]
+                    
+                qry = 'SELECT {0} FROM {1} WHERE {2} ORDER BY station_id, date_time'.format(
+                    colnames, table, where)
+                
+                try:
+                    cur.execute(qry, params)
+                    rows = cur.fetchall()
+                except mysql.connector.Error as err:
+                    self._logger.error(err)
+                    continue
+                
+                if len(rows) == 0:
+                    continue
+                
+                df = rows_to_frame(rows, cur.description)
+                station_id = df['station_id'].values
+                
+                # split into the stations, rows are ordered by station
+                bounds = np.flatnonzero(station_id[1:] != station_id[:-1]) + 1
+                for s, e in zip(np.r_[0, bounds], np.r_[bounds, len(df)]):
+                    d = df.iloc[s:e].dropna(axis=1, how='all')
+                    data[station_id[s]] = d
+                    
+            cur.close()
+            
+        self._logger.debug('Retrieved data for {} of {} stations from {}'.format(
+            len(data), len(stations), table))
+                
+        return data
+        
+    def iter_station_data(self, stid, start_date, end_date, columns=None, loc='level1',
+                          rows=None, freq=None):
+        """
+        Generator that reads the data for a station in chunks so that long
+        histories can be processed in constant memory. By default the rows
+        are streamed from an unbuffered cursor and yielded `rows` at a time,
+        if `freq` is given a query is made for each time slice instead.
+        
+        Every chunk has the same columns and dtypes, numeric columns are
+        float64 and columns are not dropped when they are empty.
+        
+        Args:
+            stid: string for the primary_id
+            start_date: timestamp for the start date to pull
+            end_date: timestamp for the end date to pull
+            columns: list of columns to retrieve, default is all columns
+                except `id`
+            loc: table location to get from
+            rows: number of rows per chunk, default `chunk_size`
+            freq: pandas offset alias for time slices, i.e. '30D'
+            
+        Yields:
+            DataFrame with 'date_time' as the index
+        """
+        
+        table = self.get_table(loc)[0]
+        
+        if rows is None:
+            rows = self.chunk_size
+        
+        # time ranges to query, the last range includes the end date
+        if freq is None:
+            ranges = [(start_date, end_date, '<=')]
+        else:
+            edges = list(pd.date_range(start_date, end_date, freq=freq))
+            if len(edges) == 0 or edges[0] != start_date:
+                edges.insert(0, start_date)
+            if edges[-1] != end_date:
+                edges.append(end_date)
+            ranges = [(s, e, '<') for s, e in zip(edges[:-1], edges[1:])]
+            ranges[-1] = (ranges[-1][0], ranges[-1][1], '<=')
         
+        cnx = self._pool.get()
+        exhausted = False
         try:
-            qry = "SELECT * FROM {0} WHERE station_id='{1}' AND date_time BETWEEN '{2}' AND '{3}'".format(
-                table, stid, start_date.isoformat(), end_date.isoformat())
-
-            df = pd.read_sql(qry, self.cnx, index_col='date_time')
+            cur = cnx.cursor()
+            colnames = ','.join(self._data_columns(cur, table, columns))
+            cur.close()
             
-            if df is None:
-                self._logger.warn('Could not find data for {}'.format(stid))
+            # unbuffered cursor, rows are read from the server as fetched
+            cur = cnx.cursor(buffered=False)
+            for s, e, op in ranges:
+                qry = 'SELECT {0} FROM {1} WHERE station_id=%s AND date_time >= %s ' \
+                    'AND date_time {2} %s ORDER BY date_time'.format(colnames, table, op)
+                cur.execute(qry, (stid, s.isoformat(), e.isoformat()))
                 
+                while True:
+                    data = cur.fetchmany(rows)
+                    if len(data) == 0:
+                        break
+                    yield rows_to_frame(data, cur.description)
+                    
+            cur.close()
+            exhausted = True
+            
+        finally:
+            if exhausted:
+                self._pool.put(cnx)
             else:
-                # replace None with NaN and drop columns without any data
-                df.fillna(value=np.nan, inplace=True)
-                df.dropna(axis=1, how='all', inplace=True)
-                
-        except mysql.connector.Error as err:
-                self._logger.error(err)
+                # the generator was closed early, the connection still has
+                # unread rows and can't be reused
+                self._pool.discard(cnx)
                 
-        self.db_close()
+    def _data_columns(self, cur, table, columns=None):
+        """
+        Determine the columns to select from a data table, always starting
+        with station_id and date_time
+        
+        Args:
+            cur: cursor to query the table with
+            table: table name
+            columns: list of columns or None for all columns except `id`
+            
+        Returns:
+            list of column names
+        """
+        
+        if columns is None:
+            cur.execute('SELECT * FROM {} LIMIT 0'.format(table))
+            cur.fetchall()
+            columns = [c[0] for c in cur.description if c[0] not in ['id', 'station_id', 'date_time']]
+        else:
+            columns = [c for c in columns if c not in ['station_id', 'date_time']]
+            
+        return ['station_id', 'date_time'] + columns
+        
+    def get_watermarks(self, stations, loc='level0'):
+        """
+        Get the last time in the database plus one minute for each station
+        with a single grouped query. This is the time to start retrieving
+        new data from.
+        
+        Args:
+            stations: list of primary_id's
+            loc: table location to get from
+            
+        Returns:
+            dict of UTC timestamps keyed by primary_id, None for stations
+            without any data
+        """
+        
+        table = self.get_table(loc)[0]
+        
+        watermarks = {stid: None for stid in stations}
+        if len(watermarks) == 0:
+            return watermarks
+        
+        with self.connection() as cnx:
+            cur = cnx.cursor()
+            
+            # limit the size of the IN list for very large clients
+            for sta in chunks(list(watermarks.keys()), 1000):
+                qry = "SELECT station_id, max(date_time) + INTERVAL 1 MINUTE AS d FROM {0} " \
+                    "WHERE station_id IN ({1}) GROUP BY station_id".format(
+                        table, ','.join(['%s'] * len(sta)))
+                cur.execute(qry, sta)
                 
+                for stid, d in cur.fetchall():
+                    if d is not None:
+                        watermarks[stid] = pd.to_datetime(d, utc=True)
+                        
+            cur.close()
+            
+        self._logger.debug('Found data for {} of {} stations in {}'.format(
+            sum([w is not None for w in watermarks.values()]), len(watermarks), table))
+        
+        return watermarks
+        
+    def read_metadata(self, source):
+        """
+        Read the current metadata for a source with a single query, used to
+        determine which stations are new or changed before writing
+        
+        Args:
+            source: metadata source, i.e. 'mesowest'
+            
+        Returns:
+            DataFrame of the `metadata_columns` indexed by primary_id
+        """
+        
+        table = self.get_table('metadata')[0]
+        columns = list(self.metadata_columns.keys())
+        
+        qry = 'SELECT primary_id, {0} FROM {1} WHERE source=%s'.format(','.join(columns), table)
+        
+        with self.connection() as cnx:
+            cur = cnx.cursor()
+            cur.execute(qry, (source,))
+            rows = cur.fetchall()
+            cur.close()
+            
+        df = pd.DataFrame(rows, columns=['primary_id'] + columns)
+        df.set_index('primary_id', inplace=True)
+        
+        self._logger.debug('Read metadata for {} {} stations from {}'.format(
+            len(df), source, table))
+        
         return df
-
+    
+    def metadata_status(self, df, current):
+        """
+        Compare the metadata for the stations with the current metadata by
+        hashing the `metadata_columns` of each row
+        
+        Args:
+            df: metadata DataFrame with a primary_id column
+            current: current metadata from :meth:`read_metadata`
+            
+        Returns:
+            Series of 'new', 'changed' or 'unchanged' aligned with `df`
+        """
+        
+        columns = [c for c in self.metadata_columns if c in df.columns]
+        
+        new_hash = metadata_hash(df, columns, self.metadata_columns)
+        old_hash = pd.Series(metadata_hash(current, columns, self.metadata_columns),
+                             index=current.index)
+        old_hash = old_hash[~old_hash.index.duplicated()]
+        old_hash = old_hash.reindex(df['primary_id'].values).values
+        
+        exists = df['primary_id'].isin(current.index).values
+        status = np.where(~exists, 'new', np.where(new_hash == old_hash, 'unchanged', 'changed'))
+        
+        return pd.Series(status, index=df.index)
         
     def get_table(self, loc):
         """
@@ -238,6 +782,185 @@ class Database():
         
         return table
  
+class ConnectionPool():
+    """
+    Pool of MySQL connections. Connections are opened lazily up to `size`
+    and are health checked before being handed back out, a connection that
+    fails the check is replaced with a new one. When a connection is closed
+    instead of returned a None placeholder is put in the idle queue so a
+    thread waiting for a connection wakes up and opens a new one.
+    
+    Args:
+        connect: function that opens and returns a new connection
+        size: maximum number of connections to open
+        timeout: seconds to wait for a connection when all are checked out,
+            None will wait forever
+    """
+    
+    def __init__(self, connect, size=5, timeout=None):
+        
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        
+        self._idle = LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        
+        self.opened = 0
+        self.reused = 0
+        self.replaced = 0
+        
+    def get(self):
+        """
+        Check out a connection, reusing an idle one when available
+        """
+        
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+            
+        while True:
+            try:
+                cnx = self._idle.get_nowait()
+            except Empty:
+                cnx = None
+                
+            if cnx is None:
+                # open a new connection if the pool is not full
+                with self._lock:
+                    room = self._created < self.size
+                    if room:
+                        self._created += 1
+                
+                if room:
+                    return self._open()
+                
+                # wait for a connection to be returned or a slot freed
+                timeout = None
+                if deadline is not None:
+                    timeout = max(0, deadline - time.time())
+                try:
+                    cnx = self._idle.get(timeout=timeout)
+                except Empty:
+                    raise mysql.connector.PoolError(
+                        'No connection available after {} seconds'.format(self.timeout))
+                
+                if cnx is None:
+                    continue
+                    
+            # health check on the idle connection
+            if self._healthy(cnx):
+                with self._lock:
+                    self.reused += 1
+                return cnx
+            
+            with self._lock:
+                self.replaced += 1
+            self._discard(cnx)
+            return self._open()
+    
+    def put(self, cnx):
+        """
+        Return a connection to the pool, any open transaction is rolled back
+        """
+        
+        try:
+            cnx.rollback()
+            self._idle.put_nowait(cnx)
+        except Exception:
+            self.discard(cnx)
+    
+    def discard(self, cnx):
+        """
+        Close a checked out connection instead of returning it to the pool
+        """
+        
+        self._discard(cnx)
+        self._release()
+    
+    def close(self):
+        """
+        Close all the idle connections
+        """
+        
+        closed = []
+        while True:
+            try:
+                cnx = self._idle.get_nowait()
+            except Empty:
+                break
+            if cnx is not None:
+                closed.append(cnx)
+                
+        for cnx in closed:
+            self.discard(cnx)
+                
+    def stats(self):
+        """
+        Counters of the connections opened and reused
+        """
+        
+        with self._idle.mutex:
+            idle = len([cnx for cnx in self._idle.queue if cnx is not None])
+            
+        with self._lock:
+            return {
+                'opened': self.opened,
+                'reused': self.reused,
+                'replaced': self.replaced,
+                'idle': idle,
+                'size': self.size
+                }
+    
+    def _open(self):
+        """
+        Open a new connection, the slot is already reserved in `_created`
+        """
+        
+        try:
+            cnx = self._connect()
+        except Exception:
+            self._release()
+            raise
+        
+        with self._lock:
+            self.opened += 1
+        return cnx
+    
+    def _release(self):
+        """
+        Free the slot of a closed connection and wake up a waiting thread
+        """
+        
+        with self._lock:
+            self._created -= 1
+            
+        try:
+            self._idle.put_nowait(None)
+        except Full:
+            pass
+        
+    def _healthy(self, cnx):
+        """
+        Ping the server to ensure the connection is still alive
+        """
+        
+        try:
+            return cnx.is_connected()
+        except Exception:
+            return False
+        
+    def _discard(self, cnx):
+        """
+        Close a connection, ignoring any errors
+        """
+        
+        try:
+            cnx.close()
+        except Exception:
+            pass
+ 
 class NumpyMySQLConverter(mysql.connector.conversion.MySQLConverter):
     """ A mysql.connector Converter that handles Numpy types """
 
@@ -256,5 +979,247 @@ class NumpyMySQLConverter(mysql.connector.conversion.MySQLConverter):
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
-        yield l[i:i + n]       
+        yield l[i:i + n]
+        
+def column_values(values):
+    """
+    Convert a NumPy column to a list of native Python values with missing
+    values as None. Float and datetime64 columns are converted straight
+    from the array buffer without upcasting to object.
+    
+    Args:
+        values: 1D NumPy array
+        
+    Returns:
+        list of Python values
+    """
+    
+    kind = values.dtype.kind
+    
+    if kind == 'f':
+        lst = values.tolist()
+        for i in np.flatnonzero(np.isnan(values)):
+            lst[i] = None
+    
+    elif kind == 'M':
+        # datetime64[us] converts to datetime.datetime and NaT to None
+        lst = values.astype('datetime64[us]').tolist()
+        
+    elif kind in 'iub':
+        lst = values.tolist()
+        
+    else:
+        lst = values.tolist()
+        for i in np.flatnonzero(pd.isnull(values)):
+            lst[i] = None
+            
+    return lst
+
+def rows_to_frame(rows, description):
+    """
+    Convert rows from a data table query to a DataFrame. The first two
+    columns must be station_id and date_time, numeric columns are parsed
+    straight into float64.
+    
+    Args:
+        rows: list of row tuples
+        description: cursor description for the query
+        
+    Returns:
+        DataFrame with 'date_time' as the index
+    """
+    
+    numeric = FieldType.get_number_types()
+    columns = [d[0] for d in description]
+    
+    if len(rows) > 0:
+        values = list(zip(*rows))
+    else:
+        values = [()] * len(columns)
+    
+    df = pd.DataFrame(index=pd.DatetimeIndex(values[1], name='date_time'))
+    df['station_id'] = np.array(values[0], dtype=object)
+    for i in range(2, len(columns)):
+        if description[i][1] in numeric:
+            df[columns[i]] = np.array(values[i], dtype=np.float64)
+        else:
+            df[columns[i]] = np.array(values[i], dtype=object)
+            
+    return df
+
+def metadata_hash(df, columns, decimals):
+    """
+    Hash the columns of each row of a metadata DataFrame. Numeric columns
+    are rounded so that values read back from DECIMAL columns hash the same
+    as the values reported by the source, text is compared as stripped
+    strings and nulls hash the same regardless of type.
+    
+    Args:
+        df: DataFrame
+        columns: columns to hash
+        decimals: dict of the decimals to round to for each column, None
+            for text columns
+        
+    Returns:
+        numpy array of uint64 hashes
+    """
+    
+    d = pd.DataFrame(index=np.arange(len(df)))
+    for c in columns:
+        v = df[c].values
+        if decimals[c] is None:
+            null = pd.isnull(v)
+            d[c] = np.where(null, '\x00', pd.Series(v).astype(str).str.strip().values)
+        else:
+            v = pd.to_numeric(pd.Series(v).astype(object).where(pd.notnull(v), None),
+                              errors='coerce')
+            d[c] = v.astype(np.float64).round(decimals[c]).values
+            
+    return pd.util.hash_pandas_object(d, index=False).values
+
+def quote_identifier(name):
+    """
+    Quote a table name with backticks, each part of a schema qualified
+    name like `db.tbl` is quoted separately
+    
+    Args:
+        name: table name, optionally qualified with the database
+        
+    Returns:
+        quoted name
+    """
+    
+    return '.'.join(['`{}`'.format(n.replace('`', '``')) for n in name.split('.')])
+
+def staging_table(prefix, tbl):
+    """
+    Quoted name of the temporary staging table for `tbl`. Temporary tables
+    are created in the default database so the name is derived from the
+    unqualified table name.
+    
+    Args:
+        prefix: prefix for the staging table
+        tbl: table name, optionally qualified with the database
+        
+    Returns:
+        quoted staging table name
+    """
+    
+    return quote_identifier('{}{}'.format(prefix, tbl.split('.')[-1]))
+
+def write_columns(df):
+    """
+    Names of the columns that are written for a dataframe. A DatetimeIndex
+    is written as the `date_time` column when the dataframe doesn't have
+    one, so the intermediate frames don't need a `date_time` column.
+    
+    Args:
+        df: DataFrame
+        
+    Returns:
+        list of column names
+    """
+    
+    columns = list(df.columns)
+    if ('date_time' not in columns) and isinstance(df.index, pd.DatetimeIndex):
+        columns.append('date_time')
+        
+    return columns
+
+def frame_arrays(df):
+    """
+    NumPy arrays for the :func:`write_columns` of a dataframe. The
+    DatetimeIndex is passed as datetime64 in UTC, it is formatted in bulk
+    when the rows are serialized.
+    
+    Args:
+        df: DataFrame
+        
+    Returns:
+        list of 1D NumPy arrays
+    """
+    
+    arrays = [df[c].values for c in df.columns]
+    if len(arrays) < len(write_columns(df)):
+        index = df.index
+        if index.tz is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+        arrays.append(index.values)
+        
+    return arrays
+
+def row_batches(df, n):
+    """
+    Yield the rows of a dataframe as lists of tuples with at most n rows,
+    ready for `executemany`. Only one batch of rows is held in memory at a
+    time.
+    
+    Args:
+        df: DataFrame
+        n: number of rows per batch
+    """
+    
+    arrays = frame_arrays(df)
+    for i in range(0, len(df), n):
+        cols = [column_values(a[i:i + n]) for a in arrays]
+        yield list(zip(*cols))
+        
+def column_strings(values):
+    """
+    Format a NumPy column as strings for LOAD DATA INFILE, missing values
+    are the unquoted word NULL
+    
+    Args:
+        values: 1D NumPy array
+        
+    Returns:
+        list of strings
+    """
+    
+    kind = values.dtype.kind
+    
+    if kind == 'f':
+        lst = list(map(repr, values.tolist()))
+        for i in np.flatnonzero(np.isnan(values)):
+            lst[i] = 'NULL'
+            
+    elif kind == 'M':
+        lst = np.datetime_as_string(values.astype('datetime64[s]')).tolist()
+        for i in np.flatnonzero(np.isnat(values)):
+            lst[i] = 'NULL'
+        lst = [v.replace('T', ' ') for v in lst]
+            
+    elif kind in 'iub':
+        lst = list(map(str, values.tolist()))
+        
+    else:
+        null = pd.isnull(values)
+        lst = []
+        for v, isnull in zip(values.tolist(), null):
+            if isnull:
+                v = 'NULL'
+            else:
+                v = str(v)
+                if '\t' in v or '\n' in v or '"' in v or v == 'NULL':
+                    v = '"{}"'.format(v.replace('"', '""'))
+            lst.append(v)
+            
+    return lst
+
+def write_delimited(df, f, n):
+    """
+    Write a dataframe as tab delimited lines for LOAD DATA INFILE with
+    fields optionally enclosed by double quotes and no escape character.
+    The dataframe is written n rows at a time.
+    
+    Args:
+        df: DataFrame
+        f: file like object to write to
+        n: number of rows to format at a time
+    """
+    
+    arrays = frame_arrays(df)
+    for i in range(0, len(df), n):
+        cols = [column_strings(a[i:i + n]) for a in arrays]
+        f.writelines('\t'.join(r) + '\n' for r in zip(*cols))
             
\ No newline at end of file
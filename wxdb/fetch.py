@@ -0,0 +1,384 @@
+"""
+HTTP fetch engine shared by the data sources
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from requests.adapters import HTTPAdapter
+
+import sys
+if sys.version_info[0] < 3:
+    from urlparse import urlparse
+else:
+    # Python 3
+    from urllib.parse import urlparse
+
+__author__ = "Scott Havens"
+__maintainer__ = "Scott Havens"
+__email__ = "scott.havens@ars.usda.gov"
+__date__ = "2017-07-27"
+
+
+class Request():
+    """
+    A GET request for the :class:`Fetcher`
+
+    Args:
+        url: url to request
+        params: dict of query parameters
+        key: anything to identify the request by, i.e. the station id
+        stream: if True the body isn't downloaded with the headers, it's
+            read from `response.raw` by the caller who has to close the
+            response
+    """
+
+    def __init__(self, url, params=None, key=None, stream=False):
+        self.url = url
+        self.params = params
+        self.key = key
+        self.stream = stream
+
+    def __repr__(self):
+        return 'Request({}, {})'.format(self.url, self.key)
+
+
+class Limiter():
+    """
+    Fixed limit on the number of concurrent requests to a host. Keeps a
+    histogram of the request latencies.
+
+    Args:
+        limit: maximum concurrent requests
+    """
+
+    # upper edges of the latency histogram buckets in seconds
+    buckets = [0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, float('inf')]
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.histogram = [0] * len(self.buckets)
+
+        self._inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until a request can be sent
+        """
+
+        with self._cond:
+            while self._inflight >= int(self.limit):
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(self, latency, ok):
+        """
+        Record a finished request
+
+        Args:
+            latency: seconds the request took
+            ok: False if the request failed, timed out or the server
+                returned 429 or 5xx
+        """
+
+        with self._cond:
+            self._inflight -= 1
+            for i, b in enumerate(self.buckets):
+                if latency <= b:
+                    self.histogram[i] += 1
+                    break
+            self._update(latency, ok)
+            self._cond.notify_all()
+
+    def _update(self, latency, ok):
+        pass
+
+    def format_histogram(self):
+        """
+        Latency histogram as a string
+        """
+
+        h = []
+        lower = 0
+        for b, n in zip(self.buckets, self.histogram):
+            h.append('{}-{}s: {}'.format(lower, b, n))
+            lower = b
+        return ', '.join(h)
+
+
+class AdaptiveLimiter(Limiter):
+    """
+    Concurrency limit that adapts to the health of the server with additive
+    increase, multiplicative decrease (AIMD). After every `limit` successful
+    requests the limit is increased by one. The limit is multiplied by
+    `decrease` when a request fails, times out, gets a 429 or 5xx or takes
+    longer than `latency_factor` times the average latency. The limit is
+    decreased at most once for every `limit` requests so that a burst of
+    slow requests only counts once.
+
+    Args:
+        limit: initial limit
+        minimum: lowest limit
+        maximum: highest limit
+        latency_factor: latency relative to the average that is considered
+            a sign the server is degrading
+        decrease: factor to decrease the limit by
+    """
+
+    def __init__(self, limit=1, minimum=1, maximum=8, latency_factor=3.0, decrease=0.5):
+        Limiter.__init__(self, limit)
+
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_factor = latency_factor
+        self.decrease = decrease
+
+        self._average = None
+        self._successes = 0
+        self._since_decrease = 0
+
+    def _update(self, latency, ok):
+
+        self._since_decrease += 1
+
+        slow = (self._average is not None) and \
+            (latency > self.latency_factor * self._average)
+
+        if ok:
+            # moving average of the healthy latency
+            if self._average is None:
+                self._average = latency
+            else:
+                self._average = 0.9 * self._average + 0.1 * latency
+
+        if (not ok) or slow:
+            self._successes = 0
+            if self._since_decrease >= self.limit:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._since_decrease = 0
+
+        else:
+            self._successes += 1
+            if self._successes >= int(self.limit):
+                self.limit = min(self.maximum, self.limit + 1)
+                self._successes = 0
+
+
+class Fetcher():
+    """
+    Fetch many GET requests concurrently with a keep-alive session and a
+    concurrency limit for each host, timeouts and retries with exponential
+    backoff. Failed requests are logged instead of silently dropped.
+
+    Args:
+        concurrency: maximum concurrent requests to a host, the initial
+            limit if adaptive
+        adaptive: use an :class:`AdaptiveLimiter` for each host that
+            ramps the concurrency up to `max_concurrency` while the server
+            is healthy
+        max_concurrency: highest limit for the adaptive limiter
+        timeout: tuple of the connect and read timeouts in seconds
+        retries: number of times to retry a failed request
+        backoff: seconds to wait before the first retry, doubled for every
+            retry after
+        max_retry_after: longest wait in seconds a server can ask for with
+            the Retry-After header
+
+    Example:
+        f = Fetcher(concurrency=4)
+        for req, rs in f.imap([Request(url, params, key='BOGI1')]):
+            ...
+    """
+
+    # status codes that will be retried
+    retry_status = [429, 500, 502, 503, 504]
+
+    def __init__(self, concurrency=4, adaptive=False, max_concurrency=8,
+                 timeout=(10, 120), retries=3, backoff=1.0, max_retry_after=60):
+        self._logger = logging.getLogger(__name__)
+
+        self.concurrency = concurrency
+        self.adaptive = adaptive
+        self.max_concurrency = max(concurrency, max_concurrency) if adaptive else concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+
+        self._sessions = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+
+        self.stats = {'requests': 0, 'retries': 0, 'failed': 0}
+
+    def get(self, url, params=None):
+        """
+        Fetch a single url
+
+        Args:
+            url: url to request
+            params: dict of query parameters
+
+        Returns:
+            response, None if the request failed after all the retries
+        """
+
+        return self.fetch(Request(url, params))
+
+    def imap(self, reqs):
+        """
+        Fetch the requests concurrently, yielding the responses in the order
+        they are returned. At most `max_concurrency` requests are in flight
+        at a time so responses are not fetched faster than they are
+        consumed.
+
+        Args:
+            reqs: list of :class:`Request`
+
+        Yields:
+            tuple of the request and response, the response is None if the
+            request failed after all the retries
+        """
+
+        reqs = iter(reqs)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+
+            pending = {}
+            while True:
+                # keep the workers busy
+                while len(pending) < self.max_concurrency:
+                    try:
+                        req = next(reqs)
+                    except StopIteration:
+                        break
+                    pending[executor.submit(self.fetch, req)] = req
+
+                if not pending:
+                    break
+
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    req = pending.pop(future)
+                    yield req, future.result()
+
+    def map(self, reqs):
+        """
+        Fetch the requests concurrently and return all the responses
+
+        Returns:
+            list of tuples of the request and response
+        """
+
+        return list(self.imap(reqs))
+
+    def fetch(self, req):
+        """
+        Fetch a request, retrying connection errors, timeouts and the
+        `retry_status` codes
+
+        Args:
+            req: :class:`Request`
+
+        Returns:
+            response, None if the request failed after all the retries
+        """
+
+        host = urlparse(req.url).netloc
+        session, limit = self._host(host)
+
+        rs = None
+        reason = None
+        for attempt in range(self.retries + 1):
+
+            if attempt > 0:
+                self._wait(attempt, rs)
+                self._count('retries')
+
+            self._count('requests')
+            limit.acquire()
+            start = time.time()
+            try:
+                rs = session.get(req.url, params=req.params, timeout=self.timeout,
+                                 stream=req.stream)
+            except requests.exceptions.RequestException as e:
+                limit.release(time.time() - start, False)
+                rs = None
+                reason = e.__class__.__name__
+                continue
+
+            ok = rs.status_code not in self.retry_status
+            limit.release(time.time() - start, ok)
+
+            if not ok:
+                reason = 'status {}'.format(rs.status_code)
+                rs.close()
+                continue
+
+            return rs
+
+        self._count('failed')
+        self._logger.warn('Giving up on {} after {} attempts - {}'.format(
+            req, self.retries + 1, reason))
+
+        return None
+
+    def log_stats(self):
+        """
+        Log the number of requests, retries and failures and for each host
+        the concurrency limit and latency histogram
+        """
+
+        self._logger.info('{} requests, {} retries, {} failed'.format(
+            self.stats['requests'], self.stats['retries'], self.stats['failed']))
+
+        for host, limit in self._limits.items():
+            self._logger.info('{} concurrency limit {}'.format(host, int(limit.limit)))
+            self._logger.info('{} latency {}'.format(host, limit.format_histogram()))
+
+    def _host(self, host):
+        """
+        Get the session and concurrency limit for the host, creating them on
+        the first request to the host
+        """
+
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+
+                if self.adaptive:
+                    self._limits[host] = AdaptiveLimiter(limit=self.concurrency,
+                                                         maximum=self.max_concurrency)
+                else:
+                    self._limits[host] = Limiter(self.concurrency)
+
+            return self._sessions[host], self._limits[host]
+
+    def _wait(self, attempt, rs):
+        """
+        Sleep before a retry, using the Retry-After header if the server
+        sent one otherwise exponential backoff with jitter. Retry-After is
+        capped at `max_retry_after` so a bad header can't stall the worker
+        """
+
+        delay = self.backoff * 2**(attempt - 1) * random.uniform(0.5, 1.5)
+
+        if rs is not None:
+            try:
+                retry_after = min(float(rs.headers['Retry-After']), self.max_retry_after)
+                delay = max(delay, retry_after)
+            except (KeyError, ValueError):
+                pass
+
+        time.sleep(delay)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
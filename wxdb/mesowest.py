@@ -5,12 +5,22 @@ Interact with the Mesowest API to get metadata and timeseries data
 import logging
 from MesoPy import Meso
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import pytz
-import grequests
 import json
+from array import array
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
 
 import utils
+from pipeline import Pipeline
+from fetch import Fetcher, Request
+from backfill import Backfill
 
 import sys
 if sys.version_info[0] < 3: 
@@ -59,6 +69,14 @@ class Mesowest():
     
     mesowest_timeseries_url = 'http://api.mesowest.net/v2/stations/timeseries'
     
+    concurrency = 8     # concurrent requests to the API
+    max_retry_after = 60    # longest Retry-After in seconds that is honoured
+    batch_size = 10     # stations per request
+    batch_window = pd.Timedelta(hours=6)    # start time spread within a request
+    queue_size = 4      # stations waiting between each stage of the pipeline
+    stream = False      # decode the responses as they are read, needs ijson
+    backfill_chunk = pd.Timedelta(days=7)   # longer ranges are backfilled in chunks
+    
     def __init__(self, db, config, quality_control=False):
         self._logger = logging.getLogger(__name__)
         
@@ -78,15 +96,35 @@ class Mesowest():
          
         self.params = p
         
+        if 'mesowest_batch_size' in self.config:
+            self.batch_size = int(self.config['mesowest_batch_size'])
+        self.stream = utils.config_bool(self.config, 'mesowest_stream', self.stream)
+        if self.stream and (ijson is None):
+            self._logger.warn('ijson is not installed, Mesowest responses will not be streamed')
+            self.stream = False
+        if 'mesowest_backfill_days' in self.config:
+            self.backfill_chunk = pd.Timedelta(days=float(self.config['mesowest_backfill_days']))
+        if 'mesowest_max_retry_after' in self.config:
+            self.max_retry_after = float(self.config['mesowest_max_retry_after'])
+            
+        self.backfill = Backfill(db, 'mesowest', self.backfill_chunk)
+            
+        self.fetcher = Fetcher(concurrency=self.concurrency,
+                               max_retry_after=self.max_retry_after)
+        
         self._logger.debug('Initialized Mesowest')
         
-    def metadata(self):
+    def metadata(self, incremental=False):
         """
         Retrieve the metadata from Mesowest. Two calls are made to the Mesowest API.
         The first call is to get the networks in order to determine the `network` and
         `primary_provider`. The second call retrieves the metadata given the `config`
         parameters. The two dataframes are combined and inserted into the database
         given the :class:`~wxcb.database.Database` instance.
+        
+        Args:
+            incremental: only write the stations that are new or whose
+                metadata changed since the last refresh
         """
         
         self._logger.info('Obtaining metadata form Mesowest')
@@ -123,13 +161,22 @@ class Mesowest():
         DF['reported_long'] = DF['longitude']
         
         # calculate the UTM coordinates
-        DF['utm_x'], DF['utm_y'], DF['utm_zone'] = zip(*DF.apply(utils.df_utm, axis=1))
+        DF['utm_x'], DF['utm_y'], DF['utm_zone'] = utils.utm_coords(DF['latitude'], DF['longitude'])
         
         # add the source to the DF
         DF['source'] = 'mesowest'
         
         DF = DF.where((pd.notnull(DF)), None)
         
+        if incremental:
+            status = self.db.metadata_status(DF, self.db.read_metadata('mesowest'))
+            self._logger.info('Mesowest metadata: {} new, {} changed, {} unchanged stations'.format(
+                (status == 'new').sum(), (status == 'changed').sum(), (status == 'unchanged').sum()))
+            
+            DF = DF[(status != 'unchanged').values]
+            if len(DF) == 0:
+                return
+        
         # insert the dataframe into the database
         self.db.insert_data(DF, 'metadata', description='Mesowest metadata')
         
@@ -138,61 +185,152 @@ class Mesowest():
     def data(self):
         """
         Retrieve the data from Mesowest. Build a list of the URL's that 
-        need to be fetched and use grequests to fetch the data. Then the
-        data retrieval will be significantly sped up.
+        need to be fetched and use the :class:`~wxdb.fetch.Fetcher` to fetch
+        the data. The responses
+        are passed through a :class:`~wxdb.pipeline.Pipeline` as they are
+        returned so that parsing and database writes for finished stations
+        overlap with the remaining downloads.
         """
         
         req = self.build_timeseries_url()
         
-        # send the requests to CDEC
+        # send the requests to Mesowest
         self._logger.info('Sending {} requests to Mesowest API'.format(len(req)))
-        res = grequests.map(req)
-          
-        count = 0      
-        for rs in res:
-            if rs:
-                if rs.status_code == 200:
-                    try:
-                        data = json.loads(rs.text)
-                        df, av = self.meso2df(data)
-                        self.db.insert_data(df, 
-                                            loc='level0',
-                                            description='Mesowest data for {}'.
-                                            format(df.iloc[0].station_id))
-                        self.db.insert_data(av, 
-                                            loc='level1',
-                                            description='Mesowest data for {} averaged'.
-                                            format(df.iloc[0].station_id))
-                        count += 1
-                    except Exception:
-                        # the data doest have anything in it
-                        q = self.parse_url(rs.url)
-                        self._logger.warn('{} - {}'.format(q['stid'][0],data['SUMMARY']['RESPONSE_MESSAGE']))
-                        
-                    
+        
+        p = Pipeline('Mesowest', maxsize=self.queue_size)
+        p.add_stage('parse', self.parse_response, expand=True)
+        if self.qc:
+            p.add_stage('qc', self.qc_data)
+        p.add_stage('write', self.write_data)
+        
+        counts = p.run(self.fetcher.imap(req))
                         
-        self._logger.info('Retrieved {} good responses form Mesowest'.format(count))
+        self._logger.info('Retrieved {} good responses form Mesowest'.format(counts['write']))
+        self.fetcher.log_stats()
+        
+    def parse_response(self, item):
+        """
+        Parse a response from Mesowest into the data and averaged data for
+        each station in the response
         
+        Args:
+            item: tuple of the :class:`~wxdb.fetch.Request` and the response
+                from the Mesowest timeseries API, the request key is the
+                list of stations and the backfill chunk or None
+            
+        Returns:
+            list of tuples of station id, DataFrame, averaged DataFrame and
+            the backfill chunk for each station with data, None if the
+            response doesn't have any data
+        """
+        
+        req, rs = item
+        group, chunk = req.key
+        requested = ','.join(group)
+        
+        if rs is None:
+            # the fetcher has already logged the failure
+            return None
+        
+        try:
+            if rs.status_code != 200:
+                self._logger.warn('Mesowest returned status {} for {}'.format(
+                    rs.status_code, requested))
+                return None
+            
+            if self.stream:
+                rs.raw.decode_content = True
+                data = decode_stream(rs.raw)
+            else:
+                data = json.loads(rs.text)
+        finally:
+            rs.close()
+        
+        if 'STATION' not in data:
+            # the data doest have anything in it
+            self._logger.warn('{} - {}'.format(requested, data['SUMMARY']['RESPONSE_MESSAGE']))
+            
+            # a backfill chunk without any data is done
+            if (chunk is not None) and (data['SUMMARY'].get('RESPONSE_CODE') == 2):
+                self.backfill.complete(group, chunk)
+            return None
+        
+        out = []
+        failed = []
+        for s in data['STATION']:
+            stid = str(s['STID'])
+            try:
+                df, av = self.meso2df(s)
+                if (df is not None) and (chunk is not None):
+                    df = self.backfill.trim(df, chunk)
+                    av = self.backfill.trim(av, chunk)
+            except Exception:
+                self._logger.warn('{} - error parsing the data'.format(stid))
+                failed.append(stid.upper())
+                continue
+            
+            if df is None:
+                self._logger.warn('{} - no data returned'.format(stid))
+                continue
+            out.append((stid, df, av, chunk))
+                
+        # stations that were not in the response
+        missing = set(requested.upper().split(',')) - \
+            set([str(s['STID']).upper() for s in data['STATION']])
+        for stid in missing:
+            self._logger.warn('{} - not returned by Mesowest'.format(stid))
+            
+        # stations in a backfill chunk without any data to write are done,
+        # stations that failed to parse are requested again on the next run
+        if chunk is not None:
+            written = set([o[0].upper() for o in out])
+            self.backfill.complete([stid for stid in group
+                                    if (stid.upper() not in written) and
+                                    (stid.upper() not in failed)], chunk)
+        
+        return out
+    
+    def qc_data(self, item):
+        """
+        Quality control the averaged data
+        """
+        stid, df, av, chunk = item
+        return stid, df, self.qc.run(av), chunk
+    
+    def write_data(self, item):
+        """
+        Insert the data and averaged data into the database, a backfill
+        chunk is marked complete once both have been written
+        """
+        
+        stid, df, av, chunk = item
+        ok = self.db.insert_data(df, 
+                                 loc='level0',
+                                 description='Mesowest data for {}'.
+                                 format(stid))
+        ok &= self.db.insert_data(av, 
+                                  loc='level1',
+                                  description='Mesowest data for {} averaged'.
+                                  format(stid))
+        
+        if ok and (chunk is not None):
+            self.backfill.complete([stid], chunk)
+            
+        return stid
         
     def build_timeseries_url(self):
         """
-        Build the url's to call Mesowest API and adds the url
-        to the grequests.
+        Build the requests to call Mesowest API
         
         Returns:
-            list of grequest.get objects
+            list of :class:`~wxdb.fetch.Request` with the list of station
+            id's in the request and the backfill chunk as the key
         """
         
-        self.db.db_connect()
-        
         # deteremine the client/s for processing
         client = self.config['client']
         self._logger.info('Client for Mesowest data collection: {}'.format(client))
         
-        # query to get the mesowest stations for the given client
-        client_qry = "SELECT primary_id FROM tbl_stations_view WHERE source='mesowest' AND client='{}'"
-        cursor = self.db.cnx.cursor()
-        
         # get the current local time
         endTime = utils.get_end_time(self.config['timezone'], self.config['end_time'])
         mnt = pytz.timezone(self.config['timezone'])
@@ -203,45 +341,60 @@ class Mesowest():
             startTime = mnt.localize(startTime)
             startTime = startTime.tz_convert('UTC')
         
-        # go through each client and get the stations
+        # the mesowest stations for all the clients
+        stations = self.db.station_index(client).stations(source='mesowest')
+        
+        # determine the last value for every station in one query
+        if self.config['start_time'] is None:
+            watermarks = self.db.get_watermarks(stations, loc='level0')
+        
+        # go through each and get the start time
+        start = {}
+        for stid in stations:
+                    
+            if self.config['start_time'] is None:        
+                startTime = watermarks[stid]
+            
+                if startTime is None:
+                    # start of the water year, do a local time then convert to UTC       
+                    wy = utils.water_day(endTime, self.config['timezone'])
+                    startTime = pd.to_datetime(datetime(wy-1, 10, 1), utc=False)
+                    startTime = mnt.localize(startTime)
+                    startTime = startTime.tz_convert('UTC')
+                    
+            start[stid] = startTime
+            
+        # long ranges are backfilled in chunks
+        backfill_chunks = []
+        if self.config['start_time'] is None:
+            start, backfill_chunks = self.backfill.plan(start, endTime)
+            
+        # build the URL's to retrieve the data, one request for each group
+        # of stations with a similar start time
         req = []
-        for cl in client:
-            self._logger.info('Retrieving current data for client {}'.format(cl))
+        for group in utils.group_stations(start, self.batch_size, self.batch_window):
+            startTime = min([start[stid] for stid in group])
+            stid = ','.join(group)
             
-            cursor.execute(client_qry.format(cl))
-            stations = cursor.fetchall()
+            self._logger.debug('Building url for station {} between {} and {}'.format(
+                stid, startTime.strftime('%Y-%m-%d %H:%M'), endTime.strftime('%Y-%m-%d %H:%M')))
+            p = self.timeseries_params(startTime, endTime, stid)
             
-            # go through each and get the data
-            for stid in stations:
-                stid = stid[0]
-                        
-                if self.config['start_time'] is None:        
-                    # determine the last value for the station
-                    qry = "SELECT max(date_time) + INTERVAL 1 MINUTE AS d FROM tbl_level0 WHERE station_id='%s'" % stid
-                    cursor.execute(qry)
-                    startTime = cursor.fetchone()[0]                 
-                
-                    if startTime is not None:
-                        startTime = pd.to_datetime(startTime, utc=True)
-                    else:             
-                        # start of the water year, do a local time then convert to UTC       
-                        wy = utils.water_day(endTime, self.config['timezone'])
-                        startTime = pd.to_datetime(datetime(wy-1, 10, 1), utc=False)
-                        startTime = mnt.localize(startTime)
-                        startTime = startTime.tz_convert('UTC')
-                    
-                # build the URL's to retrieve the data
-                self._logger.debug('Building url for station {} between {} and {}'.format(
-                    stid, startTime.strftime('%Y-%m-%d %H:%M'), endTime.strftime('%Y-%m-%d %H:%M')))
-                p = self.timeseries_params(startTime, endTime, stid)
-                
-                req.append(grequests.get(self.mesowest_timeseries_url, params=p))
-                
-        cursor.close()
-        self.db.db_close()
+            req.append(Request(self.mesowest_timeseries_url, params=p, key=(group, None),
+                               stream=self.stream))
+            
+        # one request for each group of stations with the same chunk
+        for chunk, group in self.backfill.group(backfill_chunks, self.batch_size):
+            p = self.timeseries_params(chunk[0], chunk[1], ','.join(group))
+            req.append(Request(self.mesowest_timeseries_url, params=p, key=(group, chunk),
+                               stream=self.stream))
+            
+        self._logger.debug('Grouped {} stations and {} backfill chunks into {} requests'.format(
+            len(start), len(backfill_chunks), len(req)))
         
         return req
         
+        
     def timeseries_params(self, startTime, endTime, stid):
         """
         Call Mesowest for the data in bbox between startTime and endTime
@@ -255,22 +408,27 @@ class Mesowest():
         
         return p
     
-    def meso2df(self, data):
+    def meso2df(self, s):
         """
-        Parse the Mesowest retuned data and parse the output into
-        a pandas dataframe
+        Parse the Mesowest retuned data for a station and parse the output
+        into a pandas dataframe. The timestamps are parsed with the fixed
+        UTC format and each variable is converted straight to a float64
+        column. The times are kept as the 'date_time' index, which is written
+        as datetime64 by :meth:`~wxdb.database.Database.insert_data`.
         
         Args:
-            data: dict returned from Mesowest
+            s: station dict from the 'STATION' list returned from Mesowest
             
         Returns:
             Tuple, DataFrame for the returned values from Mesowest and
-            a quality controled DataFrame with bad values removed
+            the hourly averaged DataFrame, (None, None) if the station
+            doesn't have valid observations for a full hour
         """
-        s = data['STATION'][0]
-        
         # determine station id
         station_id = str(s['STID'])
+        obs = s.get('OBSERVATIONS') or {}
+        if not obs.get('date_time'):
+            return None, None
         
         # map the variables that where returned with what the names are
         var = s['SENSOR_VARIABLES'].keys()
@@ -278,23 +436,24 @@ class Mesowest():
         for i in s['SENSOR_VARIABLES']:
             if s['SENSOR_VARIABLES'][i]:
                 v[list(s['SENSOR_VARIABLES'][i].keys())[0]] = i
-                     
-        # convert to dataframe
-        r = pd.DataFrame(s['OBSERVATIONS'],columns=s['OBSERVATIONS'].keys())  # preserve column order
         
-        # truncate the dataframe to ensure that there isn't a leak over to the next hour
-        r['date_time'] = pd.to_datetime(r['date_time']) 
-        r.set_index('date_time', inplace=True)
-        r = r.truncate(r.first_valid_index().ceil('H'), r.last_valid_index().floor('H'))
+        # build the dataframe, only take the variables that we wanted in
+        # case something made it through (preserve column order)
+        r = pd.DataFrame(index=pd.DatetimeIndex(parse_times(obs['date_time']), name='date_time'))
+        for key in obs:
+            name = v.get(key, key)
+            if (name != 'date_time') and (name in var):
+                r[name] = float_array(obs[key])
         
-        # convert to date_time from the returned format to MySQL format
-        r['date_time'] = r.index.strftime('%Y-%m-%d %H:%M')
-        
-        # rename the columns and make date time the index    
-        r.rename(columns = v, inplace=True)
-#         r = r.set_index('date_time')
-        vkeep = r.columns.isin(var)
-        r = r[r.columns[vkeep]]  # only take those that we wanted in case something made it through
+        # truncate the dataframe to ensure that there isn't a leak over to the next hour
+        first = r.first_valid_index()
+        if first is None:
+            return None, None
+        first = first.ceil('H')
+        last = r.last_valid_index().floor('H')
+        if first > last:
+            return None, None
+        r = r.truncate(first, last)
         
         # add the station_id
         r['station_id'] = station_id
@@ -306,10 +465,6 @@ class Mesowest():
         # perform average on the dataframe
         df = utils.average_df(r, station_id)
         
-        # quality control
-        if self.qc:
-            df = self.qc.run(df)
-        
         return r, df
 
     def parse_url(self, url):
@@ -325,5 +480,162 @@ class Mesowest():
         
         o = urlparse(url)
         return parse_qs(o.query)
+
+
+def parse_times(values):
+    """
+    Parse the Mesowest timestamps to naive UTC datetime64. The UTC format
+    returned with obstimezone=utc, i.e. 2017-08-01T00:15:00Z, is parsed by
+    NumPy without any format inference. Anything else falls back to pandas.
+    
+    Args:
+        values: list of timestamp strings or datetime64 array
+        
+    Returns:
+        datetime64[ns] array
+    """
+    
+    if isinstance(values, np.ndarray) and values.dtype.kind == 'M':
+        return values.astype('datetime64[ns]')
+    
+    if len(values) > 0 and len(values[0]) == 20 and values[0].endswith('Z'):
+        try:
+            return np.array(values, dtype='U19').astype('datetime64[s]').astype('datetime64[ns]')
+        except ValueError:
+            pass
+        
+    return pd.DatetimeIndex(pd.to_datetime(values, utc=True)).tz_convert(None).values
+
+def float_array(values):
+    """
+    Convert a list of observations to a float64 array with None as NaN
+    
+    Args:
+        values: list of observations or array
+        
+    Returns:
+        float64 array
+    """
+    
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(values), errors='coerce').values.astype(np.float64)
+
+def decode_stream(f, chunk_size=10000):
+    """
+    Decode a timeseries response incrementally with ijson as it is read
+    from f. The observations are appended to typed buffers as they are
+    parsed so the Python objects for the values are never all held in
+    memory, the timestamps are converted `chunk_size` at a time.
+    
+    Args:
+        f: file like object with the response, i.e. `response.raw`
+        chunk_size: number of timestamps to convert at a time
         
+    Returns:
+        dict like json.loads with the 'SUMMARY' and 'STATION' list, the
+        'OBSERVATIONS' for each station are NumPy arrays
+    """
+    
+    top = ObjectBuilder()
+    stations = []
+    station = None
+    obs = None
+    key = None
+    append = None
+    
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        
+        # values of an observation array go straight into the buffer
+        if append is not None:
+            if event == 'end_array':
+                append = None
+            else:
+                append(value)
+            
+        elif prefix.startswith('STATION.item.OBSERVATIONS'):
+            if event == 'map_key':
+                key = value
+                obs[key] = ObservationBuffer(key == 'date_time', chunk_size)
+            elif event == 'start_array':
+                append = obs[key].append
+            
+        elif prefix.startswith('STATION.item'):
+            if (prefix == 'STATION.item') and (event == 'start_map'):
+                station = ObjectBuilder()
+                obs = {}
+                
+            station.event(event, value)
+            
+            if prefix == 'STATION.item':
+                if (event == 'map_key') and (value == 'OBSERVATIONS'):
+                    # placeholder value, filled in when the station ends
+                    station.event('null', None)
+                    
+                elif event == 'end_map':
+                    s = station.value
+                    s['OBSERVATIONS'] = {k: b.values() for k, b in obs.items()}
+                    stations.append(s)
+                    station = None
+                    obs = None
+                
+        elif prefix != 'STATION':
+            top.event(event, value)
+            if (prefix == '') and (event == 'map_key') and (value == 'STATION'):
+                top.event('null', None)
+            
+    data = top.value
+    if 'STATION' in data:
+        data['STATION'] = stations
+        
+    return data
 
+class ObservationBuffer():
+    """
+    Typed buffer for an observation array from :func:`decode_stream`.
+    Values are appended to a float64 array with None as NaN, timestamps
+    are converted to datetime64 `chunk_size` at a time.
+    
+    Args:
+        time: True if the observations are the timestamps
+        chunk_size: number of timestamps to convert at a time
+    """
+    
+    def __init__(self, time=False, chunk_size=10000):
+        self.time = time
+        self.chunk_size = chunk_size
+        self._buffer = array('q' if time else 'd')
+        self._strings = []
+        
+        self.append = self._append_time if time else self._append_value
+        
+    def _append_value(self, value):
+        try:
+            self._buffer.append(np.nan if value is None else value)
+        except TypeError:
+            try:
+                self._buffer.append(float(value))
+            except ValueError:
+                self._buffer.append(np.nan)
+        
+    def _append_time(self, value):
+        self._strings.append(value)
+        if len(self._strings) == self.chunk_size:
+            self._flush()
+                
+    def values(self):
+        """
+        The observations as a float64 or datetime64[ns] array
+        """
+        
+        if self.time:
+            self._flush()
+            return np.frombuffer(self._buffer, dtype=np.int64).view('datetime64[ns]')
+        return np.frombuffer(self._buffer, dtype=np.float64)
+    
+    def _flush(self):
+        if self._strings:
+            t = parse_times(self._strings)
+            self._buffer.extend(t.view(np.int64).tolist())
+            self._strings = []
@@ -0,0 +1,159 @@
+"""
+Staged pipeline to overlap downloading, parsing and writing data
+"""
+
+import logging
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+__author__ = "Scott Havens"
+__maintainer__ = "Scott Havens"
+__email__ = "scott.havens@ars.usda.gov"
+__date__ = "2017-07-27"
+
+# marks the end of the items in a queue
+_STOP = object()
+
+
+class Pipeline():
+    """
+    Pipeline that passes items through a series of stages. Each stage runs
+    in its own worker thread(s) and the stages are connected with bounded
+    queues, so a slow stage applies back pressure to the stages before it
+    and the number of items in memory is limited by the queue size.
+
+    The source of the items is iterated in the calling thread, typically
+    the responses from the data source as they are returned. The last stage
+    is normally the database writer with a single worker.
+
+    Args:
+        name: name of the pipeline for logging
+        maxsize: maximum number of items waiting between two stages
+
+    Example:
+        p = Pipeline('Mesowest')
+        p.add_stage('parse', parse_function)
+        p.add_stage('write', write_function)
+        p.run(responses)
+    """
+
+    def __init__(self, name, maxsize=4):
+        self._logger = logging.getLogger(__name__)
+
+        self.name = name
+        self.maxsize = maxsize
+        self.stages = []
+        self.counts = {}
+        self.errors = {}
+
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, func, workers=1, expand=False):
+        """
+        Add a stage to the end of the pipeline
+
+        Args:
+            name: name of the stage
+            func: function that takes an item and returns the item for the
+                next stage, returning None drops the item
+            workers: number of threads for the stage
+            expand: if True, func returns a list of items that are passed
+                to the next stage one at a time
+        """
+
+        self.stages.append({'name': name, 'func': func, 'workers': workers,
+                            'expand': expand})
+        self.counts[name] = 0
+        self.errors[name] = 0
+
+    def run(self, source):
+        """
+        Run all the items from source through the pipeline and wait for
+        the pipeline to finish
+
+        Args:
+            source: iterable of items for the first stage
+
+        Returns:
+            dict of the number of items each stage completed
+        """
+
+        queues = [Queue(maxsize=self.maxsize) for s in self.stages]
+        queues.append(None)
+
+        # number of workers still running for each stage
+        self._running = [s['workers'] for s in self.stages]
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for w in range(stage['workers']):
+                t = threading.Thread(target=self._worker,
+                                     name='{}-{}-{}'.format(self.name, stage['name'], w),
+                                     args=(i, queues[i], queues[i+1]))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+        try:
+            for item in source:
+                queues[0].put(item)
+        except Exception as e:
+            self._logger.error('{} source failed: {}'.format(self.name, e))
+
+        # signal the end of the items
+        for w in range(self.stages[0]['workers']):
+            queues[0].put(_STOP)
+
+        for t in threads:
+            t.join()
+
+        self._logger.debug('{} pipeline completed {}, errors {}'.format(
+            self.name, self.counts, self.errors))
+
+        return self.counts
+
+    def _worker(self, i, q_in, q_out):
+        """
+        Process items from q_in with stage i and put the results in q_out
+        """
+
+        stage = self.stages[i]
+
+        while True:
+            item = q_in.get()
+
+            if item is _STOP:
+                break
+
+            try:
+                out = stage['func'](item)
+            except Exception as e:
+                self._logger.warn('{} {} stage failed: {}'.format(self.name, stage['name'], e))
+                with self._lock:
+                    self.errors[stage['name']] += 1
+                continue
+
+            with self._lock:
+                self.counts[stage['name']] += 1
+
+            if (out is None) or (q_out is None):
+                continue
+
+            if stage['expand']:
+                for o in out:
+                    q_out.put(o)
+            else:
+                q_out.put(out)
+
+        # the last worker of the stage signals the next stage
+        with self._lock:
+            self._running[i] -= 1
+            last = self._running[i] == 0
+
+        if last and (q_out is not None):
+            for w in range(self.stages[i+1]['workers']):
+                q_out.put(_STOP)
@@ -1,5 +1,4 @@
 import logging
-import pandas as pd
 import numpy as np
 
 __author__ = "Scott Havens"
@@ -86,6 +85,11 @@ class QC():
         
         self.config = config
         
+        # min and max vectors for the range checks
+        self.variables = list(self.ranges.keys())
+        self.min = np.array([self.ranges[v]['min'] for v in self.variables], dtype=np.float64)
+        self.max = np.array([self.ranges[v]['max'] for v in self.variables], dtype=np.float64)
+        
         # database placeholder, if 'write_to' given then write
         # the dataframe to the desired table, if not just return
         # the dataframe
@@ -93,32 +97,46 @@ class QC():
         
     def run(self, data):
         """
-        Simple quality control measures to check out of range and removal
+        Simple quality control measures to check out of range and removal.
+        All the range checks are evaluated at once over a 2D block of the
+        columns in `ranges`. Out of range values are handled by the `flag`
+        option:
+        
+        `remove` - set to NaN
+        
+        `cap` - set to the min or max of the range
+        
+        `fill` - set to the last value in range for the column, NaN if
+            there isn't one
         """
         
-        stid = data.station_id[0]
-        cols = data.columns
-        r = pd.DataFrame(index=data.index)
-        m = pd.DataFrame(index=data.index)
-        for key, val in self.ranges.items():
-            if key in cols:
-                # check for missing data
-                # the station_id and date_time column *should* always have something in them
-                m_idx = data[key].isnull()
-        
-                # check the range
-                r_idx = ~data[key].between(val['min'], val['max'])
-                
-                # value that is NaN is out of range so fix the flag
-                r_idx[m_idx] = False
-                
-                # deal with the data
-                if self.config['flag'] == 'remove':
-                    data.loc[r_idx, key] = np.nan
-                
-                m[key] = m_idx
-                r[key] = r_idx
-                
+        stid = data['station_id'].iloc[0]
+        
+        # the station_id and date_time column *should* always have something
+        # in them so only the columns with ranges are checked
+        sel = [i for i, v in enumerate(self.variables) if v in data.columns]
+        cols = [self.variables[i] for i in sel]
+        lo = self.min[sel]
+        hi = self.max[sel]
+        
+        values = np.array(data[cols].values, dtype=np.float64)
+        
+        # missing and out of range masks, NaN is not out of range
+        m = np.isnan(values)
+        with np.errstate(invalid='ignore'):
+            r = (values < lo) | (values > hi)
+        
+        # deal with the data
+        if r.any():
+            flag = self.config['flag']
+            if flag == 'remove':
+                values[r] = np.nan
+            elif flag == 'cap':
+                np.clip(values, lo, hi, out=values)
+            elif flag == 'fill':
+                values = fill_last(values, r, m)
+            data[cols] = values
+        
         r_idx = r.any(axis=1)
         m_idx = m.any(axis=1)
         
@@ -127,11 +145,8 @@ class QC():
             self._logger.warn('Flagged {} rows for {}'.format(flg, stid))
                 
         # add the flag column
-        data['qc_flag'] = None
-        
-        # add the flags
-        data.loc[m_idx, 'qc_flag'] = 'm'
-        data.loc[r_idx, 'qc_flag'] = data.loc[r_idx, 'qc_flag'] + 'r'
+        data['qc_flag'] = np.where(m_idx, np.where(r_idx, 'mr', 'm'),
+                                   np.where(r_idx, 'r', None)).astype(object)
         
         if self.db:
             # write out to the database
@@ -142,9 +157,28 @@ class QC():
         
         # return the flagged dataframe
         return data
+
+
+def fill_last(values, r, m):
+    """
+    Replace the out of range values in each column with the last value
+    that is in range
+    
+    Args:
+        values: 2D array with a row for each time
+        r: out of range mask
+        m: missing mask
         
-        
-        
-        
-        
-        
\ No newline at end of file
+    Returns:
+        filled array, NaN where there isn't a previous value in range
+    """
+    
+    # row of the last good value at or before each row
+    good = ~(r | m)
+    rows = np.where(good, np.arange(values.shape[0])[:, np.newaxis], -1)
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    
+    filled = values[np.maximum(rows, 0), np.arange(values.shape[1])]
+    filled[rows < 0] = np.nan
+    
+    return np.where(r, filled, values)
@@ -0,0 +1,117 @@
+"""
+Resolve the clients to their stations
+"""
+
+import logging
+
+__author__ = "Scott Havens"
+__maintainer__ = "Scott Havens"
+__email__ = "scott.havens@ars.usda.gov"
+__date__ = "2017-07-27"
+
+
+class StationIndex():
+    """
+    Index of the stations for a list of clients. `tbl_stations_view` is
+    loaded for all the clients with a single parameterized query and
+    indexed by client and by station. Stations that belong to more than
+    one client are only returned once.
+
+    Use :meth:`~wxdb.database.Database.station_index` to get an index that
+    is cached for the run.
+
+    Client names are matched without case, like the `IN` in MySQL, and the
+    rows are indexed under the client names as they were given.
+
+    Args:
+        db: :class:`~wxdb.database.Database` instance
+        clients: list of client names
+
+    Example:
+        index = db.station_index(['BRB', 'TUOL'])
+        stations = index.stations(source='mesowest')
+    """
+
+    view = 'tbl_stations_view'
+
+    def __init__(self, db, clients):
+        self._logger = logging.getLogger(__name__)
+
+        self.db = db
+        self.clients = list(clients)
+
+        self.by_client = {cl: [] for cl in self.clients}
+        self.by_station = {}
+
+        self.load()
+
+    def load(self):
+        """
+        Load the stations for all the clients with one query
+        """
+
+        if len(self.clients) == 0:
+            return
+
+        qry = "SELECT client, primary_id, source, metadata_id FROM {0} " \
+            "WHERE client IN ({1})".format(self.view, ','.join(['%s'] * len(self.clients)))
+
+        with self.db.connection() as cnx:
+            cur = cnx.cursor()
+            cur.execute(qry, self.clients)
+            rows = cur.fetchall()
+            cur.close()
+
+        # the database can return the client in a different case
+        spelling = {cl.lower(): cl for cl in self.clients}
+
+        for client, stid, source, metadata_id in rows:
+            client = spelling.get(client.lower())
+            if client is None:
+                continue
+
+            if stid not in self.by_client[client]:
+                self.by_client[client].append(stid)
+
+            info = self.by_station.setdefault(stid, {'sources': [], 'metadata_id': [],
+                                                     'clients': []})
+            if source not in info['sources']:
+                info['sources'].append(source)
+                info['metadata_id'].append(metadata_id)
+            if client not in info['clients']:
+                info['clients'].append(client)
+
+        for cl in self.clients:
+            self._logger.info('Client {} has {} stations'.format(cl, len(self.by_client[cl])))
+
+    def stations(self, source=None):
+        """
+        Stations for all the clients without duplicates, in client order
+
+        Args:
+            source: only return the stations from the source, i.e.
+                'mesowest', None for all stations
+
+        Returns:
+            list of station primary_id's
+        """
+
+        seen = set()
+        stations = []
+        for cl in self.clients:
+            for stid in self.by_client[cl]:
+                if stid in seen:
+                    continue
+                if (source is not None) and (source not in self.by_station[stid]['sources']):
+                    continue
+                seen.add(stid)
+                stations.append(stid)
+
+        return stations
+
+    def sources(self, stid):
+        """
+        Sources for a station
+        """
+
+        return self.by_station[stid]['sources']
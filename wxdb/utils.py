@@ -17,6 +17,42 @@ FREEZE = 273.16         # freezing temp K
 BOIL = 373.15           # boiling temperature K
 SEA_LEVEL = 1.013246e5  # sea level pressure
 
+# affine unit conversions keyed by (from_unit, to_unit), value = scale * x + offset
+UNIT_CONVERSIONS = {
+    ('deg_f', 'deg_c'): (5.0 / 9.0, -32.0 * 5.0 / 9.0),
+    ('inches', 'mm'): (25.4, 0.0),
+    ('mph', 'm/s'): (0.44704, 0.0),
+    }
+
+# metric unit that convert_units converts each unit to
+METRIC_UNITS = {
+    'deg_f': 'deg_c',
+    'inches': 'mm',
+    'mph': 'm/s'
+    }
+
+# how each variable is aggregated to the hour in average_df, variables that
+# are not listed are averaged
+AGGREGATION = {
+    'wind_direction': 'circular',   # mean of the unit vectors
+    'wind_gust': 'max',
+    'precip_accum': 'last',         # accumulators keep the last value
+    'precip_storm': 'last',
+    'snow_accum': 'last'
+    }
+
+HOUR_NS = 3600 * 10**9  # nanoseconds in an hour
+
+# WGS84 constants for the UTM conversion, same as the utm package
+UTM_K0 = 0.9996
+UTM_E = 0.00669438
+UTM_E_P2 = UTM_E / (1.0 - UTM_E)
+UTM_R = 6378137
+UTM_M1 = (1 - UTM_E / 4 - 3 * UTM_E**2 / 64 - 5 * UTM_E**3 / 256)
+UTM_M2 = (3 * UTM_E / 8 + 3 * UTM_E**2 / 32 + 45 * UTM_E**3 / 1024)
+UTM_M3 = (15 * UTM_E**2 / 256 + 45 * UTM_E**3 / 1024)
+UTM_M4 = (35 * UTM_E**3 / 3072)
+
 def water_day(indate, timezone):
     """
     Determine the decimal day in the water year
@@ -64,69 +100,233 @@ def get_end_time(timezone, end_time=None, to_timezone='UTC'):
         endTime = mnt.localize(endTime)
     return endTime.tz_convert(to_timezone)
 
+def group_stations(start, size, window):
+    """
+    Group the stations into batches of at most `size` stations where the
+    start times are within `window` of the earliest start time in the batch.
+
+    Args:
+        start: dict of start times keyed by station
+        size: maximum number of stations in a batch
+        window: pandas Timedelta for the spread of start times in a batch
+
+    Returns:
+        list of lists of station id's
+    """
+
+    groups = []
+    group = []
+    for stid in sorted(start, key=lambda s: start[s]):
+        if (len(group) == size) or \
+                (group and start[stid] - start[group[0]] > window):
+            groups.append(group)
+            group = []
+        group.append(stid)
+
+    if group:
+        groups.append(group)
 
-def convert_units(r, units):
+    return groups
+
+def config_bool(config, key, default=False):
+    """
+    Read a boolean option from a config section. The bare key without a
+    value is True, otherwise the value is one of true/false, yes/no, on/off
+    or 1/0 in any case.
+
+    Args:
+        config: dict of the config section
+        key: option name
+        default: value if the option isn't in the section
+
+    Returns:
+        bool
+    """
+
+    if key not in config:
+        return default
+
+    value = config[key]
+    if isinstance(value, bool):
+        return value
+    if value is None:
+        return True
+
+    value = str(value).strip().lower()
+    if value in ['', 'true', 'yes', 'on', '1']:
+        return True
+    if value in ['false', 'no', 'off', '0']:
+        return False
+
+    raise ValueError('{} must be true or false, not {}'.format(key, config[key]))
+
+def register_conversion(from_unit, to_unit, scale, offset=0.0, metric=False):
+    """
+    Add an affine unit conversion to the registry, the converted value is
+    `scale * x + offset`
+    
+    Args:
+        from_unit: unit to convert from, i.e. 'deg_f'
+        to_unit: unit to convert to, i.e. 'deg_c'
+        scale: multiplier
+        offset: value added after the multiplication
+        metric: make `to_unit` the unit that :func:`convert_units` converts
+            `from_unit` to by default
+    """
+    
+    UNIT_CONVERSIONS[(from_unit, to_unit)] = (float(scale), float(offset))
+    if metric:
+        METRIC_UNITS[from_unit] = to_unit
+
+def convert_units(r, units, to_units=None):
     """
     Convert the units of a dataframe from english
     to metric. The dictionary provides the column name
-    with the current unit
+    with the current unit. Columns that are converted the same way are
+    converted together as one 2D block with in place NumPy operations,
+    columns with a unit that has no conversion are left as is.
     
     Args:
         r: dataframe to convert
         units: dict for {col_name: unit}
+        to_units: dict for {col_name: unit} to convert to, defaults to
+            the unit in `METRIC_UNITS`
         
     Returns:
         dataframe r converted
     """
     
-    # columns of data frame
-    col = r.columns
+    if to_units is None:
+        to_units = {c: METRIC_UNITS.get(u) for c, u in units.items()}
     
-    # functions to apply
-    f2c = lambda x: (x - 32) * 5 / 9
-    in2mm = lambda x: x * 25.4
-    mph2ms = lambda x: x * 0.44704
+    # group the columns by the conversion
+    groups = {}
+    for c in r.columns:
+        key = (units.get(c), to_units.get(c))
+        if key in UNIT_CONVERSIONS:
+            groups.setdefault(key, []).append(c)
     
-    for c in col:
-        
-        if c in units.keys():
-            
-            if units[c] == 'deg_f':
-                func = f2c
-            elif units[c] == 'inches':
-                func = in2mm
-            elif units[c] == 'mph':
-                func = mph2ms
-            else:
-                func = None
+    for key, cols in groups.items():
+        scale, offset = UNIT_CONVERSIONS[key]
+        block = np.array(r[cols].values, dtype=np.float64)
+        np.multiply(block, scale, out=block)
+        if offset != 0.0:
+            np.add(block, offset, out=block)
+        r[cols] = block
         
-        if func is not None:
-            r[c] = r[c].map(func)
-
     return r
 
-def average_df(r, stid):
+def average_df(r, stid, counts=False):
     """
-    Average the dataframe. Performs a copy of the original dataframe then
-    resample 'H' will take the mean of the values that fall within the hour.
+    Aggregate the numeric columns of the dataframe to the hour. Each
+    variable is reduced as given in `AGGREGATION`, the circular mean for
+    direction, the maximum for gusts, the last value for accumulators and
+    the mean for everything else. The hour is the start of the hour the
+    value falls within, the same as resample 'H'.
     
     Args:
         r: DataFrame with 'date_time' as index
         stid: station id, will be entered as a columns
+        counts: also return the number of observations in each hour
         
     Returns:
-        DataFrame that is resampled with a 'date_time' and 'station_id' columns
-        added back in
+        DataFrame that is resampled with the hour as the 'date_time' index and
+        the 'station_id' column added back in. If `counts`, a tuple of the
+        DataFrame and a DataFrame of the observation counts for each variable.
     """
     
-    df = r.copy()
-    df = df.resample('H').mean()
-    df.dropna(axis=0, how='all', inplace=True)
-    df['date_time'] = df.index.strftime('%Y-%m-%d %H:%M')
+    num = r.select_dtypes(include=[np.number])
+    
+    how = [AGGREGATION.get(c, 'mean') for c in num.columns]
+    hours, values, n = hourly_aggregate(r.index.asi8, num.values, how)
+    
+    index = pd.DatetimeIndex(hours * HOUR_NS, name='date_time')
+    if r.index.tz is not None:
+        index = index.tz_localize('UTC').tz_convert(r.index.tz)
+    
+    # only the hours with an observation
+    keep = (n > 0).any(axis=1)
+    df = pd.DataFrame(values[keep], index=index[keep], columns=num.columns)
     df['station_id'] = stid
     
+    if counts:
+        return df, pd.DataFrame(n[keep], index=df.index, columns=num.columns)
+    
     return df
 
+def hourly_aggregate(t, values, how):
+    """
+    Reduce the columns of a 2D block to the hour in one pass. The times
+    are bucketed into integer hours since the epoch and every reducer is a
+    `reduceat` over the hour segments, missing values are ignored.
+    
+    Args:
+        t: int64 array of nanoseconds since the epoch
+        values: 2D array with a row for each time
+        how: reducer for each column, 'mean', 'max', 'last' or 'circular'
+            for the mean direction in degrees
+        
+    Returns:
+        tuple of the int64 hours since the epoch, the 2D float64 array of
+        the reduced values and the 2D int64 array of the observation counts
+    """
+    
+    t = np.asarray(t, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    
+    if len(t) == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, values.shape[1])), \
+            np.empty((0, values.shape[1]), dtype=np.int64)
+    
+    # stable sort so the last value in an hour is the last observation
+    if np.any(t[1:] < t[:-1]):
+        order = np.argsort(t, kind='mergesort')
+        t = t[order]
+        values = values[order]
+    
+    hour = t // HOUR_NS
+    starts = np.r_[0, np.flatnonzero(hour[1:] != hour[:-1]) + 1]
+    
+    valid = ~np.isnan(values)
+    n = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    out = np.full(n.shape, np.nan)
+    has = n > 0
+    how = np.asarray(how)
+    
+    # mean
+    col = how == 'mean'
+    if col.any():
+        s = np.add.reduceat(np.where(valid[:, col], values[:, col], 0.0), starts, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[:, col] = np.where(has[:, col], s / n[:, col], np.nan)
+    
+    # max ignoring missing values
+    col = how == 'max'
+    if col.any():
+        out[:, col] = np.fmax.reduceat(values[:, col], starts, axis=0)
+    
+    # last valid value, the row of the last valid value in each hour
+    col = how == 'last'
+    if col.any():
+        rows = np.where(valid[:, col], np.arange(len(t))[:, np.newaxis], 0)
+        last = np.maximum.reduceat(rows, starts, axis=0)
+        v = values[:, col]
+        out[:, col] = np.where(has[:, col], v[last, np.arange(v.shape[1])], np.nan)
+    
+    # circular mean of the directions
+    col = how == 'circular'
+    if col.any():
+        rad = np.where(valid[:, col], np.radians(values[:, col]), np.nan)
+        s = np.add.reduceat(np.where(valid[:, col], np.sin(rad), 0.0), starts, axis=0)
+        c = np.add.reduceat(np.where(valid[:, col], np.cos(rad), 0.0), starts, axis=0)
+        d = np.mod(np.degrees(np.arctan2(s, c)), 360.0)
+        d[d >= 360.0] = 0.0
+        out[:, col] = np.where(has[:, col], d, np.nan)
+    
+    return hour[starts], out, n
+
 def df_utm(row):
     """
     Calculate the UTM coordinates for a dataframe row
@@ -144,12 +344,89 @@ def df_utm(row):
         ret = (None, None, None)
     return ret
 
-def satw(tk):
+def utm_coords(lat, lon):
+    """
+    Calculate the UTM coordinates for arrays of latitude and longitude at
+    once. Uses the same formulas as `utm.from_latlon` with the zone and
+    central meridian calculated for each point, so points in different
+    zones are converted together. Rows with a missing or out of range
+    latitude or longitude get NaN and a zone of None.
+    
+    Args:
+        lat: array like of latitudes in degrees
+        lon: array like of longitudes in degrees
+        
+    Returns:
+        tuple of arrays with utm_x, utm_y and utm_zone
+    """
+    
+    lat = pd.to_numeric(pd.Series(np.asarray(lat)), errors='coerce').values.astype(np.float64)
+    lon = pd.to_numeric(pd.Series(np.asarray(lon)), errors='coerce').values.astype(np.float64)
+    
+    valid = (lat >= -80.0) & (lat <= 84.0) & (lon >= -180.0) & (lon <= 180.0)
+    lat = np.where(valid, lat, 0.0)
+    lon = np.where(valid, lon, 0.0)
+    
+    # zone number with the exceptions for Norway and Svalbard
+    zone = np.floor((lon + 180) / 6).astype(np.int64) + 1
+    zone[(lat >= 56) & (lat < 64) & (lon >= 3) & (lon < 12)] = 32
+    svalbard = (lat >= 72) & (lon >= 0)
+    for lower, upper, z in [(0, 9, 31), (9, 21, 33), (21, 33, 35), (33, 42, 37)]:
+        zone[svalbard & (lon >= lower) & (lon < upper)] = z
+    
+    letter = np.array(list('CDEFGHJKLMNPQRSTUVWXX'))[(lat + 80).astype(np.int64) >> 3]
+    
+    lat_rad = np.radians(lat)
+    lat_sin = np.sin(lat_rad)
+    lat_cos = np.cos(lat_rad)
+    lat_tan = lat_sin / lat_cos
+    lat_tan2 = lat_tan * lat_tan
+    lat_tan4 = lat_tan2 * lat_tan2
+    
+    central_lon_rad = np.radians((zone - 1) * 6 - 180 + 3)
+    
+    n = UTM_R / np.sqrt(1 - UTM_E * lat_sin**2)
+    c = UTM_E_P2 * lat_cos**2
+    
+    a = lat_cos * (np.radians(lon) - central_lon_rad)
+    a2 = a * a
+    a3 = a2 * a
+    a4 = a3 * a
+    a5 = a4 * a
+    a6 = a5 * a
+    
+    m = UTM_R * (UTM_M1 * lat_rad -
+                 UTM_M2 * np.sin(2 * lat_rad) +
+                 UTM_M3 * np.sin(4 * lat_rad) -
+                 UTM_M4 * np.sin(6 * lat_rad))
+    
+    x = UTM_K0 * n * (a +
+                      a3 / 6 * (1 - lat_tan2 + c) +
+                      a5 / 120 * (5 - 18 * lat_tan2 + lat_tan4 + 72 * c - 58 * UTM_E_P2)) + 500000
+    
+    y = UTM_K0 * (m + n * lat_tan * (a2 / 2 +
+                                     a4 / 24 * (5 - lat_tan2 + 9 * c + 4 * c**2) +
+                                     a6 / 720 * (61 - 58 * lat_tan2 + lat_tan4 + 600 * c - 330 * UTM_E_P2)))
+    y[lat < 0] += 10000000
+    
+    x[~valid] = np.nan
+    y[~valid] = np.nan
+    utm_zone = np.array([str(z) + l for z, l in zip(zone, letter)], dtype=object)
+    utm_zone[~valid] = None
+    
+    return x, y, utm_zone
+
+def satw(tk, out=None):
     """
     Saturation vapor pressure of water. from IPW satw
 
+    The terms are computed over the whole array with `out=` ufuncs into
+    the output and two work arrays, `tk` is never modified. float32 input
+    is computed in float32, anything else in float64.
+
     Args:
         tk: temperature in Kelvin
+        out: (optional) array to write the result into
 
     Returns:
         saturated vapor pressure over water
@@ -157,28 +434,30 @@ def satw(tk):
     20151027 Scott Havens
     """
 
-    # remove bad values
-    tk[tk < 0] = np.nan
-
-    l10 = np.log(10.0)
+    tk, out, (x, z) = _sat_arrays(tk, out, 2)
 
-    btk = BOIL/tk
-    x = -7.90298*(btk - 1.0) + 5.02808*np.log(btk)/l10 - \
-        1.3816e-7*(np.power(10.0, 1.1344e1*(1.0 - tk/BOIL))-1.) + \
-        8.1328e-3*(np.power(10.0, -3.49149*(btk - 1.0)) - 1.0) + \
-        np.log(SEA_LEVEL)/l10
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        x[...] = tk
+        _satw_kernel(x, out, z)
 
-    x = np.power(10.0, x)
+        # remove bad values
+        out[tk < 0] = np.nan
 
-    return x
+    return out
 
 
-def sati(tk):
+def sati(tk, out=None):
     """
     saturation vapor pressure over ice. From IPW sati
 
+    The values above and at or below freezing are gathered into the work
+    arrays with `np.compress` and each branch is only computed for its own
+    values, the work arrays are allocated once and shared by both
+    branches. `tk` is never modified.
+
     Args:
         tk: temperature in Kelvin
+        out: (optional) array to write the result into
 
     Returns:
         saturated vapor pressure over ice
@@ -186,24 +465,105 @@ def sati(tk):
     20151027 Scott Havens
     """
 
-    # remove bad values
-    tk[tk < 0] = np.nan
+    tk, out, work = _sat_arrays(tk, out, 3, flat=True)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        ice = tk <= FREEZE
+
+        # vapor above freezing then vapor below freezing
+        for mask, kernel in [(~ice, _satw_kernel), (ice, _sati_kernel)]:
+            n = np.count_nonzero(mask)
+            if n == 0:
+                continue
+            x, y, z = [w[:n] for w in work]
+            np.compress(mask.ravel(), tk.ravel(), out=x)
+            kernel(x, y, z)
+            np.place(out, mask, y)
+
+        # remove bad values
+        out[tk < 0] = np.nan
 
-    # preallocate
-    x = np.empty(tk.shape)
+    return out
 
-    # vapor above freezing
-    ind = tk > FREEZE
-    x[ind] = satw(tk[ind])
 
-    # vapor below freezing
-    l10 = np.log(10.0)
-    x[~ind] = 100.0 * np.power(10.0, -9.09718*((FREEZE/tk[~ind]) - 1.0) -
-                               3.56654*np.log(FREEZE/tk[~ind])/l10 +
-                               8.76793e-1*(1.0 - (tk[~ind]/FREEZE)) +
-                               np.log(6.1071)/l10)
+def _satw_kernel(x, y, z):
+    """
+    Saturation vapor pressure over water in place, `x` holds the
+    temperature and is overwritten, the result is written to `y` and `z`
+    is a work array
+    """
+
+    # 5.02808*log10(btk) - 7.90298*(btk - 1.0)
+    np.divide(BOIL, x, out=x)
+    np.log10(x, out=y)
+    y *= 5.02808
+    np.subtract(x, 1.0, out=z)
+    z *= -7.90298
+    y += z
 
-    return x
+    # 8.1328e-3*(10**(-3.49149*(btk - 1.0)) - 1.0)
+    np.subtract(x, 1.0, out=z)
+    z *= -3.49149
+    np.power(10.0, z, out=z)
+    z -= 1.0
+    z *= 8.1328e-3
+    y += z
+
+    # -1.3816e-7*(10**(1.1344e1*(1.0 - tk/BOIL)) - 1.0)
+    np.reciprocal(x, out=x)
+    np.subtract(1.0, x, out=x)
+    x *= 1.1344e1
+    np.power(10.0, x, out=x)
+    x -= 1.0
+    x *= 1.3816e-7
+    y -= x
+
+    y += np.log10(SEA_LEVEL)
+    np.power(10.0, y, out=y)
+
+
+def _sati_kernel(x, y, z):
+    """
+    Saturation vapor pressure over ice in place, `x` holds the
+    temperature and is overwritten, the result is written to `y` and `z`
+    is a work array
+    """
+
+    # -9.09718*((FREEZE/tk) - 1.0) - 3.56654*log10(FREEZE/tk)
+    np.divide(FREEZE, x, out=x)
+    np.log10(x, out=y)
+    y *= -3.56654
+    np.subtract(x, 1.0, out=z)
+    z *= -9.09718
+    y += z
+
+    # 8.76793e-1*(1.0 - (tk/FREEZE))
+    np.reciprocal(x, out=x)
+    np.subtract(1.0, x, out=x)
+    x *= 8.76793e-1
+    y += x
+
+    y += np.log10(6.1071)
+    np.power(10.0, y, out=y)
+    y *= 100.0
+
+
+def _sat_arrays(tk, out, n, flat=False):
+    """
+    Array, output and `n` work arrays for the saturation vapor pressure.
+    The work arrays have the shape of `tk`, or are 1D if `flat`. float32
+    stays float32, everything else is float64.
+    """
+
+    tk = np.asarray(tk)
+    dtype = np.float32 if tk.dtype == np.float32 else np.float64
+    tk = tk.astype(dtype, copy=False)
+
+    if out is None:
+        out = np.empty(tk.shape, dtype=dtype)
+
+    shape = (tk.size,) if flat else tk.shape
+    return tk, out, [np.empty(shape, dtype=dtype) for i in range(n)]
    
 def rh2vp(ta, rh):
     """
@@ -218,12 +578,11 @@ def rh2vp(ta, rh):
         vapor pressure in Pascals
     """ 
     
-    if np.max(rh) >= 1.0:
+    rh = np.asarray(rh)
+    if np.any(rh >= 1.0):
         rh = rh / 100.0
     
-    vp = sati(ta + FREEZE)
-    
-    return vp * rh
-    
+    vp = sati(np.add(ta, FREEZE))
+    vp *= rh
     
-    
\ No newline at end of file
+    return vp
@@ -18,6 +18,7 @@ from mesowest import Mesowest
 from cdec import CDEC
 from quality_control import QC
 from acid import ACID
+from utils import config_bool
 
 __author__ = "Scott Havens"
 __maintainer__ = "Scott Havens"
@@ -159,11 +160,14 @@ class Weather():
         Get the metadata from the sources
         """
         
+        # only write the new and changed stations
+        incremental = config_bool(self.config['metadata'], 'incremental')
+        
         for s in self.config['metadata']['sources']:
             if s == 'mesowest':
-                Mesowest(self.db, self.config['mesowest_metadata']).metadata()
+                Mesowest(self.db, self.config['mesowest_metadata']).metadata(incremental)
             elif s == 'cdec':
-                CDEC(self.db).metadata()
+                CDEC(self.db).metadata(incremental)
                 
         # update the station from tbl_station_update
         self.update_stations()
@@ -244,6 +248,9 @@ class Weather():
             
 #         if self.perform_qc:
 #             QC(self.config['quality_control']).run()
+        
+        # close the pooled connections
+        self.db.close()
                     
         self._logger.info('Elapsed time: {}'.format(datetime.now() - startTime))
         self._logger.info('Done')    